@@ -0,0 +1,650 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from sqlalchemy import Integer, cast, func, select
+from sqlalchemy.orm import sessionmaker
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only the columnar engine needs it
+    np = None
+
+from database import create_sqlite_engine
+from create import Base, Office, EstateAgent, Listing, Sale, Commission
+from benchmark import BENCHMARK_MONTH, generate_dataset
+from queries import get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price
+
+# Number of rows fetched per round trip while loading the columns
+CHUNK_SIZE = 100000
+
+# Marks a missing date in the day columns
+MISSING_DAY = np.iinfo(np.int32).min if np is not None else None
+
+def days_since_epoch(column):
+    """
+    Convert a date column to the number of days since 1970-01-01 in SQL.
+
+    param column: Date column
+    return: SQLAlchemy column expression
+    """
+    return cast(func.julianday(column) - 2440587.5, Integer)
+
+def month_index(year, month):
+    """
+    Get the number of months between January 1970 and a month.
+
+    param year: Year
+    param month: Month
+    return: Month index
+    """
+    return (year - 1970) * 12 + month - 1
+
+# Little-endian dtype of every column of the snapshot format
+SALE_COLUMNS = {"sale_id": "<i8", "listing_id": "<i8", "agent_id": "<i8", "sale_price": "<f8", "sale_day": "<i4"}
+COMMISSION_COLUMNS = {"commission_sale_id": "<i8", "commission_agent_id": "<i8", "commission_amount": "<f8", "commission_day": "<i4"}
+LISTING_COLUMNS = {"listing_office": "<i8", "listing_day": "<i4"}
+INDEX_COLUMNS = {"month_order": "<i8", "sorted_month": "<i4"}
+
+MANIFEST = "manifest.json"
+
+class SalesColumns:
+    """
+    Columnar copy of the sales, commissions and listings tables for vectorised monthly KPIs.
+
+    Sales and commissions are parallel NumPy arrays in sale_id order. month_order lists
+    the sale positions sorted by month of sale, so the sales of a month are one slice of
+    it found with a binary search on sorted_month. Listing attributes are dense arrays
+    indexed by listing_id. The arrays are either loaded from the database or memory-mapped
+    from a snapshot written by export_snapshot. The results match the SQL reports in
+    queries.py.
+
+    Attributes:
+        sale_id (ndarray): Id of every sale
+        listing_id (ndarray): Listing of every sale, -1 if missing
+        agent_id (ndarray): Agent of every sale, -1 if missing
+        sale_price (ndarray): Price of every sale, NaN if missing
+        sale_day (ndarray): Day of every sale since 1970-01-01
+        commission_sale_id (ndarray): Sale of every commission
+        commission_agent_id (ndarray): Agent of every commission, -1 if missing
+        commission_amount (ndarray): Amount of every commission, NaN if missing
+        commission_day (ndarray): Day of sale of every commission since 1970-01-01
+        listing_office (ndarray): Office of every listing by listing_id, -1 if missing
+        listing_day (ndarray): Listing day of every listing by listing_id, MISSING_DAY if missing
+        month_order (ndarray): Sale positions sorted by month of sale
+        sorted_month (ndarray): Month of sale since January 1970 of every entry of month_order
+        offices (dict): City and state by office_id
+        agents (set): Ids of the agents in estate_agents, None to count every agent id
+    """
+
+    def __init__(self, columns, offices, agents=None):
+        if np is None:
+            raise ImportError("SalesColumns requires numpy")
+        for name in SALE_COLUMNS.keys() | COMMISSION_COLUMNS.keys() | LISTING_COLUMNS.keys() | INDEX_COLUMNS.keys():
+            setattr(self, name, columns[name])
+        self.offices = offices
+        self.agents = agents
+
+    @classmethod
+    def load(cls, session, chunk_size=CHUNK_SIZE):
+        """
+        Load the columns from the database with chunked fetchmany calls.
+
+        param session: SQLAlchemy session
+        param chunk_size: Number of rows fetched per round trip
+        return: SalesColumns
+        """
+        if np is None:
+            raise ImportError("SalesColumns requires numpy")
+        connection = session.connection()
+        columns = {}
+        for names, query in ((SALE_COLUMNS, _sales_query(0)), (COMMISSION_COLUMNS, _commissions_query(0))):
+            columns.update(zip(names, _fetch_columns(connection, query, names.values(), chunk_size)))
+        listing_id, listing_office, listing_day = _fetch_columns(connection, _listings_query(0), ("<i8", "<i8", "<i4"), chunk_size)
+        size = int(max(listing_id.max(initial=0), columns["listing_id"].max(initial=0))) + 1
+        columns["listing_office"] = np.full(size, -1, dtype=np.int64)
+        columns["listing_day"] = np.full(size, MISSING_DAY, dtype=np.int32)
+        columns["listing_office"][listing_id] = listing_office
+        columns["listing_day"][listing_id] = listing_day
+        columns["month_order"], columns["sorted_month"] = _month_index(columns["sale_day"])
+        return cls(columns, _load_offices(connection), _load_agents(connection))
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """
+        Open a snapshot written by export_snapshot without reading it into memory.
+
+        param path: Snapshot directory
+        return: SalesColumns
+        """
+        if np is None:
+            raise ImportError("SalesColumns requires numpy")
+        manifest = _read_manifest(path)
+        columns = {name: _memmap(path, name, dtype, manifest) for name, dtype in manifest["columns"].items()}
+        offices = {int(office_id): tuple(office) for office_id, office in manifest["offices"].items()}
+        agents = set(manifest["agents"]) if "agents" in manifest else None
+        return cls(columns, offices, agents)
+
+    def __len__(self):
+        return len(self.sale_day)
+
+    def month_positions(self, year, month):
+        """
+        Get the positions of the sales of a month.
+
+        param year: Year
+        param month: Month
+        return: ndarray of positions
+        """
+        index = month_index(year, month)
+        return self.month_order[
+            int(np.searchsorted(self.sorted_month, index, side="left")):int(np.searchsorted(self.sorted_month, index, side="right"))
+        ]
+
+    def get_top_offices(self, year, month):
+        """
+        Get the top 5 offices by number of sales in a given month and year.
+
+        param year: Year
+        param month: Month
+        return: List of (office_id, city, state, sales_count) tuples
+        """
+        listing_id = self.listing_id[self.month_positions(year, month)]
+        offices = self.listing_office[listing_id[listing_id >= 0]]
+        counts = np.bincount(offices[offices >= 0])
+        top = []
+        for office_id in _top(counts, descending_ids=True):
+            if office_id in self.offices:
+                top.append((office_id, *self.offices[office_id], int(counts[office_id])))
+            if len(top) == 5:
+                break
+        return top
+
+    def get_top_agents(self, year, month):
+        """
+        Get the top 5 agents by number of sales in a given month and year.
+
+        Agent ids missing from estate_agents are skipped, like the join of the SQL report does.
+
+        param year: Year
+        param month: Month
+        return: List of (agent_id, sales_count) tuples
+        """
+        agents = self.agent_id[self.month_positions(year, month)]
+        counts = np.bincount(agents[agents >= 0])
+        top = []
+        for agent_id in _top(counts):
+            if self.agents is None or agent_id in self.agents:
+                top.append((agent_id, int(counts[agent_id])))
+            if len(top) == 5:
+                break
+        return top
+
+    def get_average_days_on_market(self, year, month):
+        """
+        Get the average number of days a listing is on the market before it is sold in a given month and year.
+
+        param year: Year
+        param month: Month
+        return: Average number of days on market, None if there were no sales
+        """
+        days = self._listed(self.month_positions(year, month))[1]
+        return float(days.mean()) if len(days) else None
+
+    def get_average_selling_price(self, year, month):
+        """
+        Get the average selling price of a home in a given month and year.
+
+        param year: Year
+        param month: Month
+        return: Average selling price, None if there were no sales
+        """
+        prices = self.sale_price[self.month_positions(year, month)]
+        prices = prices[~np.isnan(prices)]
+        return float(prices.mean()) if len(prices) else None
+
+    def get_monthly_commissions(self, year, month):
+        """
+        Get the total commission of every agent in a given month and year.
+
+        param year: Year
+        param month: Month
+        return: List of (agent_id, total_commission) tuples
+        """
+        in_month = (_months(self.commission_day) == month_index(year, month)) & (self.commission_agent_id >= 0)
+        agents = self.commission_agent_id[in_month]
+        amounts = self.commission_amount[in_month]
+        totals = np.bincount(agents, weights=np.nan_to_num(amounts))
+        return [(int(agent_id), float(totals[agent_id])) for agent_id in np.unique(agents)]
+
+    def monthly_average_selling_price(self):
+        """
+        Get the average selling price of every month with sales.
+
+        return: Dictionary of average selling price by (year, month)
+        """
+        priced = ~np.isnan(self.sale_price)
+        return _monthly_means(_months(self.sale_day)[priced], self.sale_price[priced])
+
+    def monthly_average_days_on_market(self):
+        """
+        Get the average number of days on market of every month with sales.
+
+        return: Dictionary of average days on market by (year, month)
+        """
+        listed, days = self._listed(slice(None))
+        return _monthly_means(_months(self.sale_day)[listed], days)
+
+    def _listed(self, positions):
+        """
+        Get which sales have a listing date, with their days on market.
+
+        param positions: Positions of the sales
+        return: Tuple of (boolean mask, days on market of the listed sales)
+        """
+        listing_id = self.listing_id[positions]
+        known = (listing_id >= 0) & (listing_id < len(self.listing_day))
+        listing_day = np.where(known, self.listing_day[np.where(known, listing_id, 0)], MISSING_DAY)
+        listed = listing_day != MISSING_DAY
+        return listed, (self.sale_day[positions][listed] - listing_day[listed]).astype(np.int64)
+
+def export_snapshot(session, path, chunk_size=CHUNK_SIZE):
+    """
+    Write the sales, commissions and listings tables to a columnar snapshot.
+
+    Every column is one raw little-endian file that SalesColumns.from_snapshot opens with
+    np.memmap. manifest.json records the dtypes, the row counts, the offices, the agents and the
+    highest sale_id covered, which refresh_snapshot uses as its watermark.
+
+    param session: SQLAlchemy session
+    param path: Snapshot directory, created if missing
+    param chunk_size: Number of rows fetched per round trip
+    return: Manifest dictionary
+    """
+    if np is None:
+        raise ImportError("export_snapshot requires numpy")
+    os.makedirs(path, exist_ok=True)
+    for name in SALE_COLUMNS.keys() | COMMISSION_COLUMNS.keys() | LISTING_COLUMNS.keys():
+        open(_column_file(path, name), "wb").close()
+    manifest = {"max_sale_id": 0, "columns": {**SALE_COLUMNS, **COMMISSION_COLUMNS, **LISTING_COLUMNS, **INDEX_COLUMNS}, "rows": {}}
+    return _append_snapshot(session, path, manifest, chunk_size)
+
+def refresh_snapshot(session, path, chunk_size=CHUNK_SIZE):
+    """
+    Append the sales with a sale_id above the snapshot watermark, their commissions and
+    any new listings to a snapshot.
+
+    Sales, commissions and listings already covered by the snapshot are not read again,
+    so changes to them are only picked up by a new export_snapshot.
+
+    param session: SQLAlchemy session
+    param path: Snapshot directory
+    param chunk_size: Number of rows fetched per round trip
+    return: Manifest dictionary
+    """
+    if np is None:
+        raise ImportError("refresh_snapshot requires numpy")
+    return _append_snapshot(session, path, _read_manifest(path), chunk_size)
+
+def _append_snapshot(session, path, manifest, chunk_size):
+    """
+    Append everything above the watermark of a manifest to the snapshot files.
+
+    param session: SQLAlchemy session
+    param path: Snapshot directory
+    param manifest: Current manifest
+    param chunk_size: Number of rows fetched per round trip
+    return: Updated manifest dictionary
+    """
+    connection = session.connection()
+    watermark = manifest["max_sale_id"]
+    max_sale_id = connection.execute(select(func.max(Sale.sale_id))).scalar() or 0
+    _append_query(connection, _sales_query(watermark, max_sale_id), path, SALE_COLUMNS, chunk_size)
+    _append_query(connection, _commissions_query(watermark, max_sale_id), path, COMMISSION_COLUMNS, chunk_size)
+
+    # Listings are dense by listing_id, so new listings extend the arrays
+    old_size = os.path.getsize(_column_file(path, "listing_office")) // 8
+    max_listing_id = max(
+        connection.execute(select(func.max(Listing.listing_id))).scalar() or 0,
+        connection.execute(select(func.max(Sale.listing_id)).where(Sale.sale_id <= max_sale_id)).scalar() or 0,
+    )
+    size = max(old_size, max_listing_id + 1)
+    if size > old_size:
+        with open(_column_file(path, "listing_office"), "ab") as file:
+            np.full(size - old_size, -1, dtype="<i8").tofile(file)
+        with open(_column_file(path, "listing_day"), "ab") as file:
+            np.full(size - old_size, MISSING_DAY, dtype="<i4").tofile(file)
+        listing_office = np.memmap(_column_file(path, "listing_office"), dtype="<i8", mode="r+")
+        listing_day = np.memmap(_column_file(path, "listing_day"), dtype="<i4", mode="r+")
+        for listing_id, office_id, day in _iter_chunks(connection, _listings_query(old_size), ("<i8", "<i8", "<i4"), chunk_size):
+            listing_office[listing_id] = office_id
+            listing_day[listing_id] = day
+        listing_office.flush()
+        listing_day.flush()
+        del listing_office, listing_day
+
+    # Only the appended sales are sorted, then merged into the month index of the others
+    indexed = manifest["rows"].get("sale_day", 0)
+    month_order = np.fromfile(_column_file(path, "month_order"), dtype="<i8", count=indexed) if indexed else np.empty(0, dtype="<i8")
+    sorted_month = np.fromfile(_column_file(path, "sorted_month"), dtype="<i4", count=indexed) if indexed else np.empty(0, dtype="<i4")
+    new_sale_day = np.fromfile(_column_file(path, "sale_day"), dtype="<i4", offset=indexed * 4)
+    month_order, sorted_month = _merge_month_index(month_order, sorted_month, new_sale_day, indexed)
+    month_order.astype("<i8").tofile(_column_file(path, "month_order"))
+    sorted_month.astype("<i4").tofile(_column_file(path, "sorted_month"))
+
+    manifest["max_sale_id"] = max(watermark, max_sale_id)
+    manifest["offices"] = {str(office_id): list(office) for office_id, office in _load_offices(connection).items()}
+    manifest["agents"] = sorted(_load_agents(connection))
+    manifest["rows"] = {
+        name: os.path.getsize(_column_file(path, name)) // np.dtype(dtype).itemsize
+        for name, dtype in manifest["columns"].items()
+    }
+    temporary = os.path.join(path, MANIFEST + ".tmp")
+    with open(temporary, "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temporary, os.path.join(path, MANIFEST))
+    return manifest
+
+def _sales_query(after_sale_id, max_sale_id=None):
+    """
+    Build the query of the sale columns above a watermark, in sale_id order.
+
+    param after_sale_id: Only sales with a greater sale_id are selected
+    param max_sale_id: Only sales up to this sale_id are selected
+    return: Select statement
+    """
+    query = (
+        select(Sale.sale_id, func.coalesce(Sale.listing_id, -1), func.coalesce(Sale.agent_id, -1), Sale.sale_price, days_since_epoch(Sale.date_of_sale))
+        .where(Sale.date_of_sale.is_not(None), Sale.sale_id > after_sale_id)
+        .order_by(Sale.sale_id)
+    )
+    return query if max_sale_id is None else query.where(Sale.sale_id <= max_sale_id)
+
+def _commissions_query(after_sale_id, max_sale_id=None):
+    """
+    Build the query of the commission columns of the sales above a watermark.
+
+    param after_sale_id: Only commissions of sales with a greater sale_id are selected
+    param max_sale_id: Only commissions of sales up to this sale_id are selected
+    return: Select statement
+    """
+    query = (
+        select(Commission.sale_id, func.coalesce(Commission.agent_id, -1), Commission.commission_amount, days_since_epoch(Sale.date_of_sale))
+        .join(Sale, Sale.sale_id == Commission.sale_id)
+        .where(Sale.date_of_sale.is_not(None), Sale.sale_id > after_sale_id)
+        .order_by(Commission.sale_id)
+    )
+    return query if max_sale_id is None else query.where(Sale.sale_id <= max_sale_id)
+
+def _listings_query(from_listing_id):
+    """
+    Build the query of the listing columns from a listing_id on.
+
+    param from_listing_id: Only listings with this or a greater listing_id are selected
+    return: Select statement
+    """
+    return (
+        select(Listing.listing_id, func.coalesce(Listing.office_id, -1), func.coalesce(days_since_epoch(Listing.date_of_listing), int(MISSING_DAY)))
+        .where(Listing.listing_id >= from_listing_id)
+    )
+
+def _load_offices(connection):
+    """
+    Load the city and state of every office.
+
+    param connection: SQLAlchemy connection
+    return: Dictionary of (city, state) by office_id
+    """
+    return {office_id: (city, state) for office_id, city, state in connection.execute(select(Office.office_id, Office.city, Office.state))}
+
+def _load_agents(connection):
+    """
+    Load the id of every agent.
+
+    param connection: SQLAlchemy connection
+    return: Set of agent ids
+    """
+    return set(connection.execute(select(EstateAgent.agent_id)).scalars())
+
+def _column_file(path, name):
+    """
+    Get the file of a snapshot column.
+
+    param path: Snapshot directory
+    param name: Column name
+    return: File path
+    """
+    return os.path.join(path, name + ".bin")
+
+def _read_manifest(path):
+    """
+    Read the manifest of a snapshot.
+
+    param path: Snapshot directory
+    return: Manifest dictionary
+    """
+    with open(os.path.join(path, MANIFEST)) as file:
+        return json.load(file)
+
+def _memmap(path, name, dtype, manifest):
+    """
+    Memory-map a snapshot column read-only.
+
+    param path: Snapshot directory
+    param name: Column name
+    param dtype: Column dtype
+    param manifest: Manifest dictionary
+    return: ndarray
+    """
+    rows = manifest["rows"][name]
+    if rows == 0:
+        # np.memmap cannot map an empty file
+        return np.empty(0, dtype=dtype)
+    return np.memmap(_column_file(path, name), dtype=dtype, mode="r", shape=(rows,))
+
+def _append_query(connection, query, path, columns, chunk_size):
+    """
+    Stream a query into the snapshot files of its columns.
+
+    param connection: SQLAlchemy connection
+    param query: Select statement
+    param path: Snapshot directory
+    param columns: Dictionary of dtype by column name, in query order
+    param chunk_size: Number of rows fetched per round trip
+    return: None
+    """
+    files = [open(_column_file(path, name), "ab") for name in columns]
+    try:
+        for arrays in _iter_chunks(connection, query, columns.values(), chunk_size):
+            for file, array in zip(files, arrays):
+                array.tofile(file)
+    finally:
+        for file in files:
+            file.close()
+
+def _month_index(sale_day):
+    """
+    Sort the sales by month of sale.
+
+    param sale_day: ndarray of sale days since 1970-01-01
+    return: Tuple of (sale positions sorted by month, month of every sorted position)
+    """
+    months = _months(sale_day)
+    month_order = np.argsort(months, kind="stable")
+    return month_order, months[month_order].astype(np.int32)
+
+def _merge_month_index(month_order, sorted_month, sale_day, first):
+    """
+    Merge appended sales into a month index, sorting only the appended ones.
+
+    Appended sales come after every indexed sale of the same month, which keeps the index
+    in the order _month_index gives, at O(new log new) plus one copy of the index.
+
+    param month_order: Sale positions sorted by month of the indexed sales
+    param sorted_month: Month of every entry of month_order
+    param sale_day: ndarray of sale days of the appended sales
+    param first: Position of the first appended sale
+    return: Tuple of (sale positions sorted by month, month of every sorted position)
+    """
+    new_order, new_months = _month_index(sale_day)
+    positions = np.searchsorted(sorted_month, new_months, side="right")
+    return np.insert(month_order, positions, new_order + first), np.insert(sorted_month, positions, new_months)
+
+def _months(days):
+    """
+    Convert days since 1970-01-01 to months since January 1970.
+
+    param days: ndarray of days
+    return: ndarray of months
+    """
+    return np.asarray(days).astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+
+def _iter_chunks(connection, query, dtypes, chunk_size):
+    """
+    Fetch a query with fetchmany and yield one NumPy array per column for every chunk.
+
+    Integer columns must not contain NULL; NULL in float columns becomes NaN.
+
+    param connection: SQLAlchemy connection
+    param query: Select statement
+    param dtypes: NumPy dtype of every column
+    param chunk_size: Number of rows fetched per round trip
+    return: Generator of lists of ndarrays
+    """
+    # The DB-API cursor skips building a Row object per row
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(str(query.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [np.array(column, dtype=dtype) for column, dtype in zip(zip(*rows), dtypes)]
+    finally:
+        cursor.close()
+
+def _fetch_columns(connection, query, dtypes, chunk_size):
+    """
+    Fetch a query into one NumPy array per column.
+
+    param connection: SQLAlchemy connection
+    param query: Select statement
+    param dtypes: NumPy dtype of every column
+    param chunk_size: Number of rows fetched per round trip
+    return: List of ndarrays
+    """
+    dtypes = list(dtypes)
+    chunks = [[] for _ in dtypes]
+    for arrays in _iter_chunks(connection, query, dtypes, chunk_size):
+        for chunk, array in zip(chunks, arrays):
+            chunk.append(array)
+    return [np.concatenate(chunk) if chunk else np.empty(0, dtype=dtype) for chunk, dtype in zip(chunks, dtypes)]
+
+def _top(counts, descending_ids=False):
+    """
+    Get the ids with a non-zero count, highest count first.
+
+    param counts: ndarray of counts by id
+    param descending_ids: Order ties by descending id instead of ascending id
+    return: List of ids
+    """
+    ids = np.nonzero(counts)[0]
+    order = np.lexsort((-ids if descending_ids else ids, -counts[ids]))
+    return [int(i) for i in ids[order]]
+
+def _monthly_means(months, values):
+    """
+    Group values by month and average them.
+
+    param months: ndarray of months since January 1970
+    param values: ndarray of values
+    return: Dictionary of mean by (year, month)
+    """
+    if not len(months):
+        return {}
+    first = months.min()
+    sums = np.bincount(months - first, weights=values)
+    counts = np.bincount(months - first)
+    return {
+        (1970 + int(month) // 12, int(month) % 12 + 1): float(sums[month - first] / counts[month - first])
+        for month in np.nonzero(counts)[0] + first
+    }
+
+def benchmark(sizes, directory=None):
+    """
+    Compare the SQL reports with the columnar engine on synthetic databases.
+
+    For every size the SQL path runs the four monthly reports for one month, while the
+    columnar path is timed for loading once and for answering the same month.
+
+    param sizes: Numbers of sales to benchmark
+    param directory: Directory for the benchmark databases, defaults to a temporary one
+    return: List of result dictionaries
+    """
+    results = []
+    reports = (get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price)
+    with tempfile.TemporaryDirectory(dir=directory) as workdir:
+        for size in sizes:
+            engine = create_sqlite_engine("sqlite:///" + os.path.join(workdir, f"analytics_{size}.db"))
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            generate_dataset(session, size, sold_ratio=1.0)
+            year, month = BENCHMARK_MONTH
+
+            start = time.perf_counter()
+            expected = [report(session, year, month) for report in reports]
+            sql_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            columns = SalesColumns.load(session)
+            load_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            answers = [
+                columns.get_top_offices(year, month),
+                columns.get_top_agents(year, month),
+                columns.get_average_days_on_market(year, month),
+                columns.get_average_selling_price(year, month),
+            ]
+            numpy_seconds = time.perf_counter() - start
+
+            matches = (
+                answers[0] == [tuple(row) for row in expected[0]]
+                and answers[1] == [(agent.agent_id, count) for agent, count in expected[1]]
+                and np.isclose(answers[2], expected[2]) and np.isclose(answers[3], expected[3])
+            )
+            results.append({"sales": size, "sql": sql_seconds, "numpy_load": load_seconds, "numpy": numpy_seconds, "matches": bool(matches)})
+            print("{:>12,} sales  SQL {:>8.3f} s  NumPy load {:>8.3f} s  NumPy month {:>8.4f} s  same answers: {}".format(
+                size, sql_seconds, load_seconds, numpy_seconds, bool(matches)))
+            session.close()
+            engine.dispose()
+    return results
+
+def main():
+    """
+    Run the columnar analytics benchmark or write a columnar snapshot of realestate.db.
+    """
+    parser = argparse.ArgumentParser(description="NumPy analytics engine.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("benchmark", help="benchmark the NumPy engine against the SQL reports")
+    bench.add_argument("--sizes", type=int, nargs="+", default=[1000000, 10000000, 50000000], help="numbers of sales")
+    bench.add_argument("--directory", help="directory for the benchmark databases")
+    export = commands.add_parser("export", help="write a columnar snapshot")
+    export.add_argument("path", help="snapshot directory")
+    refresh = commands.add_parser("refresh", help="append new sales to a columnar snapshot")
+    refresh.add_argument("path", help="snapshot directory")
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args.sizes, args.directory)
+        return
+    engine = create_sqlite_engine()
+    session = sessionmaker(bind=engine)()
+    if args.command == "export":
+        manifest = export_snapshot(session, args.path)
+    else:
+        manifest = refresh_snapshot(session, args.path)
+    print(f"Snapshot {args.path} covers {manifest['rows']['sale_id']:,} sales up to sale_id {manifest['max_sale_id']}")
+
+if __name__ == "__main__":
+    main()
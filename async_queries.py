@@ -0,0 +1,185 @@
+"""
+Async versions of the monthly reports of queries.py, for request handlers running on an event loop.
+
+Every report runs the synchronous query of queries.py through AsyncSession.run_sync(), so
+the SQL is the same and only the waiting moves off the event loop. aiosqlite runs each
+connection in its own thread, which only pays off with several CPU cores.
+Requires aiosqlite and greenlet (requirements-optional.txt).
+"""
+import argparse
+import asyncio
+import time
+from collections import namedtuple
+from datetime import date
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+import queries
+from database import ASYNC_DATABASE_URL, DATABASE_URL, create_async_sqlite_engine, create_sqlite_engine
+
+Dashboard = namedtuple("Dashboard", ["top_offices", "top_agents", "average_days_on_market", "average_selling_price"])
+
+# Session factory of get_monthly_dashboard() when none is passed
+_default_session_factory = None
+
+async def get_top_offices(session, year, month):
+    """
+    Get the top 5 offices by number of sales in a given month and year.
+
+    param session: SQLAlchemy AsyncSession
+    param year: Year
+    param month: Month
+    return: List of top 5 offices
+    """
+    return await session.run_sync(queries.get_top_offices, year, month)
+
+async def get_top_agents(session, year, month):
+    """
+    Get the top 5 estate agents by number of sales in a given month and year.
+
+    param session: SQLAlchemy AsyncSession
+    param year: Year
+    param month: Month
+    return: List of top 5 estate agents
+    """
+    return await session.run_sync(queries.get_top_agents, year, month)
+
+async def get_average_days_on_market(session, year, month):
+    """
+    Get the average number of days a listing is on the market before it is sold in a given month and year.
+
+    param session: SQLAlchemy AsyncSession
+    param year: Year
+    param month: Month
+    return: Average number of days on market
+    """
+    return await session.run_sync(queries.get_average_days_on_market, year, month)
+
+async def get_average_selling_price(session, year, month):
+    """
+    Get the average selling price of a home in a given month and year.
+
+    param session: SQLAlchemy AsyncSession
+    param year: Year
+    param month: Month
+    return: Average selling price
+    """
+    return await session.run_sync(queries.get_average_selling_price, year, month)
+
+async def insert_monthly_commissions(session, year, month):
+    """
+    Calculate the total commission for each estate agent in a given month and year and store it.
+
+    param session: SQLAlchemy AsyncSession
+    param year: Year
+    param month: Month
+    return: List of (agent_id, total_commission) tuples
+    """
+    return await session.run_sync(queries.insert_monthly_commissions, year, month)
+
+def default_session_factory():
+    """
+    Get the async session factory of realestate.db, creating its engine on first use.
+
+    return: async_sessionmaker
+    """
+    global _default_session_factory
+    if _default_session_factory is None:
+        _default_session_factory = async_sessionmaker(create_async_sqlite_engine(), expire_on_commit=False)
+    return _default_session_factory
+
+async def close_default_session_factory():
+    """
+    Dispose of the engine of the default session factory. aiosqlite runs every pooled
+    connection in a non-daemon thread, so the interpreter only exits once it is closed.
+
+    return: None
+    """
+    global _default_session_factory
+    if _default_session_factory is not None:
+        await _default_session_factory.kw["bind"].dispose()
+        _default_session_factory = None
+
+async def get_monthly_dashboard(year, month, session_factory=None):
+    """
+    Run the four monthly read reports concurrently, each on its own pooled connection.
+
+    param year: Year
+    param month: Month
+    param session_factory: async_sessionmaker, defaults to the one of realestate.db
+    return: Dashboard
+    """
+    session_factory = session_factory or default_session_factory()
+
+    async def run(report):
+        async with session_factory() as session:
+            return await report(session, year, month)
+
+    return Dashboard(*await asyncio.gather(
+        run(get_top_offices), run(get_top_agents), run(get_average_days_on_market), run(get_average_selling_price)
+    ))
+
+def load_test(requests=200, concurrency=8, url=DATABASE_URL, async_url=ASYNC_DATABASE_URL, year=None, month=None):
+    """
+    Compare dashboard requests per second of the sync reports and get_monthly_dashboard().
+
+    The sync path serves the requests one after the other as a blocking worker does, the
+    async path keeps concurrency dashboards in flight on one event loop.
+
+    param requests: Number of dashboard requests per path
+    param concurrency: Number of concurrent async requests
+    param url: Database URL of the sync engine
+    param async_url: Database URL of the async engine
+    param year: Year of the dashboard, defaults to the current one
+    param month: Month of the dashboard, defaults to the current one
+    return: Dictionary of requests/second by path
+    """
+    year = year or date.today().year
+    month = month or date.today().month
+    reports = (queries.get_top_offices, queries.get_top_agents, queries.get_average_days_on_market, queries.get_average_selling_price)
+
+    engine = create_sqlite_engine(url)
+    Session = sessionmaker(bind=engine)
+    start = time.perf_counter()
+    for _ in range(requests):
+        with Session() as session:
+            Dashboard(*[report(session, year, month) for report in reports])
+    sync_seconds = time.perf_counter() - start
+    engine.dispose()
+
+    async def run_async():
+        async_engine = create_async_sqlite_engine(async_url, pool_size=concurrency * 4)
+        session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def request():
+            async with semaphore:
+                await get_monthly_dashboard(year, month, session_factory)
+
+        await get_monthly_dashboard(year, month, session_factory)  # open the pool before timing
+        start = time.perf_counter()
+        await asyncio.gather(*[request() for _ in range(requests)])
+        seconds = time.perf_counter() - start
+        await async_engine.dispose()
+        return seconds
+
+    async_seconds = asyncio.run(run_async())
+    results = {"sync": requests / sync_seconds, "async": requests / async_seconds}
+    print("sync  {:>8.1f} requests/s".format(results["sync"]))
+    print("async {:>8.1f} requests/s ({} concurrent)".format(results["async"], concurrency))
+    return results
+
+def main():
+    """
+    Run the dashboard load test against realestate.db.
+    """
+    parser = argparse.ArgumentParser(description="Load test the async dashboard against the sync reports.")
+    parser.add_argument("--requests", type=int, default=200, help="dashboard requests per path")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent async requests")
+    parser.add_argument("--year", type=int, help="dashboard year")
+    parser.add_argument("--month", type=int, help="dashboard month")
+    args = parser.parse_args()
+    load_test(args.requests, args.concurrency, year=args.year, month=args.month)
+
+if __name__ == "__main__":
+    main()
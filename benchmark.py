@@ -0,0 +1,488 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import sqlalchemy
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session, sessionmaker
+
+import insert as generators
+import queries
+from create import Base, Office, EstateAgent, AgentOffice, Seller, Listing, Buyer, Sale, Commission
+from database import create_sqlite_engine
+
+# Number of rows written per transaction while generating a dataset
+BATCH_SIZE = 100000
+
+# Listings are dated within three years from this day, so datasets do not depend on the run date
+DATASET_START = date(2021, 1, 1)
+
+# Month every monthly report is run for, and the range of the range reports
+BENCHMARK_MONTH = (2022, 6)
+BENCHMARK_RANGE = ((2022, 1), (2022, 12))
+
+# Relative slowdown above which compare() reports a regression
+THRESHOLD = 0.2
+
+# Covering report indexes of create.py and the single-column index each one replaced,
+# as (index name, table, column), rebuilt by plans() for the "before" side
+REPORT_INDEXES = {
+    "ix_sales_date_listing_agent_price": ("ix_sales_date_of_sale", "sales", "date_of_sale"),
+    "ix_commissions_sale_agent_amount": ("ix_commissions_sale_id", "commissions", "sale_id"),
+}
+
+def generate_dataset(session, num_listings, num_offices=1000, num_agents=5000, sold_ratio=0.6, seed=0, batch_size=BATCH_SIZE):
+    """
+    Fill an empty database with a deterministic random dataset without Faker.
+
+    Every table of the schema is filled: offices, agents and their offices, one seller per
+    listing, and one buyer, sale and commission per sold listing. The same arguments
+    always produce the same rows.
+
+    param session: SQLAlchemy session
+    param num_listings: Number of listings
+    param num_offices: Number of offices
+    param num_agents: Number of agents
+    param sold_ratio: Share of the listings that are sold
+    param seed: Random seed
+    param batch_size: Number of listings per transaction
+    return: Number of sales
+    """
+    rng = random.Random(seed)
+    session.execute(insert(Office), [
+        {"office_id": i, "address": f"{i} Main St", "city": f"City {i}", "state": "ST", "zip_code": f"{i:05d}"}
+        for i in range(1, num_offices + 1)
+    ])
+    session.execute(insert(EstateAgent), [
+        {"agent_id": i, "first_name": f"First{i}", "last_name": f"Last{i}", "email": f"agent{i}@example.com", "phone": f"agent-{i}"}
+        for i in range(1, num_agents + 1)
+    ])
+    session.execute(insert(AgentOffice), [
+        {"agent_office_id": i, "agent_id": i, "office_id": rng.randint(1, num_offices)}
+        for i in range(1, num_agents + 1)
+    ])
+    session.commit()
+    sale_id = 0
+    for first in range(1, num_listings + 1, batch_size):
+        sellers, listings, buyers, sales, commissions = [], [], [], [], []
+        for i in range(first, min(first + batch_size, num_listings + 1)):
+            listing_price = rng.uniform(50000, 2000000)
+            date_of_listing = DATASET_START + timedelta(days=rng.randrange(3 * 365 - 180))
+            agent_id = rng.randint(1, num_agents)
+            sold = rng.random() < sold_ratio
+            sellers.append({"seller_id": i, "name": f"Seller {i}", "email": f"seller{i}@example.com", "phone": f"seller-{i}"})
+            listings.append({
+                "listing_id": i, "seller_id": i, "bedrooms": rng.randint(1, 5), "bathrooms": rng.randint(1, 4),
+                "listing_price": listing_price, "zip_code": f"{rng.randrange(1000):05d}", "date_of_listing": date_of_listing,
+                "agent_id": agent_id, "office_id": rng.randint(1, num_offices), "status": "sold" if sold else "listed",
+            })
+            if not sold:
+                continue
+            sale_id += 1
+            sale_price = rng.uniform(listing_price * 0.9, listing_price * 1.1)
+            date_of_sale = date_of_listing + timedelta(days=rng.randint(30, 180))
+            buyers.append({"buyer_id": sale_id, "name": f"Buyer {sale_id}", "email": f"buyer{sale_id}@example.com", "phone": f"buyer-{sale_id}"})
+            sales.append({
+                "sale_id": sale_id, "listing_id": i, "buyer_id": sale_id, "sale_price": sale_price,
+                "date_of_sale": date_of_sale, "agent_id": agent_id,
+            })
+            commissions.append({
+                "commission_id": sale_id, "agent_id": agent_id, "sale_id": sale_id,
+                "commission_amount": sale_price * generators.get_commission_rate(sale_price), "commission_date": date_of_sale,
+            })
+        for model, rows in ((Seller, sellers), (Listing, listings), (Buyer, buyers), (Sale, sales), (Commission, commissions)):
+            if rows:
+                session.execute(insert(model), rows)
+        session.commit()
+    return sale_id
+
+def open_dataset(directory, num_listings, seed=0):
+    """
+    Open the dataset of a size, generating it on first use.
+
+    Datasets are kept as dataset_<listings>_<seed>.db in the directory, so later runs and
+    comparisons time the same rows.
+
+    param directory: Dataset directory
+    param num_listings: Number of listings
+    param seed: Random seed
+    return: SQLAlchemy engine
+    """
+    path = os.path.join(directory, f"dataset_{num_listings}_{seed}.db")
+    exists = os.path.exists(path)
+    engine = create_sqlite_engine("sqlite:///" + path)
+    if not exists:
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        try:
+            generate_dataset(session, num_listings, seed=seed)
+        except BaseException:
+            session.close()
+            engine.dispose()
+            os.remove(path)
+            raise
+        session.close()
+    return engine
+
+def query_cases():
+    """
+    Get the benchmark cases of the queries.py functions, run against a generated dataset.
+
+    return: List of (name, function taking a session) pairs
+    """
+    year, month = BENCHMARK_MONTH
+    start, end = BENCHMARK_RANGE
+
+    def deep_search_page(session):
+        page = queries.search_listings(session, status="listed", limit=50)
+        for _ in range(20):
+            if page.next_key is None:
+                break
+            page = queries.search_listings(session, after=page.next_key, status="listed", limit=50)
+
+    return [
+        ("get_top_offices", lambda session: queries.get_top_offices(session, year, month)),
+        ("get_top_agents", lambda session: queries.get_top_agents(session, year, month)),
+        ("get_average_days_on_market", lambda session: queries.get_average_days_on_market(session, year, month)),
+        ("get_average_selling_price", lambda session: queries.get_average_selling_price(session, year, month)),
+        ("insert_monthly_commissions", lambda session: queries.insert_monthly_commissions(session, year, month)),
+        ("MonthlyReport.run", lambda session: queries.MonthlyReport(session, year, month).run()),
+        ("get_top_offices_by_month", lambda session: queries.get_top_offices_by_month(session, start, end)),
+        ("get_top_agents_by_month", lambda session: queries.get_top_agents_by_month(session, start, end)),
+        ("get_average_days_on_market_by_month", lambda session: queries.get_average_days_on_market_by_month(session, start, end)),
+        ("get_average_selling_price_by_month", lambda session: queries.get_average_selling_price_by_month(session, start, end)),
+        ("insert_monthly_commissions_range", lambda session: queries.insert_monthly_commissions_range(session, start, end)),
+        ("print_monthly_commissions", lambda session: queries.print_monthly_commissions(
+            session, queries.insert_monthly_commissions(session, year, month), file=io.StringIO())),
+        ("search_listings", lambda session: queries.search_listings(session, zip_code="00042", min_bedrooms=3, limit=50)),
+        ("search_listings_20_pages", deep_search_page),
+        ("iter_listings_entities", lambda session: list(queries.iter_listings(session, status="listed"))),
+        ("iter_listings_records", lambda session: list(queries.iter_listings(session, status="listed", records=True))),
+        ("recompute_commissions", lambda session: generators.recompute_commissions(session)),
+    ]
+
+def insert_cases(num_listings, workers=2):
+    """
+    Get the benchmark cases of the insert.py generators, each run on a fresh database.
+
+    Every case seeds the offices and agents first and only times the generator.
+
+    param num_listings: Number of listings per run
+    param workers: Number of worker processes of the parallel generator
+    return: List of (name, setup function, timed function) tuples, both taking a session
+    """
+    def agents_and_offices(session):
+        generate_dataset(session, 0, num_offices=100, num_agents=50)
+        return [agent_id for agent_id, in session.query(EstateAgent.agent_id)], [office_id for office_id, in session.query(Office.office_id)]
+
+    def listings_only(session):
+        agents, offices = agents_and_offices(session)
+        generators.generate_listings_and_sellers_batched(session, num_listings, agents=agents, offices=offices)
+
+    return [
+        ("generate_listings_and_sellers", agents_and_offices,
+         lambda session, state: generators.generate_listings_and_sellers(session, num_listings, agents=state[0], offices=state[1])),
+        ("generate_listings_and_sellers_batched", agents_and_offices,
+         lambda session, state: generators.generate_listings_and_sellers_batched(session, num_listings, agents=state[0], offices=state[1])),
+        ("generate_sales_and_commissions", listings_only,
+         lambda session, state: generators.generate_sales_and_commissions(session)),
+        ("generate_sales_and_commissions_batched", listings_only,
+         lambda session, state: generators.generate_sales_and_commissions_batched(session)),
+        ("generate_parallel", agents_and_offices,
+         lambda session, state: generators.generate_parallel(session, num_listings, agents=state[0], offices=state[1], workers=workers)),
+    ]
+
+@contextmanager
+def rolled_back_session(engine):
+    """
+    Open a session whose commits are undone, so the cases that write leave a cached dataset as it was generated.
+
+    The session joins a transaction of its own connection and turns its commits into
+    savepoints. pysqlite does not begin a transaction before a SAVEPOINT, so releasing the
+    savepoint would commit; BEGIN is emitted explicitly instead.
+
+    param engine: SQLAlchemy engine
+    return: Context manager of (session, function rolling back everything written since the last call)
+    """
+    connection = engine.connect()
+    event.listen(connection, "begin", lambda conn: conn.exec_driver_sql("BEGIN"))
+    transactions = [connection.begin()]
+    session = Session(bind=connection, join_transaction_mode="create_savepoint")
+
+    def rollback():
+        session.rollback()
+        transactions[0].rollback()
+        transactions[0] = connection.begin()
+
+    try:
+        yield session, rollback
+    finally:
+        session.close()
+        transactions[0].rollback()
+        connection.close()
+
+def measure(function, repeat, reset=None):
+    """
+    Time a function and measure its peak memory.
+
+    The timed runs are not traced, since tracemalloc slows Python code down; one extra
+    traced run gives the peak of memory allocated by the function.
+
+    param function: Function without arguments
+    param repeat: Number of timed runs
+    param reset: Function without arguments called after every run, outside the timing, None for nothing
+    return: Dictionary of the median and best seconds and the peak bytes
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+        if reset is not None:
+            reset()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        if reset is not None:
+            reset()
+    return {"seconds": statistics.median(seconds), "best": min(seconds), "peak_bytes": peak}
+
+def run(sizes, directory, repeat=5, insert_listings=1000, only=None, output=None):
+    """
+    Run every benchmark case and optionally write the results to a JSON file.
+
+    param sizes: Numbers of listings of the query datasets
+    param directory: Directory keeping the generated datasets
+    param repeat: Number of timed runs per case
+    param insert_listings: Number of listings per insert generator run
+    param only: Only run the cases whose name contains this text
+    param output: JSON results file
+    return: Results dictionary
+    """
+    os.makedirs(directory, exist_ok=True)
+    results = []
+
+    def record(name, size, measured):
+        results.append(dict(name=name, size=size, **measured))
+        print("{:<40} {:>10,} {:>10.4f} s {:>10.4f} s {:>10.1f} MB".format(
+            name, size, measured["seconds"], measured["best"], measured["peak_bytes"] / 1e6))
+
+    print("{:<40} {:>10} {:>12} {:>12} {:>13}".format("case", "size", "median", "best", "peak memory"))
+    for size in sizes:
+        engine = open_dataset(directory, size)
+        # insert_monthly_commissions and recompute_commissions commit, so every run is rolled back
+        with rolled_back_session(engine) as (session, rollback):
+            for name, function in query_cases():
+                if only is None or only in name:
+                    record(name, size, measure(lambda: function(session), repeat, rollback))
+        engine.dispose()
+
+    for name, setup, function in insert_cases(insert_listings):
+        if only is not None and only not in name:
+            continue
+        runs = []
+        # Every run needs an empty database, so setup happens outside the timed function
+        for traced in [False] * repeat + [True]:
+            with tempfile.TemporaryDirectory(dir=directory) as workdir:
+                engine = create_sqlite_engine("sqlite:///" + os.path.join(workdir, "insert.db"))
+                Base.metadata.create_all(engine)
+                session = sessionmaker(bind=engine)()
+                state = setup(session)
+                if traced:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                try:
+                    function(session, state)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    if traced:
+                        peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                    session.close()
+                    engine.dispose()
+                if not traced:
+                    runs.append(elapsed)
+        record(name, insert_listings, {"seconds": statistics.median(runs), "best": min(runs), "peak_bytes": peak})
+
+    document = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as file:
+            json.dump(document, file, indent=2)
+    return document
+
+def use_report_indexes(engine, covering=True):
+    """
+    Switch a database between the covering report indexes and the single-column indexes they replaced.
+
+    param engine: SQLAlchemy engine
+    param covering: Create the covering indexes if True, the replaced ones if False
+    return: None
+    """
+    with engine.begin() as connection:
+        for name, (replaced, table, column) in REPORT_INDEXES.items():
+            index = next(index for index in Base.metadata.tables[table].indexes if index.name == name)
+            if covering:
+                connection.exec_driver_sql(f"DROP INDEX IF EXISTS {replaced}")
+                index.create(connection, checkfirst=True)
+            else:
+                index.drop(connection, checkfirst=True)
+                connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {replaced} ON {table} ({column})")
+
+def explain(session, function):
+    """
+    Run a function and get the query plan of every statement it executed.
+
+    Statements without a plan, like the SAVEPOINT of a rolled back session, are left out.
+
+    param session: SQLAlchemy session
+    param function: Function taking the session
+    return: List of (statement, plan steps) pairs
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        function(session)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    connection = session.connection()
+    plans = [
+        (statement, [row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)])
+        for statement, parameters in statements
+    ]
+    return [(statement, plan) for statement, plan in plans if plan]
+
+def plans(num_listings, directory, repeat=5):
+    """
+    Print the query plan and timing of every report before and after the covering report indexes.
+
+    The dataset is switched to the single-column indexes the covering ones replaced, then
+    back, so both sides run on the same rows. The dataset is left with the covering indexes.
+
+    param num_listings: Number of listings of the dataset
+    param directory: Directory keeping the generated datasets
+    param repeat: Number of timed runs per report
+    return: Dictionary of {"before": ..., "after": ...} by report, each a dictionary of the median seconds and the plans
+    """
+    os.makedirs(directory, exist_ok=True)
+    engine = open_dataset(directory, num_listings)
+    # The monthly and range reports, the queries the report indexes are built for
+    cases = [(name, function) for name, function in query_cases() if name.startswith(("get_", "insert_monthly_commissions"))]
+    results = {name: {} for name, _ in cases}
+    try:
+        for side, covering in (("before", False), ("after", True)):
+            use_report_indexes(engine, covering)
+            with rolled_back_session(engine) as (session, rollback):
+                for name, function in cases:
+                    statements = explain(session, function)
+                    rollback()
+                    seconds = measure(lambda: function(session), repeat, rollback)["seconds"]
+                    results[name][side] = {"seconds": seconds, "plans": [plan for _, plan in statements]}
+    finally:
+        use_report_indexes(engine, True)
+        engine.dispose()
+
+    for name, sides in results.items():
+        print(f"{name} ({num_listings:,} listings)")
+        for side in ("before", "after"):
+            print("  {:<6} {:>10.1f} ms".format(side, sides[side]["seconds"] * 1000))
+            for plan in sides[side]["plans"]:
+                for step in plan:
+                    print("           " + step)
+        print("  change {:>+10.0%}".format(sides["after"]["seconds"] / sides["before"]["seconds"] - 1))
+    return results
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """
+    Compare two results files and flag the cases that got slower than the threshold.
+
+    param baseline: Baseline results dictionary
+    param current: Current results dictionary
+    param threshold: Relative slowdown of the median above which a case regressed
+    return: List of (name, size, baseline seconds, current seconds) of every regression
+    """
+    before = {(result["name"], result["size"]): result for result in baseline["results"]}
+    regressions = []
+    print("{:<40} {:>10} {:>12} {:>12} {:>8}".format("case", "size", "baseline", "current", "change"))
+    for result in current["results"]:
+        key = (result["name"], result["size"])
+        if key not in before:
+            print("{:<40} {:>10,} {:>12} {:>10.4f} s {:>8}".format(*key, "-", result["seconds"], "new"))
+            continue
+        old, new = before[key]["seconds"], result["seconds"]
+        change = new / old - 1 if old else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append((*key, old, new))
+            flag = "  REGRESSION"
+        print("{:<40} {:>10,} {:>10.4f} s {:>10.4f} s {:>+7.0%}{}".format(*key, old, new, change, flag))
+    return regressions
+
+def main():
+    """
+    Run the benchmark suite, print the report plans or compare two results files.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the queries and insert generators.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="numbers of listings of the query datasets")
+    run_parser.add_argument("--directory", default="benchmark_data", help="directory keeping the generated datasets")
+    run_parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    run_parser.add_argument("--insert-listings", type=int, default=1000, help="listings per insert generator run")
+    run_parser.add_argument("--only", help="only run the cases whose name contains this text")
+    run_parser.add_argument("--output", default="benchmark.json", help="JSON results file")
+    plans_parser = commands.add_parser("plans", help="print the report plans and timings before and after the covering indexes")
+    plans_parser.add_argument("--size", type=int, default=100000, help="number of listings of the dataset")
+    plans_parser.add_argument("--directory", default="benchmark_data", help="directory keeping the generated datasets")
+    plans_parser.add_argument("--repeat", type=int, default=5, help="timed runs per report")
+    compare_parser = commands.add_parser("compare", help="flag regressions between two results files")
+    compare_parser.add_argument("baseline", help="baseline JSON results file")
+    compare_parser.add_argument("current", help="current JSON results file")
+    compare_parser.add_argument("--threshold", type=float, default=THRESHOLD, help="relative slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args.sizes, args.directory, args.repeat, args.insert_listings, args.only, args.output)
+        return
+    if args.command == "plans":
+        plans(args.size, args.directory, args.repeat)
+        return
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    regressions = compare(baseline, current, args.threshold)
+    print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
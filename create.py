@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import declarative_base
 
@@ -104,6 +104,13 @@ class Listing(Base):
     office_id = Column(Integer, ForeignKey('offices.office_id'), index=True)
     status = Column(String, default='listed')
 
+    # Listing searches filter on zip code or status and page through listing_price order
+    __table_args__ = (
+        Index('ix_listings_zip_code_price', 'zip_code', 'listing_price', 'listing_id'),
+        Index('ix_listings_status_price', 'status', 'listing_price', 'listing_id'),
+        Index('ix_listings_price', 'listing_price', 'listing_id'),
+    )
+
 
 class Buyer(Base):
     """
@@ -140,9 +147,15 @@ class Sale(Base):
     listing_id = Column(Integer, ForeignKey('listings.listing_id'), index=True)
     buyer_id = Column(Integer, ForeignKey('buyers.buyer_id'))
     sale_price = Column(Float)
-    date_of_sale = Column(Date, index=True)
+    date_of_sale = Column(Date)
     agent_id = Column(Integer, ForeignKey('estate_agents.agent_id'), index=True)
 
+    # The monthly reports filter on a date_of_sale range and only read these columns, so
+    # they are answered from the index without visiting the table
+    __table_args__ = (
+        Index('ix_sales_date_listing_agent_price', 'date_of_sale', 'listing_id', 'agent_id', 'sale_price'),
+    )
+
 class Commission(Base):
     """
     Commission model
@@ -158,10 +171,15 @@ class Commission(Base):
 
     commission_id = Column(Integer, primary_key=True)
     agent_id = Column(Integer, ForeignKey('estate_agents.agent_id'), index=True)
-    sale_id = Column(Integer, ForeignKey('sales.sale_id'), index=True)
+    sale_id = Column(Integer, ForeignKey('sales.sale_id'))
     commission_amount = Column(Float)
     commission_date = Column(Date)
 
+    # Commission totals join on sale_id and sum commission_amount by agent_id from the index alone
+    __table_args__ = (
+        Index('ix_commissions_sale_agent_amount', 'sale_id', 'agent_id', 'commission_amount'),
+    )
+
 class MonthlyCommission(Base):
     """
     Monthly commission model
@@ -174,9 +192,86 @@ class MonthlyCommission(Base):
         total_commission (float): Total commission
     """
     __tablename__ = 'monthly_commission'
+    __table_args__ = (UniqueConstraint('agent_id', 'year', 'month', name='uq_monthly_commission_agent_month'),)
 
     monthly_commission_id = Column(Integer, primary_key=True)
     agent_id = Column(Integer, ForeignKey('estate_agents.agent_id'), index=True)
     year = Column(Integer, index=True)
     month = Column(Integer, index=True)
     total_commission = Column(Float)
+
+
+class AgentMonthlySales(Base):
+    """
+    Agent monthly sales rollup model, maintained incrementally by rollups.py
+    
+    Attributes:
+        year (int): Year of sale
+        month (int): Month of sale
+        agent_id (int): Foreign key to estate_agents.agent_id
+        sales_count (int): Number of sales
+        price_sum (float): Sum of sale prices
+        days_on_market_sum (int): Sum of days between listing and sale
+        days_on_market_count (int): Number of sales whose listing has a listing date
+        commission_sum (float): Sum of commission amounts
+        commission_count (int): Number of commissions
+    """
+    __tablename__ = 'agent_monthly_sales'
+
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    agent_id = Column(Integer, ForeignKey('estate_agents.agent_id'), primary_key=True)
+    sales_count = Column(Integer, nullable=False, default=0)
+    price_sum = Column(Float, nullable=False, default=0)
+    days_on_market_sum = Column(Integer, nullable=False, default=0)
+    days_on_market_count = Column(Integer, nullable=False, default=0)
+    commission_sum = Column(Float, nullable=False, default=0)
+    commission_count = Column(Integer, nullable=False, default=0)
+
+class OfficeMonthlySales(Base):
+    """
+    Office monthly sales rollup model, maintained incrementally by rollups.py
+    
+    Attributes:
+        year (int): Year of sale
+        month (int): Month of sale
+        office_id (int): Foreign key to offices.office_id
+        sales_count (int): Number of sales
+        price_sum (float): Sum of sale prices
+        days_on_market_sum (int): Sum of days between listing and sale
+        days_on_market_count (int): Number of sales whose listing has a listing date
+        commission_sum (float): Sum of commission amounts
+        commission_count (int): Number of commissions
+    """
+    __tablename__ = 'office_monthly_sales'
+
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    office_id = Column(Integer, ForeignKey('offices.office_id'), primary_key=True)
+    sales_count = Column(Integer, nullable=False, default=0)
+    price_sum = Column(Float, nullable=False, default=0)
+    days_on_market_sum = Column(Integer, nullable=False, default=0)
+    days_on_market_count = Column(Integer, nullable=False, default=0)
+    commission_sum = Column(Float, nullable=False, default=0)
+    commission_count = Column(Integer, nullable=False, default=0)
+
+class ImportCheckpoint(Base):
+    """
+    Import checkpoint model, maintained by importer.py
+    
+    Attributes:
+        path (str): Absolute path of the imported CSV file
+        feed (str): Feed of the file
+        size (int): Size of the file in bytes when its import started
+        rows (int): Number of data rows of the file already committed
+        first_id (int): Primary key of the first data row, data row n gets first_id + n
+        first_related_id (int): Primary key of the agent office or commission of the first data row
+    """
+    __tablename__ = 'import_checkpoints'
+
+    path = Column(String, primary_key=True)
+    feed = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    rows = Column(Integer, nullable=False, default=0)
+    first_id = Column(Integer, nullable=False)
+    first_related_id = Column(Integer)
@@ -0,0 +1,197 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import date
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from create import Base
+from instrumentation import profile_from_environment
+
+DATABASE_URL = "sqlite:///realestate.db"
+ASYNC_DATABASE_URL = "sqlite+aiosqlite:///realestate.db"
+
+# Applied to every new SQLite connection of a tuned engine
+PRAGMAS = {
+    "journal_mode": "WAL",        # readers do not block the writer and the writer does not block readers
+    "synchronous": "NORMAL",      # fsync at checkpoints instead of every commit, safe with WAL
+    "cache_size": -64000,         # 64 MB page cache per connection
+    "mmap_size": 268435456,       # read up to 256 MB of the file through mmap
+    "temp_store": "MEMORY",       # sorts and temporary indexes stay in memory
+}
+
+# Seconds a connection waits for a lock before raising "database is locked"
+BUSY_TIMEOUT = 30
+
+Engines = namedtuple("Engines", ["write", "read"])
+
+def create_sqlite_engine(url=DATABASE_URL, echo=False, pragmas=PRAGMAS, read_only=False, pool_size=5, max_overflow=10):
+    """
+    Create an SQLite engine with a connection pool and the tuning PRAGMAs.
+
+    param url: Database URL
+    param echo: Log every statement
+    param pragmas: PRAGMAs run on every new connection, None for SQLite defaults
+    param read_only: Make the connections reject writes with PRAGMA query_only
+    param pool_size: Number of connections kept open
+    param max_overflow: Number of extra connections opened under load
+    return: SQLAlchemy engine
+    """
+    options = {"echo": echo, "connect_args": {"timeout": BUSY_TIMEOUT, "check_same_thread": False}}
+    if ":memory:" not in url and url != "sqlite://":
+        # In-memory databases use a single shared connection that cannot be pooled
+        options.update(pool_size=pool_size, max_overflow=max_overflow)
+    engine = create_engine(url, **options)
+    pragmas = dict(pragmas or {})
+    if read_only:
+        pragmas["query_only"] = "ON"
+    _set_pragmas(engine, pragmas)
+    profile_from_environment(engine)
+    return engine
+
+def create_async_sqlite_engine(url=ASYNC_DATABASE_URL, echo=False, pragmas=PRAGMAS, pool_size=5, max_overflow=10):
+    """
+    Create an aiosqlite engine with a connection pool and the tuning PRAGMAs.
+
+    Every pooled connection runs its statements in its own thread, so concurrent tasks
+    read in parallel. aiosqlite must be installed.
+
+    param url: Database URL with the sqlite+aiosqlite driver
+    param echo: Log every statement
+    param pragmas: PRAGMAs run on every new connection, None for SQLite defaults
+    param pool_size: Number of connections kept open
+    param max_overflow: Number of extra connections opened under load
+    return: SQLAlchemy AsyncEngine
+    """
+    options = {"echo": echo, "connect_args": {"timeout": BUSY_TIMEOUT}}
+    if ":memory:" not in url and not url.endswith("://"):
+        # aiosqlite defaults to NullPool, which opens a connection and thread per checkout
+        options.update(poolclass=AsyncAdaptedQueuePool, pool_size=pool_size, max_overflow=max_overflow)
+    engine = create_async_engine(url, **options)
+    _set_pragmas(engine.sync_engine, dict(pragmas or {}))
+    profile_from_environment(engine.sync_engine)
+    return engine
+
+def create_engines(url=DATABASE_URL, echo=False, pragmas=PRAGMAS, read_pool_size=5):
+    """
+    Create separate write and read engines on one database.
+
+    SQLite allows one writer at a time, so the write engine has a single connection and
+    bulk loads queue up on it instead of fighting over the lock. The read engine is
+    read-only and, with WAL, reads a consistent snapshot while the writer commits, so
+    reports run at the same time as seeding.
+
+    param url: Database URL
+    param echo: Log every statement
+    param pragmas: PRAGMAs run on every new connection, None for SQLite defaults
+    param read_pool_size: Number of read connections kept open
+    return: Engines
+    """
+    return Engines(
+        write=create_sqlite_engine(url, echo=echo, pragmas=pragmas, pool_size=1, max_overflow=0),
+        read=create_sqlite_engine(url, echo=echo, pragmas=pragmas, read_only=True, pool_size=read_pool_size),
+    )
+
+def _set_pragmas(engine, pragmas):
+    """
+    Run PRAGMAs on every new connection of an engine.
+
+    param engine: SQLAlchemy engine
+    param pragmas: Dictionary of PRAGMA values by name
+    return: None
+    """
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+def benchmark(num_listings=2000, batch_size=500, directory=None):
+    """
+    Compare plain engines with the tuned write/read engines for seeding and for reports run during seeding.
+
+    For each profile a fresh database is seeded while a second thread runs the monthly
+    reports in a loop on its own engine. The seeding time, the number of reports and their
+    slowest latency are printed, as well as the reports that failed with a lock error.
+
+    param num_listings: Number of listings to seed
+    param batch_size: Number of rows per transaction
+    param directory: Directory for the benchmark databases, defaults to a temporary one
+    return: Dictionary of result dictionaries by profile
+    """
+    from insert import seed
+    from queries import get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price
+
+    reports = (get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price)
+    results = {}
+    with tempfile.TemporaryDirectory(dir=directory) as workdir:
+        for profile in ("default", "tuned"):
+            url = "sqlite:///" + os.path.join(workdir, f"{profile}.db")
+            if profile == "tuned":
+                engines = create_engines(url)
+            else:
+                # What the scripts used before: plain engines with SQLite defaults
+                engines = Engines(write=create_engine(url), read=create_engine(url))
+            Base.metadata.create_all(engines.write)
+            done = threading.Event()
+            latencies = []
+            errors = []
+
+            def run_reports():
+                session = sessionmaker(bind=engines.read)()
+                today = date.today()
+                while not done.is_set():
+                    start = time.perf_counter()
+                    try:
+                        for report in reports:
+                            report(session, today.year, today.month)
+                        latencies.append(time.perf_counter() - start)
+                    except OperationalError:
+                        errors.append(time.perf_counter() - start)
+                    session.rollback()
+                session.close()
+
+            reader = threading.Thread(target=run_reports)
+            reader.start()
+            session = sessionmaker(bind=engines.write)()
+            start = time.perf_counter()
+            try:
+                seed(session, num_listings, batch_size=batch_size)
+            finally:
+                seed_seconds = time.perf_counter() - start
+                done.set()
+                reader.join()
+                session.close()
+                engines.write.dispose()
+                engines.read.dispose()
+            results[profile] = {
+                "seed": seed_seconds, "reports": len(latencies), "locked": len(errors),
+                "max_latency": max(latencies + errors, default=0.0),
+            }
+            print("{:<8} seed {:>7.2f} s  reports {:>5}  locked {:>3}  slowest report {:>7.3f} s".format(
+                profile, seed_seconds, len(latencies), len(errors), results[profile]["max_latency"]))
+    return results
+
+def main():
+    """
+    Benchmark the SQLite tuning profile.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the SQLite engine profiles.")
+    parser.add_argument("--listings", type=int, default=2000, help="number of listings to seed")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows per transaction")
+    parser.add_argument("--directory", help="directory for the benchmark databases")
+    args = parser.parse_args()
+    benchmark(args.listings, args.batch_size, args.directory)
+
+if __name__ == "__main__":
+    main()
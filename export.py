@@ -0,0 +1,220 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import tempfile
+import time
+from collections import namedtuple
+from sqlalchemy import String, func, select, type_coerce
+from sqlalchemy.orm import sessionmaker
+
+from create import Office, EstateAgent, Listing, Sale, Commission
+from database import create_sqlite_engine
+from queries import month_window
+
+def _text(column):
+    """
+    Read a date column as the ISO string SQLite stores, skipping its conversion to a date and back.
+
+    param column: Date column
+    return: Labeled SQLAlchemy column expression
+    """
+    return type_coerce(column, String).label(column.name)
+
+def _cents(column):
+    """
+    Round an amount to cents in SQL, which also makes its text form short and fast to encode.
+
+    param column: Float column
+    return: Labeled SQLAlchemy column expression
+    """
+    return func.round(column, 2).label(column.name)
+
+# Columns of an exported sale, in file order
+EXPORT_COLUMNS = (
+    Sale.sale_id, _text(Sale.date_of_sale), _cents(Sale.sale_price), Sale.buyer_id,
+    Listing.listing_id, _text(Listing.date_of_listing), _cents(Listing.listing_price), Listing.bedrooms, Listing.bathrooms, Listing.zip_code,
+    EstateAgent.agent_id, EstateAgent.first_name.label("agent_first_name"), EstateAgent.last_name.label("agent_last_name"),
+    Office.office_id, Office.city.label("office_city"), Office.state.label("office_state"),
+    Commission.commission_id, _cents(Commission.commission_amount),
+)
+
+EXPORT_FORMATS = ("csv", "ndjson")
+
+ExportReport = namedtuple("ExportReport", ["rows", "bytes", "seconds"])
+
+def export_query(start=None, end=None):
+    """
+    Build the query of the exported sales, joined with their listing, agent, listing office and commission.
+
+    Sales are ordered by date_of_sale, which SQLite reads in index order instead of sorting,
+    so the first rows are written before the last ones are read. Every join is an outer
+    join, so a sale whose listing, agent, office or commission is missing is still
+    exported, with empty columns for what is missing.
+
+    param start: First (year, month) exported, None for the first sale
+    param end: Last (year, month) exported, inclusive, None for the last sale
+    return: SQLAlchemy select
+    """
+    # A missing bound leaves that side of the range open
+    conditions = []
+    if start is not None:
+        conditions.append(Sale.date_of_sale >= month_window(*start)[0])
+    if end is not None:
+        conditions.append(Sale.date_of_sale < month_window(*end)[1])
+    return (
+        select(*EXPORT_COLUMNS)
+        .select_from(Sale)
+        .outerjoin(Listing, Listing.listing_id == Sale.listing_id)
+        .outerjoin(EstateAgent, EstateAgent.agent_id == Sale.agent_id)
+        .outerjoin(Office, Office.office_id == Listing.office_id)
+        .outerjoin(Commission, Commission.sale_id == Sale.sale_id)
+        .where(*conditions)
+        .order_by(Sale.date_of_sale)
+    )
+
+def export_sales(session, file, format="csv", start=None, end=None, chunk_size=10000):
+    """
+    Stream the sales of a date range to a text file as CSV with a header row, or as one JSON object per line.
+
+    Rows are fetched chunk_size at a time with yield_per on the connection of the session,
+    so they skip the ORM loading, and every chunk is encoded into one string before it is
+    written. Memory is bounded by one chunk whatever the number of rows. Dates are written
+    in ISO format and amounts are rounded to cents.
+
+    param session: SQLAlchemy session
+    param file: Text file object
+    param format: "csv" or "ndjson"
+    param start: First (year, month) exported, None for the first sale
+    param end: Last (year, month) exported, inclusive, None for the last sale
+    param chunk_size: Number of rows fetched and written at a time
+    return: Number of exported rows
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {format}")
+    result = session.connection().execute(export_query(start, end).execution_options(yield_per=chunk_size))
+    fields = list(result.keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == "csv":
+        writer.writerow(fields)
+    rows = 0
+    for chunk in result.partitions():
+        if format == "csv":
+            writer.writerows(chunk)
+        else:
+            buffer.writelines(json.dumps(dict(zip(fields, row))) + "\n" for row in chunk)
+        file.write(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+        rows += len(chunk)
+    if format == "csv" and not rows:
+        file.write(buffer.getvalue())
+    return rows
+
+def export_to_path(session, path, format=None, compress=None, start=None, end=None, chunk_size=10000):
+    """
+    Export the sales of a date range to a file, gzip compressed or not.
+
+    param session: SQLAlchemy session
+    param path: Output file
+    param format: "csv" or "ndjson", None to infer it from the extension (.csv, .ndjson or .jsonl, optionally followed by .gz)
+    param compress: Gzip the output, None to compress when the path ends with .gz
+    param start: First (year, month) exported, None for the first sale
+    param end: Last (year, month) exported, inclusive, None for the last sale
+    param chunk_size: Number of rows fetched and written at a time
+    return: ExportReport
+    """
+    if compress is None:
+        compress = path.endswith(".gz")
+    if format is None:
+        name = path[:-len(".gz")] if path.endswith(".gz") else path
+        format = "ndjson" if name.endswith((".ndjson", ".jsonl")) else "csv"
+    start_time = time.perf_counter()
+    if compress:
+        # Level 6 compresses nearly as well as 9 in a fraction of the time
+        file = gzip.open(path, "wt", newline="", encoding="utf-8", compresslevel=6)
+    else:
+        file = open(path, "w", newline="", encoding="utf-8", buffering=1 << 20)
+    with file:
+        rows = export_sales(session, file, format, start, end, chunk_size)
+    with open(path, "rb") as output:
+        size = output.seek(0, io.SEEK_END)
+    return ExportReport(rows, size, time.perf_counter() - start_time)
+
+def _month(value):
+    """
+    Parse a YYYY-MM argument.
+
+    param value: String
+    return: Tuple of (year, month)
+    """
+    year, month = map(int, value.split("-"))
+    return year, month
+
+def benchmark(num_listings=500000, directory="benchmark_data", chunk_size=10000):
+    """
+    Export a benchmark dataset in every format, plain and gzip compressed, and print the rows/second.
+
+    The dataset comes from benchmark.open_dataset(), which generates it on first use.
+
+    param num_listings: Number of listings of the dataset
+    param directory: Directory of the benchmark datasets
+    param chunk_size: Number of rows fetched and written at a time
+    return: Dictionary of ExportReport by file name
+    """
+    from benchmark import open_dataset
+
+    engine = open_dataset(directory, num_listings)
+    session = sessionmaker(bind=engine)()
+    reports = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in ("sales.csv", "sales.csv.gz", "sales.ndjson", "sales.ndjson.gz"):
+            report = reports[name] = export_to_path(session, f"{workdir}/{name}", chunk_size=chunk_size)
+            _print_report(name, report)
+    session.close()
+    engine.dispose()
+    return reports
+
+def _print_report(name, report):
+    """
+    Print the rows, size and rows/second of an export.
+
+    param name: Output name
+    param report: ExportReport
+    return: None
+    """
+    print("{:<18} {:>12,} rows {:>10.1f} MB {:>8.2f} s {:>12,.0f} rows/s".format(
+        name, report.rows, report.bytes / 1e6, report.seconds, report.rows / report.seconds if report.seconds else 0))
+
+def main():
+    """
+    Export the sales of realestate.db.
+    """
+    parser = argparse.ArgumentParser(description="Export sales with their listing, agent, office and commission as CSV or NDJSON.")
+    parser.add_argument("path", nargs="?", help="output file; .ndjson or .jsonl selects NDJSON and .gz compresses")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, help="output format, inferred from the path by default")
+    parser.add_argument("--gzip", action="store_true", default=None, help="compress the output even without a .gz extension")
+    parser.add_argument("--from", dest="start", type=_month, metavar="YYYY-MM", help="first month exported")
+    parser.add_argument("--to", dest="end", type=_month, metavar="YYYY-MM", help="last month exported, inclusive")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows fetched and written at a time")
+    parser.add_argument("--benchmark", type=int, metavar="LISTINGS", help="export the benchmark dataset of this many listings in every format")
+    parser.add_argument("--directory", default="benchmark_data", help="directory keeping the generated datasets")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.benchmark, args.directory, args.chunk_size)
+        return
+    if args.path is None:
+        parser.error("the output path is required")
+
+    engine = create_sqlite_engine()
+    session = sessionmaker(bind=engine)()
+    try:
+        _print_report(args.path, export_to_path(session, args.path, args.format, args.gzip, args.start, args.end, args.chunk_size))
+    finally:
+        session.close()
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,549 @@
+import argparse
+import csv
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+from itertools import islice
+from sqlalchemy import select, update
+from sqlalchemy.orm import sessionmaker
+
+from create import Base, Office, EstateAgent, AgentOffice, Seller, Listing, Buyer, Sale, Commission, ImportCheckpoint
+from database import create_sqlite_engine
+from insert import BATCH_SIZE, contact_key, get_commission_rate, next_primary_key, write_batch
+from rollups import enable_rollups
+
+logger = logging.getLogger(__name__)
+
+# Feeds in load order, every feed is read from <directory>/<feed>.csv
+FEEDS = ("offices", "agents", "sellers", "listings", "buyers", "sales")
+
+# Required and optional columns of every feed; the *_id columns hold source ids of the feed
+FEED_COLUMNS = {
+    "offices": (("office_id", "address", "city", "state", "zip_code"), ()),
+    "agents": (("agent_id", "first_name", "last_name", "email", "phone"), ("office_id",)),
+    "sellers": (("seller_id", "name", "email", "phone"), ()),
+    "listings": (("listing_id", "seller_id", "bedrooms", "bathrooms", "listing_price", "date_of_listing", "agent_id", "office_id"), ("zip_code", "status")),
+    "buyers": (("buyer_id", "name", "email", "phone"), ()),
+    "sales": (("sale_id", "listing_id", "buyer_id", "sale_price", "date_of_sale", "agent_id"), ()),
+}
+
+# Table of every feed and the table of the rows derived from it
+FEED_MODELS = {
+    "offices": (Office, None),
+    "agents": (EstateAgent, AgentOffice),
+    "sellers": (Seller, None),
+    "listings": (Listing, None),
+    "buyers": (Buyer, None),
+    "sales": (Sale, Commission),
+}
+
+FeedReport = namedtuple("FeedReport", ["feed", "rows", "imported", "duplicates", "rejected", "seconds"])
+
+class CsvImporter:
+    """
+    Streaming import of CSV feeds of offices, agents, sellers, listings, buyers and sales.
+
+    Files are read chunk_size rows at a time, so memory is bounded by one chunk plus the
+    key maps. Every row of a feed gets the primary key first_id + its row number, and the
+    source id of each row is mapped to it in memory, so later feeds resolve their foreign
+    keys without a query. Agents, sellers and buyers whose email or phone number is already
+    taken, in the database or earlier in the feed, are merged into the existing contact:
+    their source id maps to its primary key and no row is written. Invalid rows are
+    rejected and skipped.
+
+    Every chunk is bulk inserted in one transaction together with the number of rows done,
+    kept in import_checkpoints. An interrupted import resumes after the last committed
+    chunk; the rows before it are parsed again without being written, which rebuilds the
+    key maps exactly as they were.
+
+    Attributes:
+        session: SQLAlchemy session
+        chunk_size (int): Number of rows read and written per transaction
+        rejects (file): File receiving the rejected rows as CSV, None to only log them
+        keys (dict): Dictionary of primary key by source id, by feed
+    """
+
+    def __init__(self, session, chunk_size=BATCH_SIZE, rejects=None):
+        self.session = session
+        self.chunk_size = chunk_size
+        self.rejects = csv.writer(rejects) if rejects is not None else None
+        self.keys = {feed: {} for feed in FEEDS}
+        self._contacts = {}
+
+    def run(self, directory):
+        """
+        Import every feed found in a directory, in load order.
+
+        param directory: Directory of the <feed>.csv files
+        return: List of FeedReport
+        """
+        reports = []
+        for feed in FEEDS:
+            path = os.path.join(directory, f"{feed}.csv")
+            if os.path.exists(path):
+                reports.append(self.import_feed(feed, path))
+        return reports
+
+    def import_feed(self, feed, path):
+        """
+        Import one CSV file of a feed, resuming after its last committed chunk.
+
+        param feed: Feed name
+        param path: CSV file
+        return: FeedReport
+        """
+        start = time.perf_counter()
+        checkpoint = self._checkpoint(feed, path)
+        done, first_id, first_related_id = checkpoint.rows, checkpoint.first_id, checkpoint.first_related_id
+        model, related_model = FEED_MODELS[feed]
+        parse = getattr(self, f"_parse_{feed}")
+        if feed in ("agents", "sellers", "buyers"):
+            self._load_contacts(feed, model, first_id)
+        rows = imported = duplicates = rejected = 0
+        with open(path, newline="") as file:
+            reader = csv.reader(file)
+            header = self._header(feed, next(reader, []), path)
+            while True:
+                chunk = list(islice(reader, self.chunk_size))
+                if not chunk:
+                    break
+                batch = {model: [], related_model: []}
+                replayed = {model: [], related_model: []}
+                sold = []
+                for values in chunk:
+                    index = rows
+                    rows += 1
+                    record = dict(zip(header, values))
+                    try:
+                        written = parse(record, first_id + index, first_related_id + index if first_related_id else None,
+                                        batch if index >= done else replayed, sold if index >= done else [])
+                    except ValueError as e:
+                        if index >= done:
+                            rejected += 1
+                            self._reject(feed, index + 2, str(e), values)
+                        continue
+                    if index >= done:
+                        imported += written
+                        duplicates += not written
+                if rows <= done:
+                    continue
+                self.session.execute(update(ImportCheckpoint).where(ImportCheckpoint.path == checkpoint.path).values(rows=rows))
+                write_batch(self.session, [(table, table_rows) for table, table_rows in batch.items() if table is not None], sold_listing_ids=sold)
+        report = FeedReport(feed, max(rows - done, 0), imported, duplicates, rejected, time.perf_counter() - start)
+        logger.info("%s: %d rows, %d imported, %d duplicates, %d rejected", feed, *report[1:5])
+        return report
+
+    def _checkpoint(self, feed, path):
+        """
+        Get the checkpoint of a file, starting one if the file was never imported.
+
+        param feed: Feed name
+        param path: CSV file
+        return: ImportCheckpoint
+        """
+        path = os.path.abspath(path)
+        size = os.path.getsize(path)
+        checkpoint = self.session.get(ImportCheckpoint, path)
+        if checkpoint is None:
+            model, related_model = FEED_MODELS[feed]
+            checkpoint = ImportCheckpoint(
+                path=path, feed=feed, size=size, rows=0,
+                first_id=next_primary_key(self.session, model.__table__.primary_key.columns[0]),
+                first_related_id=next_primary_key(self.session, related_model.__table__.primary_key.columns[0]) if related_model else None,
+            )
+            self.session.add(checkpoint)
+            self.session.commit()
+        elif checkpoint.feed != feed or checkpoint.size != size:
+            raise ValueError(f"{path} changed since its import started; delete its import_checkpoints row to import it as a new file")
+        return checkpoint
+
+    def _header(self, feed, header, path):
+        """
+        Check that a CSV header has the required columns of its feed.
+
+        param feed: Feed name
+        param header: List of column names
+        param path: CSV file
+        return: List of column names
+        """
+        header = [column.strip() for column in header]
+        missing = [column for column in FEED_COLUMNS[feed][0] if column not in header]
+        if missing:
+            raise ValueError(f"{path} is missing the columns {', '.join(missing)}")
+        return header
+
+    def _load_contacts(self, feed, model, first_id):
+        """
+        Load the email and phone keys of the contacts that existed before a feed was imported.
+
+        Keys are 64-bit hashes like in ContactRegistry, mapped to the primary key of their
+        contact. Emails are normalized like the feed rows, so they match whatever their case.
+
+        param feed: Feed name
+        param model: Contact model
+        param first_id: Primary key of the first row of the feed
+        return: None
+        """
+        primary_key = model.__table__.primary_key.columns[0]
+        emails, phones = {}, {}
+        rows = self.session.execute(
+            select(primary_key, model.email, model.phone).where(primary_key < first_id).execution_options(yield_per=self.chunk_size)
+        )
+        for row_id, email, phone in rows:
+            email = (email or "").strip().lower()
+            phone = (phone or "").strip()
+            if email:
+                emails.setdefault(contact_key(email), row_id)
+            if phone:
+                phones.setdefault(contact_key(phone), row_id)
+        self._contacts[feed] = (emails, phones)
+
+    def _contact(self, feed, record, row_id):
+        """
+        Map the source id of a contact row to its primary key, or to the contact already holding its email or phone number.
+
+        param feed: Feed name
+        param record: Dictionary of the row values
+        param row_id: Primary key of the row
+        return: Tuple of (email, phone, True if the row is a new contact)
+        """
+        source_id = _required(record, feed[:-1] + "_id")
+        if source_id in self.keys[feed]:
+            raise ValueError(f"duplicate {feed[:-1]}_id {source_id}")
+        email = (record.get("email") or "").strip().lower() or None
+        phone = (record.get("phone") or "").strip() or None
+        if email is not None and "@" not in email:
+            raise ValueError(f"invalid email {email}")
+        emails, phones = self._contacts[feed]
+        email_key = contact_key(email) if email is not None else None
+        phone_key = contact_key(phone) if phone is not None else None
+        existing = emails.get(email_key)
+        if existing is None:
+            existing = phones.get(phone_key)
+        if existing is not None:
+            self.keys[feed][source_id] = existing
+            return email, phone, False
+        if email_key is not None:
+            emails[email_key] = row_id
+        if phone_key is not None:
+            phones[phone_key] = row_id
+        self.keys[feed][source_id] = row_id
+        return email, phone, True
+
+    def _key(self, feed, record, row_id):
+        """
+        Map the source id of a row to its primary key.
+
+        param feed: Feed name
+        param record: Dictionary of the row values
+        param row_id: Primary key of the row
+        return: None
+        """
+        source_id = _required(record, feed[:-1] + "_id")
+        if source_id in self.keys[feed]:
+            raise ValueError(f"duplicate {feed[:-1]}_id {source_id}")
+        self.keys[feed][source_id] = row_id
+
+    def _resolve(self, feed, record, column):
+        """
+        Resolve a foreign key column of a row through the key map of a feed.
+
+        param feed: Feed the column points to
+        param record: Dictionary of the row values
+        param column: Column holding the source id
+        return: Primary key
+        """
+        source_id = _required(record, column)
+        try:
+            return self.keys[feed][source_id]
+        except KeyError:
+            raise ValueError(f"unknown {column} {source_id}") from None
+
+    def _parse_offices(self, record, row_id, related_id, batch, sold):
+        """
+        Validate an office row and add it to the batch.
+
+        return: Number of written rows
+        """
+        office = {
+            "office_id": row_id,
+            "address": _required(record, "address"),
+            "city": _required(record, "city"),
+            "state": _required(record, "state"),
+            "zip_code": _required(record, "zip_code"),
+        }
+        self._key("offices", record, row_id)
+        batch[Office].append(office)
+        return 1
+
+    def _parse_agents(self, record, row_id, related_id, batch, sold):
+        """
+        Validate an agent row and add it, and its office if any, to the batch.
+
+        return: Number of written rows
+        """
+        first_name = _required(record, "first_name")
+        last_name = _required(record, "last_name")
+        office_id = self._resolve("offices", record, "office_id") if (record.get("office_id") or "").strip() else None
+        email, phone, new = self._contact("agents", record, row_id)
+        if not new:
+            return 0
+        batch[EstateAgent].append({"agent_id": row_id, "first_name": first_name, "last_name": last_name, "email": email, "phone": phone})
+        if office_id is not None:
+            batch[AgentOffice].append({"agent_office_id": related_id, "agent_id": row_id, "office_id": office_id})
+        return 1
+
+    def _parse_sellers(self, record, row_id, related_id, batch, sold):
+        """
+        Validate a seller row and add it to the batch.
+
+        return: Number of written rows
+        """
+        name = _required(record, "name")
+        email, phone, new = self._contact("sellers", record, row_id)
+        if not new:
+            return 0
+        batch[Seller].append({"seller_id": row_id, "name": name, "email": email, "phone": phone})
+        return 1
+
+    def _parse_listings(self, record, row_id, related_id, batch, sold):
+        """
+        Validate a listing row and add it to the batch.
+
+        return: Number of written rows
+        """
+        listing = {
+            "listing_id": row_id,
+            "seller_id": self._resolve("sellers", record, "seller_id"),
+            "bedrooms": _number(record, "bedrooms", int),
+            "bathrooms": _number(record, "bathrooms", int),
+            "listing_price": _number(record, "listing_price", float),
+            "zip_code": (record.get("zip_code") or "").strip() or None,
+            "date_of_listing": _date(record, "date_of_listing"),
+            "agent_id": self._resolve("agents", record, "agent_id"),
+            "office_id": self._resolve("offices", record, "office_id"),
+            "status": (record.get("status") or "").strip() or "listed",
+        }
+        self._key("listings", record, row_id)
+        batch[Listing].append(listing)
+        return 1
+
+    def _parse_buyers(self, record, row_id, related_id, batch, sold):
+        """
+        Validate a buyer row and add it to the batch.
+
+        return: Number of written rows
+        """
+        name = _required(record, "name")
+        email, phone, new = self._contact("buyers", record, row_id)
+        if not new:
+            return 0
+        batch[Buyer].append({"buyer_id": row_id, "name": name, "email": email, "phone": phone})
+        return 1
+
+    def _parse_sales(self, record, row_id, related_id, batch, sold):
+        """
+        Validate a sale row and add it and its commission to the batch; its listing is marked sold.
+
+        return: Number of written rows
+        """
+        sale = {
+            "sale_id": row_id,
+            "listing_id": self._resolve("listings", record, "listing_id"),
+            "buyer_id": self._resolve("buyers", record, "buyer_id"),
+            "sale_price": _number(record, "sale_price", float),
+            "date_of_sale": _date(record, "date_of_sale"),
+            "agent_id": self._resolve("agents", record, "agent_id"),
+        }
+        self._key("sales", record, row_id)
+        batch[Sale].append(sale)
+        batch[Commission].append({
+            "commission_id": related_id,
+            "agent_id": sale["agent_id"],
+            "sale_id": row_id,
+            "commission_amount": sale["sale_price"] * get_commission_rate(sale["sale_price"]),
+            "commission_date": sale["date_of_sale"],
+        })
+        sold.append(sale["listing_id"])
+        return 1
+
+    def _reject(self, feed, line, reason, values):
+        """
+        Record a rejected row.
+
+        param feed: Feed name
+        param line: Line number of the row in its file
+        param reason: Reason of the rejection
+        param values: Values of the row
+        return: None
+        """
+        if self.rejects is not None:
+            self.rejects.writerow([feed, line, reason, *values])
+        else:
+            logger.warning("%s line %d rejected: %s", feed, line, reason)
+
+def _required(record, column):
+    """
+    Get a required value of a row.
+
+    param record: Dictionary of the row values
+    param column: Column name
+    return: Stripped string value
+    """
+    value = (record.get(column) or "").strip()
+    if not value:
+        raise ValueError(f"missing {column}")
+    return value
+
+def _number(record, column, kind):
+    """
+    Get a required non-negative number of a row.
+
+    param record: Dictionary of the row values
+    param column: Column name
+    param kind: int or float
+    return: Number
+    """
+    value = _required(record, column)
+    try:
+        number = kind(value)
+    except ValueError:
+        raise ValueError(f"invalid {column} {value}") from None
+    if number < 0:
+        raise ValueError(f"negative {column} {value}")
+    return number
+
+def _date(record, column):
+    """
+    Get a required ISO date of a row.
+
+    param record: Dictionary of the row values
+    param column: Column name
+    return: date
+    """
+    value = _required(record, column)
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"invalid {column} {value}") from None
+
+def write_sample_feeds(directory, num_listings, seed=0):
+    """
+    Write a deterministic set of CSV feeds, one seller per listing and a sale for 60% of the listings.
+
+    Every 100th seller repeats the email of the previous one, to exercise the deduplication.
+
+    param directory: Output directory
+    param num_listings: Number of listings
+    param seed: Random seed
+    return: Number of data rows written
+    """
+    rng = random.Random(seed)
+    num_offices = max(num_listings // 1000, 1)
+    num_agents = max(num_listings // 200, 1)
+    os.makedirs(directory, exist_ok=True)
+    files = {feed: open(os.path.join(directory, f"{feed}.csv"), "w", newline="") for feed in FEEDS}
+    writers = {feed: csv.writer(file) for feed, file in files.items()}
+    for feed, writer in writers.items():
+        required, optional = FEED_COLUMNS[feed]
+        writer.writerow(required + optional)
+    rows = 0
+    for i in range(num_offices):
+        writers["offices"].writerow([f"O{i}", f"{i} Main St", f"City {i}", "ST", f"{i:05d}"])
+    for i in range(num_agents):
+        writers["agents"].writerow([f"A{i}", f"First{i}", f"Last{i}", f"agent{i}@example.com", f"agent-{i}", f"O{i % num_offices}"])
+    rows += num_offices + num_agents
+    for i in range(num_listings):
+        email = f"seller{i - 1 if i % 100 == 99 else i}@example.com"
+        writers["sellers"].writerow([f"S{i}", f"Seller {i}", email, f"seller-{i}"])
+        listing_price = round(rng.uniform(50000, 2000000), 2)
+        date_of_listing = date(2021, 1, 1) + timedelta(days=rng.randrange(900))
+        agent = rng.randrange(num_agents)
+        writers["listings"].writerow([
+            f"L{i}", f"S{i}", rng.randint(1, 5), rng.randint(1, 4), listing_price, date_of_listing.isoformat(),
+            f"A{agent}", f"O{rng.randrange(num_offices)}", f"{rng.randrange(1000):05d}", "listed",
+        ])
+        rows += 2
+        if rng.random() < 0.6:
+            writers["buyers"].writerow([f"B{i}", f"Buyer {i}", f"buyer{i}@example.com", f"buyer-{i}"])
+            writers["sales"].writerow([
+                f"T{i}", f"L{i}", f"B{i}", round(listing_price * rng.uniform(0.9, 1.1), 2),
+                (date_of_listing + timedelta(days=rng.randint(30, 180))).isoformat(), f"A{agent}",
+            ])
+            rows += 2
+    for file in files.values():
+        file.close()
+    return rows
+
+def benchmark(num_listings=100000, chunk_size=BATCH_SIZE, directory=None):
+    """
+    Import generated feeds into a fresh database and print the rows/second of every feed.
+
+    param num_listings: Number of listings of the generated feeds
+    param chunk_size: Number of rows per transaction
+    param directory: Directory for the feeds and the database, defaults to a temporary one
+    return: List of FeedReport
+    """
+    with tempfile.TemporaryDirectory(dir=directory) as workdir:
+        write_sample_feeds(workdir, num_listings)
+        engine = create_sqlite_engine("sqlite:///" + os.path.join(workdir, "import.db"))
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        reports = CsvImporter(session, chunk_size).run(workdir)
+        session.close()
+        engine.dispose()
+    _print_reports(reports)
+    return reports
+
+def _print_reports(reports):
+    """
+    Print the rows, outcome counts and rows/second of every imported feed.
+
+    param reports: List of FeedReport
+    return: None
+    """
+    for report in reports:
+        print("{:<10} {:>10,} rows {:>10,} imported {:>8,} duplicates {:>8,} rejected {:>8.2f} s {:>12,.0f} rows/s".format(
+            report.feed, report.rows, report.imported, report.duplicates, report.rejected, report.seconds,
+            report.rows / report.seconds if report.seconds else 0))
+    rows = sum(report.rows for report in reports)
+    seconds = sum(report.seconds for report in reports)
+    print("{:<10} {:>10,} rows {:>61.2f} s {:>12,.0f} rows/s".format("total", rows, seconds, rows / seconds if seconds else 0))
+
+def main():
+    """
+    Import a directory of CSV feeds into realestate.db.
+    """
+    parser = argparse.ArgumentParser(description="Import CSV feeds of offices, agents, sellers, listings, buyers and sales.")
+    parser.add_argument("directory", nargs="?", help="directory of the <feed>.csv files")
+    parser.add_argument("--chunk-size", type=int, default=BATCH_SIZE, help="rows read and written per transaction")
+    parser.add_argument("--rejects", help="CSV file receiving the rejected rows")
+    parser.add_argument("--rollups", action="store_true", help="maintain the monthly rollup tables while importing")
+    parser.add_argument("--benchmark", type=int, metavar="LISTINGS", help="import generated feeds of this many listings into a temporary database")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.benchmark, args.chunk_size)
+        return
+    if args.directory is None:
+        parser.error("the feed directory is required")
+
+    engine = create_sqlite_engine()
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    if args.rollups:
+        enable_rollups(Session)
+    session = Session()
+    rejects = open(args.rejects, "a", newline="") if args.rejects else None
+    try:
+        _print_reports(CsvImporter(session, args.chunk_size, rejects).run(args.directory))
+    finally:
+        if rejects is not None:
+            rejects.close()
+        session.close()
+
+if __name__ == "__main__":
+    main()
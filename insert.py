@@ -1,75 +1,275 @@
+import argparse
+import bisect
+import hashlib
+import multiprocessing
+import os
 import random
+import secrets
+import tempfile
+import time
+from array import array
 from datetime import datetime, timedelta
 from faker import Faker
-from sqlalchemy import create_engine
+from sqlalchemy import case, func, insert, or_, select, update
 from sqlalchemy.orm import sessionmaker
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, it only speeds up sorting contact keys
+    np = None
 
+from database import create_sqlite_engine
 from create import Base, Office, EstateAgent, AgentOffice, Seller, Listing, Buyer, Sale, Commission, MonthlyCommission
+from rollups import add_sales_to_rollups, enable_rollups, remove_sales_from_rollups, rollups_enabled
 
 fake = Faker()
 
-def generate_offices(session, num_offices=100):
+# Number of rows built in memory and written per transaction by the batched generators
+BATCH_SIZE = 10000
+
+# Commission rate table as (sale price upper bound, rate) tiers in ascending order, the last tier has no bound
+COMMISSION_TIERS = ((100000, 0.1), (200000, 0.075), (500000, 0.06), (1000000, 0.05), (None, 0.04))
+
+# Minimum number of new contact keys kept in a set before they are merged into the sorted array
+PENDING_KEYS = 65536
+
+class ContactKeys:
+    """
+    Compact set of 64-bit contact keys.
+
+    Keys live in a sorted array('Q') of 8-byte integers searched with bisect. New keys go
+    to a small pending set that is merged into the array once it holds a sixteenth of it,
+    so a key costs about 10 bytes instead of the 55 to 70 bytes of a Python set entry.
+    Merges sort with numpy when it is installed.
+
+    Attributes:
+        keys (array): Sorted merged keys
+        pending (set): Keys added since the last merge
+    """
+
+    def __init__(self, keys=()):
+        self.keys = _sorted_keys(array("Q", keys))
+        self.pending = set()
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending)
+
+    def __contains__(self, key):
+        if key in self.pending:
+            return True
+        position = bisect.bisect_left(self.keys, key)
+        return position < len(self.keys) and self.keys[position] == key
+
+    def add(self, key):
+        """
+        Add a key.
+
+        param key: 64-bit integer key
+        return: None
+        """
+        if key in self:
+            return
+        self.pending.add(key)
+        if len(self.pending) >= max(PENDING_KEYS, len(self.keys) // 16):
+            # The pending keys are not in the array, so a plain sort merges them
+            merged = self.keys + array("Q", self.pending)
+            if np is not None:
+                self.keys = array("Q", np.sort(np.frombuffer(merged, dtype=np.uint64)).tobytes())
+            else:
+                self.keys = array("Q", sorted(merged))
+            self.pending = set()
+
+class ContactRegistry:
+    """
+    Reserved email and phone keys of a contact table (EstateAgent, Seller or Buyer).
+
+    The existing keys are loaded once with a streaming key-only scan, after which every
+    uniqueness check is an in-memory lookup instead of two SELECTs per row. Keys are kept
+    as 64-bit hashes in ContactKeys sorted arrays rather than strings, measured at 10 bytes
+    per key against 55 in a Python set, so the emails and phones of 10 million contacts
+    take about 200 MB; a hash collision only makes a free key look taken.
+    
+    Attributes:
+        emails (ContactKeys): Hashes of reserved emails
+        phones (ContactKeys): Hashes of reserved phone numbers
+    """
+
+    def __init__(self, emails=(), phones=()):
+        self.emails = ContactKeys(emails)
+        self.phones = ContactKeys(phones)
+
+    @classmethod
+    def load(cls, session, model, chunk_size=BATCH_SIZE):
+        """
+        Build a registry from the email and phone columns of a contact table.
+        
+        param session: SQLAlchemy session
+        param model: Contact model with email and phone columns
+        param chunk_size: Number of rows fetched per round trip
+        return: ContactRegistry
+        """
+        emails = array("Q")
+        phones = array("Q")
+        result = session.execute(select(model.email, model.phone).execution_options(yield_per=chunk_size))
+        for email, phone in result:
+            if email is not None:
+                emails.append(contact_key(email))
+            if phone is not None:
+                phones.append(contact_key(phone))
+        return cls(emails, phones)
+
+    def __len__(self):
+        return len(self.emails)
+
+    def is_reserved(self, email, phone):
+        """
+        Check whether an email or phone number is already taken.
+        
+        param email: Email
+        param phone: Phone number
+        return: True if either key is taken
+        """
+        return contact_key(email) in self.emails or contact_key(phone) in self.phones
+
+    def reserve(self, email, phone):
+        """
+        Reserve an email and phone number if neither is taken.
+        
+        param email: Email
+        param phone: Phone number
+        return: True if the pair was reserved, False if either key was already taken
+        """
+        email_key = contact_key(email)
+        phone_key = contact_key(phone)
+        if email_key in self.emails or phone_key in self.phones:
+            return False
+        self.emails.add(email_key)
+        self.phones.add(phone_key)
+        return True
+
+def _sorted_keys(keys):
+    """
+    Sort and deduplicate an array('Q') of keys.
+
+    param keys: array('Q')
+    return: Sorted array('Q')
+    """
+    if np is not None and keys:
+        keys = np.sort(np.frombuffer(keys, dtype=np.uint64))
+        return array("Q", keys[np.concatenate(([True], keys[1:] != keys[:-1]))].tobytes())
+    return array("Q", sorted(set(keys)))
+
+def contact_key(value):
     """
-    Generate a number of offices and insert them into the database.
+    Hash an email or phone number to a 64-bit integer key.
+    
+    param value: Email or phone number
+    return: Integer key
+    """
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "little")
+
+def generate_offices(session, num_offices=100, batch_size=BATCH_SIZE):
+    """
+    Generate a number of offices and bulk insert them into the database.
     
     param session: SQLAlchemy session
     param num_offices: Number of offices to generate
-    return: List of generated offices
-    """
-    offices = []
-    for _ in range(num_offices):
-        office = Office(
-            address=fake.street_address(),
-            city=fake.city(),
-            state=fake.state_abbr(),
-            zip_code=fake.zipcode(),
-        )
-        insert_data(session, [office])
-    return offices
+    param batch_size: Number of offices per transaction
+    return: List of generated office ids
+    """
+    office_id = next_primary_key(session, Office.office_id)
+    office_ids = list(range(office_id, office_id + num_offices))
+    for first in range(0, num_offices, batch_size):
+        write_batch(session, [(Office, [
+            {
+                "office_id": office_id,
+                "address": fake.street_address(),
+                "city": fake.city(),
+                "state": fake.state_abbr(),
+                "zip_code": fake.zipcode(),
+            }
+            for office_id in office_ids[first:first + batch_size]
+        ])])
+    return office_ids
 
-def generate_agents(session, num_agents=50):
+def generate_agents(session, num_agents=50, batch_size=BATCH_SIZE):
     """
-    Generate a number of agents and insert them into the database.
+    Generate a number of agents and bulk insert them into the database.
+
+    Agents whose generated email or phone number is already taken are skipped, so fewer
+    than num_agents may be generated.
     
     param session: SQLAlchemy session
     param num_agents: Number of agents to generate
-    return: List of generated agents
+    param batch_size: Number of agents per transaction
+    return: List of generated agent ids
     """
+    agent_id = next_primary_key(session, EstateAgent.agent_id)
+    registry = ContactRegistry.load(session, EstateAgent)
+    agent_ids = []
     agents = []
     for _ in range(num_agents):
         email=fake.email()
         phone=fake.phone_number()
-        if session.query(EstateAgent).filter_by(email=email).first() or session.query(EstateAgent).filter_by(phone=phone).first():
+        if not registry.reserve(email, phone):
             continue
-        agent = EstateAgent(
-            first_name=fake.first_name(),
-            last_name=fake.last_name(),
-            email=email,
-            phone=phone,
-        )
-        insert_data(session, [agent])
-    return agents
+        agents.append({
+            "agent_id": agent_id,
+            "first_name": fake.first_name(),
+            "last_name": fake.last_name(),
+            "email": email,
+            "phone": phone,
+        })
+        agent_ids.append(agent_id)
+        agent_id += 1
+        if len(agents) >= batch_size:
+            write_batch(session, [(EstateAgent, agents)])
+            agents = []
+    if agents:
+        write_batch(session, [(EstateAgent, agents)])
+    return agent_ids
 
-def generate_agent_offices(session, agents, offices):
+def generate_agent_offices(session, agents, offices, batch_size=BATCH_SIZE):
     """
-    Generate agent offices and insert them into the database.
+    Assign every agent without an office to 1 to 3 random offices and bulk insert the assignments.
+
+    The agents that already have an office are loaded with one query, and the number of
+    offices of every agent and the offices themselves are each drawn in one call.
     
     param session: SQLAlchemy session
-    param agents: List of agents
-    param offices: List of offices
-    return: List of generated agent offices
+    param agents: List of agents or agent ids
+    param offices: List of offices or office ids
+    param batch_size: Number of assignments per transaction
+    return: List of generated agent office ids
     """
-    agent_offices = []
-    for agent in agents:
-        if session.query(AgentOffice).filter_by(agent_id=agent.agent_id).first():
-            continue
-        for _ in range(random.randint(1, 3)):
-            agent_office = AgentOffice(
-                agent_id=agent.agent_id,
-                office_id=random.choice(offices).office_id,
-            )
-            insert_data(session, [agent_office])
-    return agent_offices
+    assigned = set(session.scalars(select(AgentOffice.agent_id).distinct()))
+    agent_ids = [agent_id for agent_id in primary_keys(agents, EstateAgent.agent_id) if agent_id not in assigned]
+    office_ids = primary_keys(offices, Office.office_id)
+    counts = random.choices((1, 2, 3), k=len(agent_ids))
+    drawn = random.choices(office_ids, k=sum(counts))
+    agent_office_id = next_primary_key(session, AgentOffice.agent_office_id)
+    agent_office_ids = []
+    rows = []
+    position = 0
+    for agent_id, count in zip(agent_ids, counts):
+        # The same office drawn twice for an agent is assigned once
+        for office_id in dict.fromkeys(drawn[position:position + count]):
+            rows.append({"agent_office_id": agent_office_id, "agent_id": agent_id, "office_id": office_id})
+            agent_office_ids.append(agent_office_id)
+            agent_office_id += 1
+        position += count
+    for first in range(0, len(rows), batch_size):
+        write_batch(session, [(AgentOffice, rows[first:first + batch_size])])
+    return agent_office_ids
+
+def primary_keys(items, column):
+    """
+    Get the primary keys of a list of model objects, leaving plain primary keys as they are.
+    
+    param items: List of model objects or primary keys
+    param column: Primary key column of the model
+    return: List of primary keys
+    """
+    return [getattr(item, column.key) if isinstance(item, Base) else item for item in items]
 
 def generate_listings_and_sellers(session, num_listings=1000, agents=None, offices=None):
     """
@@ -77,24 +277,21 @@ def generate_listings_and_sellers(session, num_listings=1000, agents=None, offic
     
     param session: SQLAlchemy session
     param num_listings: Number of listings to generate
-    param agents: List of agents
-    param offices: List of offices
+    param agents: List of agents or agent ids
+    param offices: List of offices or office ids
     return: List of generated sellers and listings
     """
     listings = []
     sellers = []
-    emails = set()
-    phones = set()
+    agent_ids = primary_keys(agents, EstateAgent.agent_id)
+    office_ids = primary_keys(offices, Office.office_id)
+    registry = ContactRegistry.load(session, Seller)
     for _ in range(num_listings):
         try:
             email = fake.email()
             phone = fake.phone_number()
-            if session.query(Seller).filter_by(email=email).first() or session.query(Seller).filter_by(phone=phone).first():
-                continue
-            if email in emails or phone in phones:
+            if not registry.reserve(email, phone):
                 continue
-            emails.add(email)
-            phones.add(phone)
             seller = Seller(
                 name=fake.name(),
                 email=email,
@@ -110,8 +307,8 @@ def generate_listings_and_sellers(session, num_listings=1000, agents=None, offic
                 listing_price=random.uniform(50000, 2000000),
                 zip_code=fake.zipcode(),
                 date_of_listing=fake.date_between(start_date="-2y", end_date="today"),
-                agent_id=random.choice(agents).agent_id,
-                office_id=random.choice(offices).office_id,
+                agent_id=random.choice(agent_ids),
+                office_id=random.choice(office_ids),
             )
             session.add(listing)
             session.commit()
@@ -120,86 +317,483 @@ def generate_listings_and_sellers(session, num_listings=1000, agents=None, offic
             raise e
     return sellers, listings
 
-def generate_sales_and_commissions(session, listings):
+def generate_sales_and_commissions(session, listings=None, chunk_size=BATCH_SIZE):
     """
     Generate sales and commissions and insert them into the database.
+
+    Without listings, the unsold listings are streamed from the database chunk_size at a
+    time; a given list of listings is split into chunks of chunk_size. The sales of a
+    chunk, their commissions and the UPDATE marking their listings sold are committed in
+    one transaction, so a failure never leaves a sale whose listing is still listed.
     
     param session: SQLAlchemy session
-    param listings: List of listings
+    param listings: List of listings, None to stream the unsold listings
+    param chunk_size: Number of listings per chunk and per transaction
     return: List of generated buyers, sales, and commissions
     """
     sales = []
     buyers = []
-    emails=set()
-    phones=set()
+    registry = ContactRegistry.load(session, Buyer)
     commissions = []
-    for listing in listings:
-        if listing.status == "sold":
-            continue
+    if listings is None:
+        chunks = iter_unsold_listings(session, chunk_size)
+    else:
+        unsold = [
+            (listing.listing_id, listing.listing_price, listing.date_of_listing, listing.agent_id)
+            for listing in listings
+            if listing.status != "sold"
+        ]
+        chunks = (unsold[first:first + chunk_size] for first in range(0, len(unsold), chunk_size))
+    for chunk in chunks:
+        sold = []
         try:
-            if random.random() < 0.6:  # Assuming 60% of the listings are sold
-                phone = fake.phone_number()
-                email = fake.email()
-                if session.query(Buyer).filter_by(email=email).first() or session.query(Buyer).filter_by(phone=phone).first():
-                    continue
-                if email in emails or phone in phones:
-                    continue
-                emails.add(email)
-                phones.add(phone)
-                buyer = Buyer(
-                    name=fake.name(),
-                    email=email,
-                    phone=phone,
-                )
-                session.add(buyer)
-                session.flush()
-                sale_price = random.uniform(listing.listing_price * 0.9, listing.listing_price * 1.1)
-                date_of_sale = listing.date_of_listing + timedelta(days=random.randint(30, 180))
-
-                sale = Sale(
-                    listing_id=listing.listing_id,
-                    buyer_id=buyer.buyer_id,
-                    sale_price=sale_price,
-                    date_of_sale=date_of_sale,
-                    agent_id=listing.agent_id,
-                )
-                session.add(sale)
-                session.flush()
-                commission_rate = get_commission_rate(sale_price)
-                commission_amount = sale_price * commission_rate
-
-                commission = Commission(
-                    agent_id=sale.agent_id,
-                    sale_id=sale.sale_id,
-                    commission_amount=commission_amount,
-                    commission_date=date_of_sale,
-                )
-                session.add(commission)
-
-                listing.status = "sold"
-                session.commit()
+            for listing_id, listing_price, date_of_listing, agent_id in chunk:
+                if random.random() < 0.6:  # Assuming 60% of the listings are sold
+                    phone = fake.phone_number()
+                    email = fake.email()
+                    if not registry.reserve(email, phone):
+                        continue
+                    buyer = Buyer(
+                        name=fake.name(),
+                        email=email,
+                        phone=phone,
+                    )
+                    session.add(buyer)
+                    session.flush()
+                    sale_price = random.uniform(listing_price * 0.9, listing_price * 1.1)
+                    date_of_sale = date_of_listing + timedelta(days=random.randint(30, 180))
+
+                    sale = Sale(
+                        listing_id=listing_id,
+                        buyer_id=buyer.buyer_id,
+                        sale_price=sale_price,
+                        date_of_sale=date_of_sale,
+                        agent_id=agent_id,
+                    )
+                    session.add(sale)
+                    session.flush()
+                    commission_rate = get_commission_rate(sale_price)
+                    commission_amount = sale_price * commission_rate
+
+                    commission = Commission(
+                        agent_id=sale.agent_id,
+                        sale_id=sale.sale_id,
+                        commission_amount=commission_amount,
+                        commission_date=date_of_sale,
+                    )
+                    session.add(commission)
+                    sold.append(listing_id)
+            mark_listings_sold(session, sold)
         except Exception as e:
             session.rollback()
             raise e
     return buyers, sales, commissions
 
-def get_commission_rate(sale_price):
+def iter_unsold_listings(session, chunk_size=BATCH_SIZE):
+    """
+    Stream the listings that are not sold yet in listing_id order, one chunk at a time.
+
+    Every chunk is a keyset query on listing_id that reads plain column tuples, so no
+    listing enters the identity map and the session can commit between chunks. Listings
+    marked sold while a chunk is processed are behind the key and are not read again.
+
+    param session: SQLAlchemy session
+    param chunk_size: Number of listings per chunk
+    return: Generator of lists of (listing_id, listing_price, date_of_listing, agent_id) tuples
+    """
+    last_listing_id = 0
+    while True:
+        chunk = session.execute(
+            select(Listing.listing_id, Listing.listing_price, Listing.date_of_listing, Listing.agent_id)
+            .where(or_(Listing.status.is_(None), Listing.status != "sold"), Listing.listing_id > last_listing_id)
+            .order_by(Listing.listing_id)
+            .limit(chunk_size)
+        ).all()
+        if not chunk:
+            return
+        yield chunk
+        last_listing_id = chunk[-1][0]
+
+def mark_listings_sold(session, listing_ids):
+    """
+    Mark listings as sold with one UPDATE and commit it with the pending changes of the session.
+
+    param session: SQLAlchemy session
+    param listing_ids: Ids of the sold listings
+    return: None
+    """
+    if not listing_ids:
+        return
+    try:
+        session.execute(
+            update(Listing).where(Listing.listing_id.in_(listing_ids)).values(status="sold"),
+            execution_options={"synchronize_session": False},
+        )
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise e
+
+def get_commission_rate(sale_price, tiers=COMMISSION_TIERS):
     """
     Get the commission rate based on the sale price.
     
     param sale_price: Sale price
+    param tiers: Commission rate table
     return: Commission rate
     """
-    if sale_price < 100000:
-        return 0.1
-    elif sale_price < 200000:
-        return 0.075
-    elif sale_price < 500000:
-        return 0.06
-    elif sale_price < 1000000:
-        return 0.05
+    return tiers[bisect.bisect_right([bound for bound, _ in tiers[:-1]], sale_price)][1]
+
+def commission_rate_case(sale_price, tiers=COMMISSION_TIERS):
+    """
+    Build the SQL CASE expression of the commission rate of a sale price.
+    
+    param sale_price: Sale price column
+    param tiers: Commission rate table
+    return: SQLAlchemy CASE expression
+    """
+    return case(*[(sale_price < bound, rate) for bound, rate in tiers[:-1]], else_=tiers[-1][1])
+
+def recompute_commissions(session, tiers=COMMISSION_TIERS, batch_size=BATCH_SIZE):
+    """
+    Recompute every commission amount from the sale price with a new rate table.
+
+    Commissions are updated with one UPDATE ... FROM sales statement per range of
+    batch_size commission ids, and each range is committed as one transaction. Closed
+    months in monthly_commissions are not touched; rerun insert_monthly_commissions_range()
+    for the months that should reflect the new rates.
+
+    param session: SQLAlchemy session
+    param tiers: Commission rate table
+    param batch_size: Number of commission ids per transaction
+    return: Number of updated commissions
+    """
+    first, last = session.execute(select(func.min(Commission.commission_id), func.max(Commission.commission_id))).one()
+    if first is None:
+        return 0
+    updated = 0
+    for start in range(first, last + 1, batch_size):
+        in_batch = Commission.commission_id.between(start, start + batch_size - 1)
+        try:
+            if rollups_enabled(session):
+                sale_ids = session.execute(select(Commission.sale_id).where(in_batch)).scalars().all()
+                remove_sales_from_rollups(session, sale_ids)
+            updated += session.execute(
+                update(Commission)
+                .where(Commission.sale_id == Sale.sale_id, in_batch)
+                .values(commission_amount=Sale.sale_price * commission_rate_case(Sale.sale_price, tiers)),
+                execution_options={"synchronize_session": False},
+            ).rowcount
+            if rollups_enabled(session):
+                add_sales_to_rollups(session, sale_ids)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+    return updated
+
+def generate_listings_and_sellers_batched(session, num_listings=1000, agents=None, offices=None, batch_size=BATCH_SIZE):
+    """
+    Generate listings and sellers in memory and bulk insert them one batch at a time.
+
+    Primary keys are assigned client-side so sellers and listings can be written with
+    a single executemany per table instead of a flush per row. Each batch is committed
+    as one transaction.
+    
+    param session: SQLAlchemy session
+    param num_listings: Number of listings to generate
+    param agents: List of agents or agent ids
+    param offices: List of offices or office ids
+    param batch_size: Number of listings per transaction
+    return: Number of generated listings
+    """
+    agent_ids = primary_keys(agents, EstateAgent.agent_id)
+    office_ids = primary_keys(offices, Office.office_id)
+    seller_id = next_primary_key(session, Seller.seller_id)
+    listing_id = next_primary_key(session, Listing.listing_id)
+    registry = ContactRegistry.load(session, Seller)
+    sellers = []
+    listings = []
+    generated = 0
+    for _ in range(num_listings):
+        email = fake.email()
+        phone = fake.phone_number()
+        if not registry.reserve(email, phone):
+            continue
+        sellers.append({
+            "seller_id": seller_id,
+            "name": fake.name(),
+            "email": email,
+            "phone": phone,
+        })
+        listings.append({
+            "listing_id": listing_id,
+            "seller_id": seller_id,
+            "bedrooms": random.randint(1, 5),
+            "bathrooms": random.randint(1, 4),
+            "listing_price": random.uniform(50000, 2000000),
+            "zip_code": fake.zipcode(),
+            "date_of_listing": fake.date_between(start_date="-2y", end_date="today"),
+            "agent_id": random.choice(agent_ids),
+            "office_id": random.choice(office_ids),
+            "status": "listed",
+        })
+        seller_id += 1
+        listing_id += 1
+        if len(listings) >= batch_size:
+            generated += len(listings)
+            write_batch(session, [(Seller, sellers), (Listing, listings)])
+            sellers = []
+            listings = []
+    if listings:
+        generated += len(listings)
+        write_batch(session, [(Seller, sellers), (Listing, listings)])
+    return generated
+
+def generate_sales_and_commissions_batched(session, listings=None, batch_size=BATCH_SIZE):
+    """
+    Generate sales and commissions in memory and bulk insert them one batch at a time.
+
+    Without listings, the unsold listings are streamed from the database one batch at a
+    time, so memory does not grow with the number of listings. Listings that were sold in
+    a batch are marked with one UPDATE per batch.
+    
+    param session: SQLAlchemy session
+    param listings: List of listings, None to stream the unsold listings
+    param batch_size: Number of listings per transaction
+    return: Number of generated sales
+    """
+    if listings is None:
+        chunks = iter_unsold_listings(session, batch_size)
     else:
-        return 0.04
+        # Copy the columns out before the first commit expires the listings
+        pending = [
+            (listing.listing_id, listing.listing_price, listing.date_of_listing, listing.agent_id)
+            for listing in listings
+            if listing.status != "sold"
+        ]
+        chunks = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+    buyer_id = next_primary_key(session, Buyer.buyer_id)
+    sale_id = next_primary_key(session, Sale.sale_id)
+    commission_id = next_primary_key(session, Commission.commission_id)
+    registry = ContactRegistry.load(session, Buyer)
+    generated = 0
+    for chunk in chunks:
+        buyers = []
+        sales = []
+        commissions = []
+        sold = []
+        for listing_id, listing_price, date_of_listing, agent_id in chunk:
+            if random.random() >= 0.6:  # Assuming 60% of the listings are sold
+                continue
+            phone = fake.phone_number()
+            email = fake.email()
+            if not registry.reserve(email, phone):
+                continue
+            sale_price = random.uniform(listing_price * 0.9, listing_price * 1.1)
+            date_of_sale = date_of_listing + timedelta(days=random.randint(30, 180))
+            buyers.append({
+                "buyer_id": buyer_id,
+                "name": fake.name(),
+                "email": email,
+                "phone": phone,
+            })
+            sales.append({
+                "sale_id": sale_id,
+                "listing_id": listing_id,
+                "buyer_id": buyer_id,
+                "sale_price": sale_price,
+                "date_of_sale": date_of_sale,
+                "agent_id": agent_id,
+            })
+            commissions.append({
+                "commission_id": commission_id,
+                "agent_id": agent_id,
+                "sale_id": sale_id,
+                "commission_amount": sale_price * get_commission_rate(sale_price),
+                "commission_date": date_of_sale,
+            })
+            sold.append(listing_id)
+            buyer_id += 1
+            sale_id += 1
+            commission_id += 1
+        generated += len(sales)
+        write_batch(session, [(Buyer, buyers), (Sale, sales), (Commission, commissions)], sold_listing_ids=sold)
+    return generated
+
+def next_primary_key(session, column):
+    """
+    Get the next free value of an integer primary key column.
+    
+    param session: SQLAlchemy session
+    param column: Primary key column
+    return: Next primary key value
+    """
+    return (session.query(func.max(column)).scalar() or 0) + 1
+
+def write_batch(session, batch, sold_listing_ids=None):
+    """
+    Bulk insert a batch of rows and commit it as a single transaction.
+    
+    param session: SQLAlchemy session
+    param batch: List of (model, rows) pairs, inserted in order
+    param sold_listing_ids: Listing ids to mark as sold in the same transaction
+    return: None
+    """
+    try:
+        for model, rows in batch:
+            if rows:
+                session.execute(insert(model.__table__), rows)
+        if rollups_enabled(session):
+            add_sales_to_rollups(session, [row["sale_id"] for model, rows in batch if model is Sale for row in rows])
+        if sold_listing_ids:
+            session.execute(
+                update(Listing).where(Listing.listing_id.in_(sold_listing_ids)).values(status="sold"),
+                execution_options={"synchronize_session": False},
+            )
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise e
+
+def generate_parallel(session, num_listings=1000, agents=None, offices=None, workers=None, batch_size=BATCH_SIZE, seed=None):
+    """
+    Generate sellers, listings, buyers, sales and commissions in worker processes and
+    bulk insert them from this process.
+
+    The listings are split into partitions of batch_size. Every partition owns a disjoint
+    primary key range in each table and a disjoint email/phone namespace, so workers never
+    coordinate and the single writer never has to check for conflicts. Foreign keys only
+    point at the given agents and offices, or at rows of the same partition.
+    
+    param session: SQLAlchemy session of the writer
+    param num_listings: Number of listings to generate
+    param agents: List of agents or agent ids
+    param offices: List of offices or office ids
+    param workers: Number of worker processes, defaults to the number of cores
+    param batch_size: Number of listings per partition and per transaction
+    param seed: Seed making the generated data independent of the number of workers
+    return: Number of generated listings
+    """
+    state = {
+        "agent_ids": primary_keys(agents, EstateAgent.agent_id),
+        "office_ids": primary_keys(offices, Office.office_id),
+        "seller_id": next_primary_key(session, Seller.seller_id),
+        "listing_id": next_primary_key(session, Listing.listing_id),
+        "buyer_id": next_primary_key(session, Buyer.buyer_id),
+        "sale_id": next_primary_key(session, Sale.sale_id),
+        "commission_id": next_primary_key(session, Commission.commission_id),
+        # Run tag keeps the namespaces of separate seeding runs apart
+        "tag": secrets.token_hex(4) if seed is None else "s{}".format(seed),
+        "seed": seed,
+    }
+    partitions = [
+        (index, index * batch_size, min(batch_size, num_listings - index * batch_size))
+        for index in range((num_listings + batch_size - 1) // batch_size)
+    ]
+    generated = 0
+    with multiprocessing.Pool(workers, initializer=_init_partition_worker, initargs=(state,)) as pool:
+        for batch in pool.imap_unordered(_generate_partition, partitions):
+            generated += len(batch[Listing])
+            write_batch(session, [(model, batch[model]) for model in (Seller, Listing, Buyer, Sale, Commission)])
+    return generated
+
+_partition_state = None
+
+def _init_partition_worker(state):
+    """
+    Store the shared seeding state in a worker process.
+    
+    param state: Dictionary built by generate_parallel
+    return: None
+    """
+    global _partition_state
+    _partition_state = state
+
+def _generate_partition(partition):
+    """
+    Generate the rows of one partition in a worker process.
+
+    Row i of the partition starting at offset uses primary key base + offset + i in every
+    table; sales, buyers and commissions leave gaps for the listings that were not sold.
+    
+    param partition: Tuple of (partition index, offset, number of listings)
+    return: Dictionary of rows by model
+    """
+    index, offset, count = partition
+    state = _partition_state
+    # Forked workers inherit the same random state, so every partition is reseeded
+    partition_seed = secrets.randbits(64) if state["seed"] is None else state["seed"] + index
+    fake.seed_instance(partition_seed)
+    random.seed(partition_seed)
+    batch = {Seller: [], Listing: [], Buyer: [], Sale: [], Commission: []}
+    for i in range(offset, offset + count):
+        listing_id = state["listing_id"] + i
+        seller_id = state["seller_id"] + i
+        listing_price = random.uniform(50000, 2000000)
+        date_of_listing = fake.date_between(start_date="-2y", end_date="today")
+        agent_id = random.choice(state["agent_ids"])
+        sold = random.random() < 0.6  # Assuming 60% of the listings are sold
+        email, phone = _partition_contact(state["tag"], "s", i)
+        batch[Seller].append({
+            "seller_id": seller_id,
+            "name": fake.name(),
+            "email": email,
+            "phone": phone,
+        })
+        batch[Listing].append({
+            "listing_id": listing_id,
+            "seller_id": seller_id,
+            "bedrooms": random.randint(1, 5),
+            "bathrooms": random.randint(1, 4),
+            "listing_price": listing_price,
+            "zip_code": fake.zipcode(),
+            "date_of_listing": date_of_listing,
+            "agent_id": agent_id,
+            "office_id": random.choice(state["office_ids"]),
+            "status": "sold" if sold else "listed",
+        })
+        if not sold:
+            continue
+        buyer_id = state["buyer_id"] + i
+        sale_id = state["sale_id"] + i
+        sale_price = random.uniform(listing_price * 0.9, listing_price * 1.1)
+        date_of_sale = date_of_listing + timedelta(days=random.randint(30, 180))
+        email, phone = _partition_contact(state["tag"], "b", i)
+        batch[Buyer].append({
+            "buyer_id": buyer_id,
+            "name": fake.name(),
+            "email": email,
+            "phone": phone,
+        })
+        batch[Sale].append({
+            "sale_id": sale_id,
+            "listing_id": listing_id,
+            "buyer_id": buyer_id,
+            "sale_price": sale_price,
+            "date_of_sale": date_of_sale,
+            "agent_id": agent_id,
+        })
+        batch[Commission].append({
+            "commission_id": state["commission_id"] + i,
+            "agent_id": agent_id,
+            "sale_id": sale_id,
+            "commission_amount": sale_price * get_commission_rate(sale_price),
+            "commission_date": date_of_sale,
+        })
+    return batch
+
+def _partition_contact(tag, kind, i):
+    """
+    Build an email and phone number that are unique to one generated row of a seeding run.
+    
+    param tag: Run tag
+    param kind: Contact kind prefix
+    param i: Row number within the run
+    return: Tuple of (email, phone)
+    """
+    user, domain = fake.email().split("@")
+    return "{}+{}{}{}@{}".format(user, kind, tag, i, domain), "+{}-{}-{:09d}".format(kind, tag, i)
 
 def insert_data(session, data):
     """
@@ -213,27 +807,103 @@ def insert_data(session, data):
         session.add(item)
     session.commit()
 
+def seed(session, num_listings=1000, batched=True, batch_size=BATCH_SIZE, workers=None):
+    """
+    Seed offices, agents, listings and sales into the database.
+    
+    param session: SQLAlchemy session
+    param num_listings: Number of listings to generate
+    param batched: Use the batched bulk insert generators instead of the per-row ones
+    param batch_size: Number of rows per transaction in batched mode
+    param workers: Generate listings and sales in this many worker processes
+    return: None
+    """
+    offices = generate_offices(session, batch_size=batch_size)
+    agents = generate_agents(session, batch_size=batch_size)
+    generate_agent_offices(session, agents, offices, batch_size=batch_size)
+    if workers:
+        generate_parallel(session, num_listings, agents=agents, offices=offices, workers=workers, batch_size=batch_size)
+    elif batched:
+        generate_listings_and_sellers_batched(session, num_listings, agents=agents, offices=offices, batch_size=batch_size)
+        generate_sales_and_commissions_batched(session, batch_size=batch_size)
+    else:
+        generate_listings_and_sellers(session, num_listings, agents=agents, offices=offices)
+        generate_sales_and_commissions(session)
+
+def count_rows(session):
+    """
+    Count the rows in every table.
+    
+    param session: SQLAlchemy session
+    return: Total number of rows
+    """
+    return sum(session.query(func.count()).select_from(table).scalar() for table in Base.metadata.sorted_tables)
+
+def compare_insert_modes(num_listings=1000, batch_size=BATCH_SIZE, workers=None):
+    """
+    Seed a fresh on-disk database per mode and print rows/second for each.
+    
+    param num_listings: Number of listings to generate per run
+    param batch_size: Number of rows per transaction in batched mode
+    param workers: Also run the parallel mode with this many worker processes
+    return: Dictionary of rows/second by mode
+    """
+    modes = [("per-row", {"batched": False}), ("batched", {"batched": True})]
+    if workers:
+        modes.append(("parallel", {"workers": workers}))
+    results = {}
+    for mode, options in modes:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_sqlite_engine("sqlite:///" + os.path.join(directory, "compare.db"))
+            Base.metadata.create_all(engine)
+            Session = sessionmaker(bind=engine)
+            session = Session()
+            start = time.perf_counter()
+            seed(session, num_listings, batch_size=batch_size, **options)
+            elapsed = time.perf_counter() - start
+            rows = count_rows(session)
+            session.close()
+            engine.dispose()
+        results[mode] = rows / elapsed
+        print("{:<10} {:>10} rows {:>10.2f} s {:>12,.0f} rows/s".format(mode, rows, elapsed, results[mode]))
+    for mode in results:
+        if mode != "per-row":
+            print("Speedup of {}: {:.1f}x".format(mode, results[mode] / results["per-row"]))
+    return results
+
 def main():
     """
     Main function for running the script.
     """
+    parser = argparse.ArgumentParser(description="Insert fake data into the real estate database.")
+    parser.add_argument("--listings", type=int, default=1000, help="number of listings to generate")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per transaction in batched mode")
+    parser.add_argument("--per-row", action="store_true", help="commit every row separately (original behaviour)")
+    parser.add_argument("--workers", type=int, default=0, help="generate listings and sales in this many processes")
+    parser.add_argument("--rollups", action="store_true", help="maintain the monthly rollup tables while seeding")
+    parser.add_argument("--compare", action="store_true", help="compare rows/second of the per-row and batched modes")
+    parser.add_argument("--echo", action="store_true", help="log every SQL statement")
+    parser.add_argument("--recompute-commissions", action="store_true", help="recompute every commission amount from the rate table")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_insert_modes(args.listings, args.batch_size, args.workers)
+        return
+
     # Create the SQLite database and tables
-    engine = create_engine("sqlite:///realestate.db", echo=True)
+    engine = create_sqlite_engine(echo=args.echo)
     Base.metadata.create_all(engine)
 
     Session = sessionmaker(bind=engine)
+    if args.rollups:
+        enable_rollups(Session)
     session = Session()
 
-    generate_offices(session)
-
-    generate_agents(session)
-    offices = session.query(Office).all()
-    agents = session.query(EstateAgent).all()
+    if args.recompute_commissions:
+        print(f"{recompute_commissions(session, batch_size=args.batch_size)} commissions recomputed")
+        return
 
-    generate_agent_offices(session, agents, offices)
-    generate_listings_and_sellers(session, agents=agents, offices=offices)
-    listings = session.query(Listing).all()
-    generate_sales_and_commissions(session, listings)
+    seed(session, args.listings, batched=not args.per_row, batch_size=args.batch_size, workers=args.workers)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,258 @@
+import atexit
+import bisect
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Statements slower than this many seconds are logged with their query plan
+SLOW_QUERY_THRESHOLD = 0.1
+
+# Setting PROFILE_ENV to a threshold in seconds profiles every engine made by database.py;
+# PROFILE_OUTPUT_ENV names the summary file written at exit, *.prom for the Prometheus format
+PROFILE_ENV = "REALESTATE_PROFILE"
+PROFILE_OUTPUT_ENV = "REALESTATE_PROFILE_OUTPUT"
+
+# Profiler shared by every engine profiled through the environment
+_environment_profiler = None
+
+StatementStats = namedtuple("StatementStats", ["statement", "calls", "rows_written", "total_seconds", "max_seconds", "buckets"])
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+_WRITES = re.compile(r"(?:INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+@functools.lru_cache(maxsize=4096)
+def normalize_statement(statement):
+    """
+    Reduce an SQL statement to its shape, so statements differing only in values are grouped.
+
+    Literals become ?, expanded IN lists of any length become IN (?, ...) and whitespace
+    is collapsed.
+
+    param statement: SQL statement
+    return: Normalized statement
+    """
+    statement = _LITERALS.sub("?", statement)
+    statement = _IN_LISTS.sub("IN (?, ...)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+class QueryProfiler:
+    """
+    Per-statement latency histograms, call counts and written row counts from engine events.
+
+    Nothing is recorded until install() attaches the listeners, so an engine without a
+    profiler pays nothing. Statements slower than the threshold are logged with their
+    EXPLAIN QUERY PLAN on SQLite.
+
+    Attributes:
+        threshold (float): Seconds above which a statement is logged as slow, None to log nothing
+        buckets (tuple): Upper bounds in seconds of the latency histogram buckets
+    """
+
+    def __init__(self, threshold=SLOW_QUERY_THRESHOLD, buckets=LATENCY_BUCKETS):
+        self.threshold = threshold
+        self.buckets = tuple(buckets)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def install(self, engine):
+        """
+        Start recording the statements of an engine.
+
+        param engine: SQLAlchemy engine
+        return: None
+        """
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def uninstall(self, engine):
+        """
+        Stop recording the statements of an engine.
+
+        param engine: SQLAlchemy engine
+        return: None
+        """
+        event.remove(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.remove(engine, "handle_error", self._handle_error)
+
+    def reset(self):
+        """
+        Drop every recorded statement.
+
+        return: None
+        """
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self):
+        """
+        Get the statistics of every recorded statement, most total time first.
+
+        return: List of StatementStats
+        """
+        with self._lock:
+            stats = [StatementStats(statement, *values[:4], tuple(values[4])) for statement, values in self._stats.items()]
+        return sorted(stats, key=lambda stats: stats.total_seconds, reverse=True)
+
+    def format_summary(self, limit=None):
+        """
+        Format the statistics as a table.
+
+        param limit: Number of statements to include, None for all
+        return: String
+        """
+        lines = ["{:>8} {:>10} {:>10} {:>10} {:>10}  {}".format("calls", "total s", "mean ms", "max ms", "written", "statement")]
+        for stats in self.summary()[:limit]:
+            lines.append("{:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10}  {}".format(
+                stats.calls, stats.total_seconds, stats.total_seconds / stats.calls * 1000, stats.max_seconds * 1000,
+                "-" if stats.rows_written is None else stats.rows_written, stats.statement))
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """
+        Format the statistics in the Prometheus text exposition format.
+
+        return: String
+        """
+        lines = [
+            "# HELP sql_statement_duration_seconds Latency of SQL statements by normalized statement.",
+            "# TYPE sql_statement_duration_seconds histogram",
+        ]
+        rows = [
+            "# HELP sql_statement_rows_written_total Rows written by INSERT, UPDATE and DELETE statements by normalized statement.",
+            "# TYPE sql_statement_rows_written_total counter",
+        ]
+        for stats in self.summary():
+            label = 'statement="{}"'.format(stats.statement.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), stats.buckets):
+                cumulative += count
+                lines.append('sql_statement_duration_seconds_bucket{{{},le="{}"}} {}'.format(label, "+Inf" if bound == float("inf") else bound, cumulative))
+            lines.append("sql_statement_duration_seconds_sum{{{}}} {}".format(label, stats.total_seconds))
+            lines.append("sql_statement_duration_seconds_count{{{}}} {}".format(label, stats.calls))
+            if stats.rows_written is not None:
+                rows.append("sql_statement_rows_written_total{{{}}} {}".format(label, stats.rows_written))
+        return "\n".join(lines + rows) + "\n"
+
+    def dump_at_exit(self, path=None):
+        """
+        Write the summary when the process exits.
+
+        param path: Output file, *.prom for the Prometheus format, None for a table on stderr
+        return: None
+        """
+        atexit.register(self.dump, path)
+
+    def dump(self, path=None):
+        """
+        Write the summary.
+
+        param path: Output file, *.prom for the Prometheus format, None for a table on stderr
+        return: None
+        """
+        if path is None:
+            print(self.format_summary(), file=sys.stderr)
+            return
+        with open(path, "w") as file:
+            file.write(self.prometheus() if path.endswith(".prom") else self.format_summary() + "\n")
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """
+        Remember when a statement started.
+        """
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """
+        Record the latency and row count of a statement and log it if it was slow.
+
+        Only INSERT, UPDATE and DELETE statements get a row count, the DB-API rowcount of
+        the rows they wrote. The rowcount of a SELECT says nothing about the rows it
+        returned, so reads are left without one instead of reporting 0.
+        """
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        key = normalize_statement(statement)
+        rows = max(cursor.rowcount, 0) if _WRITES.match(key) else None
+        bucket = bisect.bisect_left(self.buckets, elapsed)
+        with self._lock:
+            values = self._stats.get(key)
+            if values is None:
+                values = self._stats[key] = [0, None if rows is None else 0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+            values[0] += 1
+            if rows is not None:
+                values[1] += rows
+            values[2] += elapsed
+            values[3] = max(values[3], elapsed)
+            values[4][bucket] += 1
+        if self.threshold is not None and elapsed > self.threshold:
+            logger.warning("Slow statement (%.3f s): %s\n%s", elapsed, statement, self._query_plan(conn, cursor, statement, parameters, executemany))
+
+    def _handle_error(self, context):
+        """
+        Forget the start time of a statement that failed.
+        """
+        if context.connection is not None and context.cursor is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
+
+    def _query_plan(self, conn, cursor, statement, parameters, executemany):
+        """
+        Get the query plan of a statement on SQLite.
+
+        The plan is read through a new DB-API cursor, so it does not emit engine events.
+
+        param conn: SQLAlchemy connection
+        param cursor: DB-API cursor of the statement
+        param statement: SQL statement
+        param parameters: Parameters of the statement
+        param executemany: Whether the parameters are a list of parameter sets
+        return: Query plan, one step per line
+        """
+        if conn.dialect.name != "sqlite":
+            return ""
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        plan_cursor = cursor.connection.cursor()
+        try:
+            plan_cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            return "\n".join("  " + row[3] for row in plan_cursor.fetchall())
+        except Exception as e:
+            return f"  (no plan: {e})"
+        finally:
+            plan_cursor.close()
+
+def profile_from_environment(engine):
+    """
+    Install the process-wide profiler on an engine if the REALESTATE_PROFILE environment variable is set.
+
+    The variable holds the slow query threshold in seconds. Every engine shares one
+    profiler, whose summary is written at exit to the file named by
+    REALESTATE_PROFILE_OUTPUT, or to stderr.
+
+    param engine: SQLAlchemy engine
+    return: QueryProfiler, or None if profiling is off
+    """
+    global _environment_profiler
+    threshold = os.environ.get(PROFILE_ENV)
+    if not threshold:
+        return None
+    if _environment_profiler is None:
+        _environment_profiler = QueryProfiler(threshold=float(threshold))
+        _environment_profiler.dump_at_exit(os.environ.get(PROFILE_OUTPUT_ENV))
+    _environment_profiler.install(engine)
+    return _environment_profiler
@@ -0,0 +1,322 @@
+import argparse
+import os
+import re
+import shutil
+from contextlib import contextmanager
+from sqlalchemy import Column, Index, MetaData, Table, delete, insert, select
+from sqlalchemy.orm import sessionmaker
+
+from create import Sale, Commission
+from database import create_sqlite_engine
+from queries import get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price
+from rollups import add_sales_to_rollups, rollups_enabled
+
+# Name the routed partition is attached under
+PARTITION_SCHEMA = "sales_partition"
+
+# Tables stored in the partitions instead of the main database
+PARTITIONED_TABLES = (Sale.__table__, Commission.__table__)
+
+_PARTITION_FILE = re.compile(r"^sales_(\d{4})(?:_(\d{2}))?\.db$")
+
+class SalesPartitions:
+    """
+    Sales and commissions stored in one SQLite file per month or per year, next to a main database holding everything else.
+
+    A monthly report only attaches the partition of its month to a connection of the main
+    database, under temporary views named sales and commissions that hide the tables of the
+    main database. The report functions of queries.py run unchanged and only ever see the
+    rows and indexes of that partition, so their latency and the cost of index maintenance
+    on insert depend on the size of one partition, not on the length of the history.
+
+    Attributes:
+        engine (Engine): Engine of the main database
+        directory (str): Directory of the partition files
+        granularity (str): "month" or "year"
+        session_factory (sessionmaker): Factory of the sessions bound to a partition
+        tables (dict): Partition copies of the sales and commissions tables by name
+    """
+
+    def __init__(self, engine, directory, granularity="month", session_factory=None):
+        if granularity not in ("month", "year"):
+            raise ValueError(f"Unknown partition granularity: {granularity}")
+        self.engine = engine
+        self.directory = directory
+        self.granularity = granularity
+        self.session_factory = session_factory or sessionmaker()
+        metadata = MetaData(schema=PARTITION_SCHEMA)
+        self.tables = {table.name: _partition_table(table, metadata) for table in PARTITIONED_TABLES}
+        self._metadata = metadata
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, year, month):
+        """
+        Get the key of the partition holding a month.
+
+        param year: Year
+        param month: Month
+        return: Partition key, YYYY_MM or YYYY
+        """
+        if self.granularity == "year":
+            return f"{year:04d}"
+        return f"{year:04d}_{month:02d}"
+
+    def path(self, key):
+        """
+        Get the file of a partition.
+
+        param key: Partition key
+        return: File path
+        """
+        return os.path.join(self.directory, f"sales_{key}.db")
+
+    def keys(self):
+        """
+        Get the keys of the partitions stored in the directory, oldest first.
+
+        return: List of partition keys
+        """
+        keys = []
+        for name in os.listdir(self.directory):
+            match = _PARTITION_FILE.match(name)
+            if match and (match.group(2) is None) == (self.granularity == "year"):
+                keys.append(name[len("sales_"):-len(".db")])
+        return sorted(keys)
+
+    @contextmanager
+    def session(self, year, month):
+        """
+        Open a session whose sales and commissions are those of the partition of a month.
+
+        A month without a partition reads as empty tables; its partition file is not created.
+
+        param year: Year
+        param month: Month
+        return: Context manager yielding a SQLAlchemy session
+        """
+        with self._attach(self.key(year, month), create=False) as connection:
+            session = self.session_factory(bind=connection)
+            try:
+                yield session
+            finally:
+                session.close()
+
+    def report(self, report, year, month, *args, **kwargs):
+        """
+        Run a monthly report of queries.py on the partition of its month.
+
+        param report: Function taking a session, a year and a month
+        param year: Year
+        param month: Month
+        return: Result of the report
+        """
+        with self.session(year, month) as session:
+            return report(session, year, month, *args, **kwargs)
+
+    def write(self, sales, commissions=(), update_rollups=True, skip_existing=False):
+        """
+        Route sales and their commissions to their partitions and insert them.
+
+        Sales are routed by date_of_sale and commissions with their sale, since the reports
+        join them. The sale of a commission that is not part of the call is looked up in the
+        main database, then in the partitions. Primary keys must be set. Every partition is
+        written in its own transaction.
+
+        param sales: List of sale row dictionaries
+        param commissions: List of commission row dictionaries
+        param update_rollups: Add the sales to the rollup tables if the session factory has rollups enabled
+        param skip_existing: Skip the rows whose primary key is already in their partition instead of failing
+        return: Dictionary of number of sales written by partition key
+        """
+        batches = {}
+        sale_keys = {}
+        for sale in sales:
+            key = self.key(sale["date_of_sale"].year, sale["date_of_sale"].month)
+            sale_keys[sale["sale_id"]] = key
+            batches.setdefault(key, ([], []))[0].append(sale)
+        missing = {commission["sale_id"] for commission in commissions} - sale_keys.keys()
+        if missing:
+            sale_keys.update(self._sale_keys(missing))
+        for commission in commissions:
+            batches.setdefault(sale_keys[commission["sale_id"]], ([], []))[1].append(commission)
+        written = {}
+        for key, (sale_rows, commission_rows) in sorted(batches.items()):
+            with self._attach(key, create=True) as connection:
+                session = self.session_factory(bind=connection)
+                try:
+                    for table, rows in (("sales", sale_rows), ("commissions", commission_rows)):
+                        if rows:
+                            statement = insert(self.tables[table])
+                            if skip_existing:
+                                statement = statement.prefix_with("OR IGNORE")
+                            session.execute(statement, rows)
+                    if update_rollups and rollups_enabled(session):
+                        add_sales_to_rollups(session, [sale["sale_id"] for sale in sale_rows])
+                    session.commit()
+                finally:
+                    session.close()
+            written[key] = len(sale_rows)
+        return written
+
+    def _sale_keys(self, sale_ids):
+        """
+        Find the partition keys of stored sales, from their date_of_sale in the main database or from the partition holding them.
+
+        param sale_ids: Set of sale ids
+        return: Dictionary of partition key by sale id
+        """
+        keys = {}
+        with self.engine.connect() as connection:
+            for sale_id, date_of_sale in connection.execute(select(Sale.sale_id, Sale.date_of_sale).where(Sale.sale_id.in_(sale_ids))):
+                keys[sale_id] = self.key(date_of_sale.year, date_of_sale.month)
+        for key in reversed(self.keys()):
+            missing = sale_ids - keys.keys()
+            if not missing:
+                break
+            with self._attach(key, create=False) as connection:
+                sales = self.tables["sales"]
+                for sale_id, in connection.execute(select(sales.c.sale_id).where(sales.c.sale_id.in_(missing))):
+                    keys[sale_id] = key
+        missing = sale_ids - keys.keys()
+        if missing:
+            raise ValueError(f"Commissions refer to unknown sales: {sorted(missing)}")
+        return keys
+
+    def archive(self, before, directory=None):
+        """
+        Detach the partitions of every month before a given one from the routing.
+
+        Their files are moved to an archive directory, where they remain valid SQLite
+        databases, or deleted.
+
+        param before: First (year, month) that stays routed
+        param directory: Archive directory, None to delete the partitions
+        return: List of archived partition keys
+        """
+        archived = []
+        for key in self.keys():
+            year, _, month = key.partition("_")
+            last_month = (int(year), int(month) if month else 12)
+            if last_month >= tuple(before):
+                continue
+            if directory is None:
+                os.remove(self.path(key))
+            else:
+                os.makedirs(directory, exist_ok=True)
+                shutil.move(self.path(key), os.path.join(directory, os.path.basename(self.path(key))))
+            archived.append(key)
+        return archived
+
+    @contextmanager
+    def _attach(self, key, create):
+        """
+        Attach a partition to a connection of the main database and hide the main sales and commissions tables behind views of it.
+
+        Views in the temp schema take precedence over tables of the main database, so
+        unqualified table names in the report queries resolve to the partition.
+
+        param key: Partition key
+        param create: Create the partition file if it does not exist, otherwise attach an empty in-memory partition
+        return: Context manager yielding a SQLAlchemy connection
+        """
+        path = self.path(key)
+        exists = os.path.exists(path)
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql(f"ATTACH DATABASE ? AS {PARTITION_SCHEMA}", (path if exists or create else ":memory:",))
+            try:
+                if not exists:
+                    self._metadata.create_all(connection)
+                for table in PARTITIONED_TABLES:
+                    connection.exec_driver_sql(f"CREATE TEMP VIEW {table.name} AS SELECT * FROM {PARTITION_SCHEMA}.{table.name}")
+                connection.commit()
+                yield connection
+            finally:
+                connection.rollback()
+                for table in PARTITIONED_TABLES:
+                    connection.exec_driver_sql(f"DROP VIEW IF EXISTS temp.{table.name}")
+                connection.exec_driver_sql(f"DETACH DATABASE {PARTITION_SCHEMA}")
+                connection.commit()
+
+def _partition_table(table, metadata):
+    """
+    Copy the columns and indexes of a table into the partition schema.
+
+    Foreign keys are left out, since the tables they point to live in the main database.
+
+    param table: SQLAlchemy table
+    param metadata: MetaData of the partition schema
+    return: SQLAlchemy table
+    """
+    columns = [Column(column.name, column.type, primary_key=column.primary_key) for column in table.columns]
+    indexes = [Index(index.name, *[column.name for column in index.columns]) for index in table.indexes]
+    return Table(table.name, metadata, *columns, *indexes)
+
+def split_sales(session, partitions, chunk_size=10000):
+    """
+    Move the sales and commissions of the main database into partitions.
+
+    Rows are moved one chunk of sales at a time, in sale_id order, and deleted from the
+    main database right after their partitions are committed. Rows already in their
+    partition are skipped, so a split interrupted between the two steps is resumed by
+    running it again. The rollup tables are left as they are, since the sales they count
+    do not change.
+
+    param session: SQLAlchemy session of the main database
+    param partitions: SalesPartitions
+    param chunk_size: Number of sales moved per chunk
+    return: Number of moved sales
+    """
+    moved = 0
+    last_sale_id = 0
+    while True:
+        sales = [row._asdict() for row in session.execute(
+            select(*Sale.__table__.columns).where(Sale.sale_id > last_sale_id).order_by(Sale.sale_id).limit(chunk_size)
+        )]
+        if not sales:
+            break
+        last_sale_id = sales[-1]["sale_id"]
+        sale_ids = [sale["sale_id"] for sale in sales]
+        commissions = [row._asdict() for row in session.execute(
+            select(*Commission.__table__.columns).where(Commission.sale_id.in_(sale_ids))
+        )]
+        partitions.write(sales, commissions, update_rollups=False, skip_existing=True)
+        session.execute(delete(Commission).where(Commission.sale_id.in_(sale_ids)), execution_options={"synchronize_session": False})
+        session.execute(delete(Sale).where(Sale.sale_id.in_(sale_ids)), execution_options={"synchronize_session": False})
+        session.commit()
+        moved += len(sales)
+    return moved
+
+def main():
+    """
+    Split realestate.db into sales partitions, archive old partitions or run the monthly reports on a partition.
+    """
+    parser = argparse.ArgumentParser(description="Manage the time-partitioned sales storage.")
+    parser.add_argument("--directory", default="sales_partitions", help="directory of the partition files")
+    parser.add_argument("--granularity", choices=("month", "year"), default="month", help="period stored in one partition")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("split", help="move the sales and commissions of realestate.db into partitions")
+    archive_parser = commands.add_parser("archive", help="detach the partitions before a month")
+    archive_parser.add_argument("before", help="first month that stays routed, as YYYY-MM")
+    archive_parser.add_argument("--to", help="archive directory, the partitions are deleted without it")
+    report_parser = commands.add_parser("report", help="run the monthly reports on the partition of a month")
+    report_parser.add_argument("month", help="month of the reports, as YYYY-MM")
+    args = parser.parse_args()
+
+    engine = create_sqlite_engine()
+    partitions = SalesPartitions(engine, args.directory, args.granularity)
+    if args.command == "split":
+        session = sessionmaker(bind=engine)()
+        print(f"{split_sales(session, partitions)} sales moved into {len(partitions.keys())} partitions")
+        session.close()
+    elif args.command == "archive":
+        year, month = map(int, args.before.split("-"))
+        archived = partitions.archive((year, month), args.to)
+        print("Archived partitions: " + (", ".join(archived) or "none"))
+    else:
+        year, month = map(int, args.month.split("-"))
+        for report in (get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price):
+            print(f"{report.__name__}: {partitions.report(report, year, month)}")
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
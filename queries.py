@@ -1,6 +1,80 @@
+import operator
+import weakref
+from collections import namedtuple
 from datetime import date
-from sqlalchemy import func, extract
-from create import Base, Office, EstateAgent, Listing, Sale, Commission, MonthlyCommission
+from itertools import islice
+from sqlalchemy import Integer, and_, cast, delete, func, inspect, literal, select, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from create import Base, Office, EstateAgent, Listing, Sale, Commission, MonthlyCommission, AgentMonthlySales, OfficeMonthlySales
+from rollups import rollups_enabled
+
+# Read-only records returned instead of ORM entities: plain tuples with named fields, no
+# instance state and no identity map entry
+AgentRecord = namedtuple("AgentRecord", ["agent_id", "first_name", "last_name", "email", "phone"])
+AgentSales = namedtuple("AgentSales", ["agent", "sales_count"])
+AgentMonthSales = namedtuple("AgentMonthSales", ["year", "month", "agent", "sales_count"])
+ListingRecord = namedtuple("ListingRecord", [column.key for column in Listing.__table__.columns])
+
+AGENT_COLUMNS = tuple(getattr(EstateAgent, field) for field in AgentRecord._fields)
+LISTING_COLUMNS = tuple(getattr(Listing, field) for field in ListingRecord._fields)
+
+# Engines whose monthly_commission table is known to have the unique (agent_id, year, month) index
+_indexed_engines = weakref.WeakSet()
+
+def month_window(year, month):
+    """
+    Get the first day of a month and the first day of the following month.
+    
+    param year: Year
+    param month: Month
+    return: Tuple of (first day, first day of next month)
+    """
+    first_day = date(year, month, 1)
+    if month == 12:
+        return first_day, date(year + 1, 1, 1)
+    return first_day, date(year, month + 1, 1)
+
+def sold_in_month(year, month):
+    """
+    Filter sales to a given month and year.
+
+    The column is compared against a half-open date range instead of being wrapped in a
+    function, so SQLite can answer it with a range scan on the date_of_sale index.
+    
+    param year: Year
+    param month: Month
+    return: SQLAlchemy filter expression
+    """
+    first_day, next_month = month_window(year, month)
+    return and_(Sale.date_of_sale >= first_day, Sale.date_of_sale < next_month)
+
+def sold_between(start, end):
+    """
+    Filter sales to a range of months.
+    
+    param start: First (year, month) of the range
+    param end: Last (year, month) of the range, inclusive
+    return: SQLAlchemy filter expression
+    """
+    first_day, _ = month_window(*start)
+    _, after_last_day = month_window(*end)
+    return and_(Sale.date_of_sale >= first_day, Sale.date_of_sale < after_last_day)
+
+def sale_year():
+    """
+    Get the year of a sale as an integer expression.
+    
+    return: SQLAlchemy column expression
+    """
+    return cast(func.strftime("%Y", Sale.date_of_sale), Integer)
+
+def sale_month():
+    """
+    Get the month of a sale as an integer expression.
+    
+    return: SQLAlchemy column expression
+    """
+    return cast(func.strftime("%m", Sale.date_of_sale), Integer)
 
 def get_top_offices(session, year, month):
     """
@@ -11,14 +85,21 @@ def get_top_offices(session, year, month):
     param month: Month
     return: List of top offices
     """
+    if rollups_enabled(session):
+        return (
+            session.query(Office.office_id, Office.city, Office.state, OfficeMonthlySales.sales_count.label("sales_count"))
+            .join(OfficeMonthlySales, OfficeMonthlySales.office_id == Office.office_id)
+            .filter(OfficeMonthlySales.year == year, OfficeMonthlySales.month == month, OfficeMonthlySales.sales_count > 0)
+            .order_by(OfficeMonthlySales.sales_count.desc(), Office.office_id.desc())
+            .limit(5)
+        ).all()
     top_offices = (
         session.query(Office.office_id, Office.city, Office.state, func.count(Sale.sale_id).label("sales_count"))
         .join(Listing, Listing.office_id == Office.office_id)
         .join(Sale, Sale.listing_id == Listing.listing_id)
-        .filter(extract("year", Sale.date_of_sale) == year)
-        .filter(extract("month", Sale.date_of_sale) == month)
+        .filter(sold_in_month(year, month))
         .group_by(Office.office_id)
-        .order_by(func.count(Sale.sale_id).desc())
+        .order_by(func.count(Sale.sale_id).desc(), Office.office_id.desc())
         .limit(5)
     ).all()
     return top_offices
@@ -30,18 +111,26 @@ def get_top_agents(session, year, month):
     param session: SQLAlchemy session
     param year: Year
     param month: Month
-    return: List of top agents
+    return: List of AgentSales
     """
+    if rollups_enabled(session):
+        rows = (
+            session.query(*AGENT_COLUMNS, AgentMonthlySales.sales_count)
+            .join(AgentMonthlySales, AgentMonthlySales.agent_id == EstateAgent.agent_id)
+            .filter(AgentMonthlySales.year == year, AgentMonthlySales.month == month, AgentMonthlySales.sales_count > 0)
+            .order_by(AgentMonthlySales.sales_count.desc(), EstateAgent.agent_id)
+            .limit(5)
+        )
+        return [AgentSales(AgentRecord._make(row[:-1]), row[-1]) for row in rows]
     top_agents = (
-        session.query(EstateAgent, func.count(Sale.sale_id).label("sales_count"))
+        session.query(*AGENT_COLUMNS, func.count(Sale.sale_id))
         .join(Sale, Sale.agent_id == EstateAgent.agent_id)
-        .filter(extract("year", Sale.date_of_sale) == year)
-        .filter(extract("month", Sale.date_of_sale) == month)
+        .filter(sold_in_month(year, month))
         .group_by(EstateAgent.agent_id)
-        .order_by(func.count(Sale.sale_id).desc())
+        .order_by(func.count(Sale.sale_id).desc(), EstateAgent.agent_id)
         .limit(5)
-    ).all()
-    return top_agents
+    )
+    return [AgentSales(AgentRecord._make(row[:-1]), row[-1]) for row in top_agents]
 
 def get_average_days_on_market(session, year, month):
     """
@@ -52,11 +141,15 @@ def get_average_days_on_market(session, year, month):
     param month: Month
     return: Average number of days on market
     """
+    if rollups_enabled(session):
+        return (
+            session.query(func.sum(OfficeMonthlySales.days_on_market_sum) * 1.0 / func.sum(OfficeMonthlySales.days_on_market_count))
+            .filter(OfficeMonthlySales.year == year, OfficeMonthlySales.month == month)
+        ).scalar()
     average_days_on_market = (
         session.query(func.avg(func.julianday(Sale.date_of_sale) - func.julianday(Listing.date_of_listing)).label("average_days_on_market"))
         .join(Listing, Listing.listing_id == Sale.listing_id)
-        .filter(extract("year", Sale.date_of_sale) == year)
-        .filter(extract("month", Sale.date_of_sale) == month)
+        .filter(sold_in_month(year, month))
     ).scalar()
     return average_days_on_market
 
@@ -69,69 +162,539 @@ def get_average_selling_price(session, year, month):
     param month: Month
     return: Average selling price
     """
+    if rollups_enabled(session):
+        return (
+            session.query(func.sum(AgentMonthlySales.price_sum) / func.sum(AgentMonthlySales.sales_count))
+            .filter(AgentMonthlySales.year == year, AgentMonthlySales.month == month)
+        ).scalar()
     average_selling_price = (
         session.query(func.avg(Sale.sale_price).label("average_selling_price"))
-        .filter(extract("year", Sale.date_of_sale) == year)
-        .filter(extract("month", Sale.date_of_sale) == month)
+        .filter(sold_in_month(year, month))
     ).scalar()
     return average_selling_price
 
 def insert_monthly_commissions(session, year, month):
     """
     Insert monthly commissions into the MonthlyCommission table.
+
+    The whole month is written with one INSERT ... SELECT ... GROUP BY statement that
+    updates the total of agents who already have a row for the month. With rollups
+    enabled, the totals are read from agent_monthly_sales instead of the commissions.
     
     param session: SQLAlchemy session
     param year: Year
     param month: Month
     return: List of monthly commissions
     """
-    x = session.query(Commission).join(Sale, Sale.sale_id == Commission.sale_id).all()
-    monthly_commissions = (
-        session.query(
-            Commission.agent_id,
-            func.sum(Commission.commission_amount).label("total_commission")
+    _ensure_monthly_commission_index(session)
+    if rollups_enabled(session):
+        totals = (
+            select(AgentMonthlySales.agent_id, literal(year), literal(month), AgentMonthlySales.commission_sum)
+            .where(AgentMonthlySales.year == year, AgentMonthlySales.month == month, AgentMonthlySales.commission_count > 0)
         )
-        .join(Sale, Sale.sale_id == Commission.sale_id)
-        .filter(extract("year", Sale.date_of_sale) == year)
-        .filter(extract("month", Sale.date_of_sale) == month)
-        .group_by(Commission.agent_id)
+    else:
+        totals = (
+            select(
+                Commission.agent_id,
+                literal(year),
+                literal(month),
+                func.sum(Commission.commission_amount).label("total_commission")
+            )
+            .join(Sale, Sale.sale_id == Commission.sale_id)
+            .where(sold_in_month(year, month))
+            .group_by(Commission.agent_id)
+        )
+    statement = insert(MonthlyCommission).from_select(["agent_id", "year", "month", "total_commission"], totals)
+    statement = (
+        statement.on_conflict_do_update(
+            index_elements=["agent_id", "year", "month"],
+            set_={"total_commission": statement.excluded.total_commission},
+        )
+        .returning(MonthlyCommission.agent_id, MonthlyCommission.total_commission)
+    )
+    monthly_commissions = sorted(session.execute(statement).all())
+    session.commit()
+
+    return monthly_commissions
+
+def store_monthly_commissions(session, year, month, monthly_commissions):
+    """
+    Store computed monthly commissions in the MonthlyCommission table, replacing the
+    totals of agents who already have a row for the month.
+    
+    param session: SQLAlchemy session
+    param year: Year
+    param month: Month
+    param monthly_commissions: List of (agent_id, total_commission) pairs
+    return: None
+    """
+    if monthly_commissions:
+        _ensure_monthly_commission_index(session)
+        statement = insert(MonthlyCommission)
+        statement = statement.on_conflict_do_update(
+            index_elements=["agent_id", "year", "month"],
+            set_={"total_commission": statement.excluded.total_commission},
+        )
+        session.execute(statement, [
+            {"agent_id": agent_id, "year": year, "month": month, "total_commission": total_commission}
+            for agent_id, total_commission in monthly_commissions
+        ])
+    session.commit()
+
+def migrate_monthly_commissions(session):
+    """
+    Add the unique (agent_id, year, month) index to a monthly_commission table created before it.
+
+    create_all() does not change existing tables, and the upserts of insert_monthly_commissions(),
+    insert_monthly_commissions_range() and store_monthly_commissions() fail without the index.
+    Duplicate rows of an agent and month, left by the inserts that predate it, are deleted
+    first, keeping the last one written. A table that already has the constraint is left as
+    it is. The upserts run this themselves once per engine, so calling it is only needed to
+    migrate ahead of time.
+
+    param session: SQLAlchemy session
+    return: Number of deleted duplicate rows
+    """
+    deleted = _migrate_monthly_commissions(session.connection())
+    session.commit()
+    return deleted or 0
+
+def _ensure_monthly_commission_index(session):
+    """
+    Migrate the monthly_commission table on the first upsert of an engine, without committing.
+
+    An engine is only remembered once the index is found in place, so a migration rolled back
+    with the caller's transaction is run again by the next upsert.
+
+    param session: SQLAlchemy session
+    return: None
+    """
+    connection = session.connection()
+    if connection.engine not in _indexed_engines and _migrate_monthly_commissions(connection) is None:
+        _indexed_engines.add(connection.engine)
+
+def _migrate_monthly_commissions(connection):
+    """
+    Deduplicate the monthly_commission table and create its unique index if it has none.
+
+    param connection: SQLAlchemy connection
+    return: Number of deleted duplicate rows, None if the index was already there
+    """
+    inspector = inspect(connection)
+    unique = [constraint["column_names"] for constraint in inspector.get_unique_constraints(MonthlyCommission.__tablename__)]
+    unique += [index["column_names"] for index in inspector.get_indexes(MonthlyCommission.__tablename__) if index["unique"]]
+    if ["agent_id", "year", "month"] in unique:
+        return None
+    latest = (
+        select(func.max(MonthlyCommission.monthly_commission_id))
+        .group_by(MonthlyCommission.agent_id, MonthlyCommission.year, MonthlyCommission.month)
+    )
+    deleted = connection.execute(delete(MonthlyCommission).where(MonthlyCommission.monthly_commission_id.not_in(latest))).rowcount
+    connection.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_monthly_commission_agent_month ON monthly_commission (agent_id, year, month)"
+    )
+    return deleted
+
+def get_top_offices_by_month(session, start, end):
+    """
+    Get the top 5 offices by number of sales for every month of a range.
+
+    All months are grouped in one query over a single range scan of date_of_sale, and
+    ROW_NUMBER() OVER (PARTITION BY year, month) picks the top 5 of each month.
+    
+    param session: SQLAlchemy session
+    param start: First (year, month) of the range
+    param end: Last (year, month) of the range, inclusive
+    return: List of (year, month, office_id, city, state, sales_count) rows
+    """
+    year, month = sale_year(), sale_month()
+    sales_count = func.count(Sale.sale_id)
+    ranked = (
+        select(
+            year.label("year"),
+            month.label("month"),
+            Listing.office_id,
+            sales_count.label("sales_count"),
+            func.row_number().over(partition_by=(year, month), order_by=(sales_count.desc(), Listing.office_id.desc())).label("rank"),
+        )
+        .join(Listing, Listing.listing_id == Sale.listing_id)
+        .where(sold_between(start, end))
+        .group_by(year, month, Listing.office_id)
+    ).subquery()
+    return (
+        session.query(ranked.c.year, ranked.c.month, Office.office_id, Office.city, Office.state, ranked.c.sales_count)
+        .join(Office, Office.office_id == ranked.c.office_id)
+        .filter(ranked.c.rank <= 5)
+        .order_by(ranked.c.year, ranked.c.month, ranked.c.rank)
     ).all()
 
-    for agent_id, total_commission in monthly_commissions:
-        if session.query(MonthlyCommission).filter(MonthlyCommission.agent_id == agent_id).filter(MonthlyCommission.year == year).filter(MonthlyCommission.month == month).count() > 0:
-            continue
-        monthly_commission = MonthlyCommission(
-            agent_id=agent_id,
-            year=year,
-            month=month,
-            total_commission=total_commission
+def get_top_agents_by_month(session, start, end):
+    """
+    Get the top 5 agents by number of sales for every month of a range.
+    
+    param session: SQLAlchemy session
+    param start: First (year, month) of the range
+    param end: Last (year, month) of the range, inclusive
+    return: List of AgentMonthSales
+    """
+    year, month = sale_year(), sale_month()
+    sales_count = func.count(Sale.sale_id)
+    ranked = (
+        select(
+            year.label("year"),
+            month.label("month"),
+            Sale.agent_id,
+            sales_count.label("sales_count"),
+            func.row_number().over(partition_by=(year, month), order_by=(sales_count.desc(), Sale.agent_id)).label("rank"),
         )
-        session.add(monthly_commission)
+        .where(sold_between(start, end))
+        .group_by(year, month, Sale.agent_id)
+    ).subquery()
+    rows = (
+        session.query(ranked.c.year, ranked.c.month, *AGENT_COLUMNS, ranked.c.sales_count)
+        .join(EstateAgent, EstateAgent.agent_id == ranked.c.agent_id)
+        .filter(ranked.c.rank <= 5)
+        .order_by(ranked.c.year, ranked.c.month, ranked.c.rank)
+    )
+    return [AgentMonthSales(row[0], row[1], AgentRecord._make(row[2:-1]), row[-1]) for row in rows]
+
+def get_average_days_on_market_by_month(session, start, end):
+    """
+    Get the average number of days on market for every month of a range.
+    
+    param session: SQLAlchemy session
+    param start: First (year, month) of the range
+    param end: Last (year, month) of the range, inclusive
+    return: List of (year, month, average_days_on_market) rows
+    """
+    year, month = sale_year(), sale_month()
+    return (
+        session.query(year.label("year"), month.label("month"), func.avg(func.julianday(Sale.date_of_sale) - func.julianday(Listing.date_of_listing)).label("average_days_on_market"))
+        .join(Listing, Listing.listing_id == Sale.listing_id)
+        .filter(sold_between(start, end))
+        .group_by(year, month)
+        .order_by(year, month)
+    ).all()
 
+def get_average_selling_price_by_month(session, start, end):
+    """
+    Get the average selling price for every month of a range.
+    
+    param session: SQLAlchemy session
+    param start: First (year, month) of the range
+    param end: Last (year, month) of the range, inclusive
+    return: List of (year, month, average_selling_price) rows
+    """
+    year, month = sale_year(), sale_month()
+    return (
+        session.query(year.label("year"), month.label("month"), func.avg(Sale.sale_price).label("average_selling_price"))
+        .filter(sold_between(start, end))
+        .group_by(year, month)
+        .order_by(year, month)
+    ).all()
+
+def insert_monthly_commissions_range(session, start, end):
+    """
+    Insert the monthly commissions of every month of a range with one statement.
+    
+    param session: SQLAlchemy session
+    param start: First (year, month) of the range
+    param end: Last (year, month) of the range, inclusive
+    return: List of (year, month, agent_id, total_commission) rows
+    """
+    _ensure_monthly_commission_index(session)
+    year, month = sale_year(), sale_month()
+    totals = (
+        select(
+            Commission.agent_id,
+            year,
+            month,
+            func.sum(Commission.commission_amount).label("total_commission")
+        )
+        .join(Sale, Sale.sale_id == Commission.sale_id)
+        .where(sold_between(start, end))
+        .group_by(year, month, Commission.agent_id)
+    )
+    statement = insert(MonthlyCommission).from_select(["agent_id", "year", "month", "total_commission"], totals)
+    statement = (
+        statement.on_conflict_do_update(
+            index_elements=["agent_id", "year", "month"],
+            set_={"total_commission": statement.excluded.total_commission},
+        )
+        .returning(MonthlyCommission.year, MonthlyCommission.month, MonthlyCommission.agent_id, MonthlyCommission.total_commission)
+    )
+    monthly_commissions = sorted(session.execute(statement).all())
     session.commit()
 
     return monthly_commissions
 
-def print_monthly_commissions(session, monthly_commissions):
+OfficeSales = namedtuple("OfficeSales", ["office_id", "city", "state", "sales_count"])
+
+MonthlyReportResult = namedtuple("MonthlyReportResult", [
+    "top_offices",
+    "top_agents",
+    "average_days_on_market",
+    "average_selling_price",
+    "monthly_commissions",
+])
+
+class MonthlyReport:
+    """
+    All monthly KPIs computed from a single pass over the month's sales.
+
+    The sales of the month are streamed once, joined to their listing and commission,
+    and the results of get_top_offices, get_top_agents, get_average_days_on_market,
+    get_average_selling_price and the commission totals of insert_monthly_commissions
+    are accumulated together. Only the names of the top 5 offices and agents are
+    looked up afterwards. Ties in the top 5 are ordered like the SQL reports.
+    
+    Attributes:
+        session: SQLAlchemy session
+        year (int): Year
+        month (int): Month
+        chunk_size (int): Number of rows fetched per round trip
+    """
+
+    def __init__(self, session, year, month, chunk_size=1000):
+        self.session = session
+        self.year = year
+        self.month = month
+        self.chunk_size = chunk_size
+
+    def run(self):
+        """
+        Stream the month's sales and compute every KPI.
+        
+        return: MonthlyReportResult
+        """
+        office_sales = {}
+        agent_sales = {}
+        agent_commissions = {}
+        sales_count = 0
+        price_sum = 0.0
+        days_count = 0
+        days_sum = 0
+        last_sale_id = None
+        rows = self.session.execute(
+            select(
+                Sale.sale_id,
+                Sale.agent_id,
+                Sale.sale_price,
+                Sale.date_of_sale,
+                Listing.office_id,
+                Listing.date_of_listing,
+                Commission.agent_id,
+                Commission.commission_amount,
+            )
+            .outerjoin(Listing, Listing.listing_id == Sale.listing_id)
+            .outerjoin(Commission, Commission.sale_id == Sale.sale_id)
+            .where(sold_in_month(self.year, self.month))
+            .order_by(Sale.date_of_sale, Sale.sale_id)
+            .execution_options(yield_per=self.chunk_size)
+        )
+        for sale_id, agent_id, sale_price, date_of_sale, office_id, date_of_listing, commission_agent_id, commission_amount in rows:
+            if commission_agent_id is not None:
+                agent_commissions[commission_agent_id] = agent_commissions.get(commission_agent_id, 0.0) + commission_amount
+            # A sale with several commissions comes back once per commission
+            if sale_id == last_sale_id:
+                continue
+            last_sale_id = sale_id
+            if sale_price is not None:
+                sales_count += 1
+                price_sum += sale_price
+            if agent_id is not None:
+                agent_sales[agent_id] = agent_sales.get(agent_id, 0) + 1
+            if office_id is not None:
+                office_sales[office_id] = office_sales.get(office_id, 0) + 1
+            if date_of_sale is not None and date_of_listing is not None:
+                days_count += 1
+                days_sum += (date_of_sale - date_of_listing).days
+
+        return MonthlyReportResult(
+            top_offices=self._top_offices(office_sales),
+            top_agents=self._top_agents(agent_sales),
+            average_days_on_market=days_sum / days_count if days_count else None,
+            average_selling_price=price_sum / sales_count if sales_count else None,
+            monthly_commissions=sorted(agent_commissions.items()),
+        )
+
+    def _top_offices(self, office_sales):
+        """
+        Look up the top 5 offices by number of sales.
+        
+        param office_sales: Dictionary of sales count by office id
+        return: List of OfficeSales
+        """
+        def lookup(office_ids):
+            query = self.session.query(Office.office_id, Office.city, Office.state).filter(Office.office_id.in_(office_ids))
+            return {office_id: (city, state) for office_id, city, state in query}
+        return [OfficeSales(office_id, *office, count) for office_id, office, count in self._top(office_sales, lookup, descending_keys=True)]
+
+    def _top_agents(self, agent_sales):
+        """
+        Look up the top 5 agents by number of sales.
+        
+        param agent_sales: Dictionary of sales count by agent id
+        return: List of AgentSales
+        """
+        def lookup(agent_ids):
+            return {row.agent_id: AgentRecord._make(row) for row in self.session.query(*AGENT_COLUMNS).filter(EstateAgent.agent_id.in_(agent_ids))}
+        return [AgentSales(agent, count) for _, agent, count in self._top(agent_sales, lookup)]
+
+    def _top(self, counts, lookup, descending_keys=False, limit=5):
+        """
+        Get the top ids by count among those found by a lookup.
+
+        Ids missing from their table are skipped before the top is cut, like the join of
+        the SQL reports skips them, so a sale of a deleted agent never shortens the list.
+        The ids are looked up limit at a time in ranking order, which takes one query
+        unless some are missing.
+
+        param counts: Dictionary of sales count by id
+        param lookup: Function taking a list of ids and returning a dictionary of record by id
+        param descending_keys: Order ties by descending id
+        param limit: Number of ids to return
+        return: List of (id, record, count) tuples
+        """
+        ranked = top_counts(counts, limit=len(counts), descending_keys=descending_keys)
+        top = []
+        for start in range(0, len(ranked), limit):
+            chunk = ranked[start:start + limit]
+            records = lookup([key for key, _ in chunk])
+            top.extend((key, records[key], count) for key, count in chunk if key in records)
+            if len(top) >= limit:
+                break
+        return top[:limit]
+
+def top_counts(counts, limit=5, descending_keys=False):
+    """
+    Get the keys with the highest counts, ties ordered by key.
+    
+    param counts: Dictionary of count by key
+    param limit: Number of keys to return
+    param descending_keys: Order ties by descending key
+    return: List of (key, count) pairs
+    """
+    if descending_keys:
+        return sorted(counts.items(), key=lambda item: (-item[1], -item[0]))[:limit]
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+def print_monthly_commissions(session, monthly_commissions, chunk_size=10000, file=None):
     """"
     Print monthly commissions.
+
+    Agent names are looked up with one IN query per chunk of rows instead of one query
+    per agent, and rows are printed as they are read.
     
     param session: SQLAlchemy session
-    param monthly_commissions: List of monthly commissions
+    param monthly_commissions: Iterable of (agent_id, total_commission) pairs
+    param chunk_size: Number of agents looked up per query
+    param file: Stream to print to, defaults to standard output
     """
-    print("\nMonthly Commissions:")
-    print("{:<10} {:<20} {:<20} {:<20}".format("Agent ID", "First Name", "Last Name", "Total Commission"))
+    print("\nMonthly Commissions:", file=file)
+    print("{:<10} {:<20} {:<20} {:<20}".format("Agent ID", "First Name", "Last Name", "Total Commission"), file=file)
 
-    for agent_id, total_commission in monthly_commissions:
-        agent = session.query(EstateAgent).filter(EstateAgent.agent_id == agent_id).one()
-        print("{:<10} {:<20} {:<20} ${:<20,.2f}".format(agent_id, agent.first_name, agent.last_name, total_commission))
+    rows = iter(monthly_commissions)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        names = {
+            agent_id: (first_name, last_name)
+            for agent_id, first_name, last_name in session.execute(
+                select(EstateAgent.agent_id, EstateAgent.first_name, EstateAgent.last_name)
+                .where(EstateAgent.agent_id.in_([agent_id for agent_id, _ in chunk]))
+            )
+        }
+        for agent_id, total_commission in chunk:
+            first_name, last_name = names.get(agent_id, ("", ""))
+            print("{:<10} {:<20} {:<20} ${:<20,.2f}".format(agent_id, first_name, last_name, total_commission), file=file)
+
+ListingPage = namedtuple("ListingPage", ["listings", "next_key"])
+
+def listing_filters(zip_code=None, min_price=None, max_price=None, min_bedrooms=None, max_bedrooms=None,
+                    min_bathrooms=None, max_bathrooms=None, status=None, listed_from=None, listed_to=None):
+    """
+    Build the filter conditions of a listing search. Every bound is inclusive and None leaves it open.
+
+    param zip_code: Zip code
+    param min_price: Lowest listing price
+    param max_price: Highest listing price
+    param min_bedrooms: Fewest bedrooms
+    param max_bedrooms: Most bedrooms
+    param min_bathrooms: Fewest bathrooms
+    param max_bathrooms: Most bathrooms
+    param status: Listing status
+    param listed_from: Earliest date of listing
+    param listed_to: Latest date of listing
+    return: List of SQLAlchemy conditions
+    """
+    bounds = (
+        (Listing.zip_code, operator.eq, zip_code), (Listing.status, operator.eq, status),
+        (Listing.listing_price, operator.ge, min_price), (Listing.listing_price, operator.le, max_price),
+        (Listing.bedrooms, operator.ge, min_bedrooms), (Listing.bedrooms, operator.le, max_bedrooms),
+        (Listing.bathrooms, operator.ge, min_bathrooms), (Listing.bathrooms, operator.le, max_bathrooms),
+        (Listing.date_of_listing, operator.ge, listed_from), (Listing.date_of_listing, operator.le, listed_to),
+    )
+    return [compare(column, value) for column, compare, value in bounds if value is not None]
+
+def search_listings(session, after=None, limit=50, records=False, **filters):
+    """
+    Get one page of listings matching the filters, cheapest first.
+
+    Pages are keyset paginated on (listing_price, listing_id): pass the next_key of a page
+    as after to get the following one. Every page is an index range scan that starts where
+    the previous one stopped, so deep pages cost the same as the first one.
+
+    param session: SQLAlchemy session
+    param after: (listing_price, listing_id) of the last listing of the previous page, None for the first page
+    param limit: Number of listings per page
+    param records: Return read-only ListingRecords that skip the identity map instead of Listing entities
+    param filters: Keyword arguments of listing_filters()
+    return: ListingPage of listings and the key of the next page, None on the last page
+    """
+    query = (select(*LISTING_COLUMNS) if records else select(Listing)).where(*listing_filters(**filters))
+    if after is not None:
+        query = query.where(tuple_(Listing.listing_price, Listing.listing_id) > tuple_(*after))
+    result = session.execute(query.order_by(Listing.listing_price, Listing.listing_id).limit(limit + 1))
+    listings = [ListingRecord._make(row) for row in result] if records else result.scalars().all()
+    if len(listings) <= limit:
+        return ListingPage(listings, None)
+    listings = listings[:limit]
+    return ListingPage(listings, (listings[-1].listing_price, listings[-1].listing_id))
+
+def iter_listings(session, chunk_size=1000, records=False, **filters):
+    """
+    Stream every listing matching the filters, cheapest first, in constant memory.
+
+    Rows are fetched chunk_size at a time from one cursor with yield_per, so only one
+    chunk of listings is held in memory.
+
+    param session: SQLAlchemy session
+    param chunk_size: Number of listings fetched per round trip
+    param records: Yield read-only ListingRecords that skip the identity map instead of Listing entities
+    param filters: Keyword arguments of listing_filters()
+    return: Generator of listings
+    """
+    query = (
+        (select(*LISTING_COLUMNS) if records else select(Listing))
+        .where(*listing_filters(**filters))
+        .order_by(Listing.listing_price, Listing.listing_id)
+        .execution_options(yield_per=chunk_size)
+    )
+    if records:
+        for row in session.execute(query):
+            yield ListingRecord._make(row)
+        return
+    for listing in session.scalars(query):
+        yield listing
 
 
 # Example usage
 if __name__ == "__main__":
-    from sqlalchemy import create_engine
     from sqlalchemy.orm import sessionmaker
-    engine = create_engine("sqlite:///realestate.db")
+    from database import create_sqlite_engine
+    engine = create_sqlite_engine()
 
     # Create tables if they don't exist
     Base.metadata.create_all(engine)
@@ -141,11 +704,14 @@ if __name__ == "__main__":
     current_year = date.today().year
     current_month = date.today().month
 
-    top_offices = get_top_offices(session, current_year, current_month)
-    top_agents = get_top_agents(session, current_year, current_month)
-    average_days_on_market = get_average_days_on_market(session, current_year, current_month)
-    average_selling_price = get_average_selling_price(session, current_year, current_month)
-    monthly_commissions = insert_monthly_commissions(session, current_year, current_month)
+    # One pass over the month's sales computes every KPI
+    report = MonthlyReport(session, current_year, current_month).run()
+    top_offices = report.top_offices
+    top_agents = report.top_agents
+    average_days_on_market = report.average_days_on_market
+    average_selling_price = report.average_selling_price
+    monthly_commissions = report.monthly_commissions
+    store_monthly_commissions(session, current_year, current_month, monthly_commissions)
 
 
     print("Top 5 Offices with the most sales for the month:")
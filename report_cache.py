@@ -0,0 +1,145 @@
+from collections import OrderedDict, namedtuple
+from datetime import date
+from functools import wraps
+from sqlalchemy import event, select
+
+from create import Listing, Sale, Commission
+from rollups import attribute_values
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+class ReportCache:
+    """
+    Read-through LRU cache of monthly report results for closed months.
+
+    Results are keyed by (report, year, month). Only months before the current one are
+    cached, since the current month still receives sales. Sessions the cache is installed
+    on invalidate every month touched by an inserted, updated or deleted Sale, Listing or
+    Commission after each flush; a commission touches the month of its sale. Use one
+    cache per database. The reports return named tuples and numbers, which hold no
+    session state, so results are cached and shared as they are.
+
+    Bulk core inserts do not flush ORM instances, so the rows written by
+    insert.write_batch(), importer.CsvImporter and SalesPartitions.write() do not
+    invalidate anything; call invalidate() for their months, or clear(), after them.
+
+    Attributes:
+        maxsize (int): Maximum number of cached results
+        hits (int): Number of results served from the cache
+        misses (int): Number of results computed by the report function
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def install(self, target):
+        """
+        Invalidate cached months whenever a session flushes report data.
+
+        param target: Session or sessionmaker
+        return: None
+        """
+        event.listen(target, "after_flush", self._after_flush)
+
+    def wrap(self, report):
+        """
+        Wrap a report function taking (session, year, month) with the cache.
+
+        param report: Report function
+        return: Cached report function
+        """
+        @wraps(report)
+        def cached_report(session, year, month):
+            return self.get(report, session, year, month)
+        return cached_report
+
+    def get(self, report, session, year, month):
+        """
+        Get a report result from the cache, computing and storing it on a miss.
+
+        param report: Report function
+        param session: SQLAlchemy session
+        param year: Year
+        param month: Month
+        return: Report result
+        """
+        today = date.today()
+        if (year, month) >= (today.year, today.month):
+            return report(session, year, month)
+        key = (report, year, month)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        result = self._entries[key] = report(session, year, month)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return result
+
+    def invalidate(self, year, month):
+        """
+        Drop every cached result of a month.
+
+        param year: Year
+        param month: Month
+        return: None
+        """
+        for key in [key for key in self._entries if key[1:] == (year, month)]:
+            del self._entries[key]
+
+    def clear(self):
+        """
+        Drop every cached result and reset the counters.
+
+        return: None
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        Get the hit/miss counters and size of the cache.
+
+        return: CacheInfo
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def _after_flush(self, session, flush_context):
+        """
+        Invalidate the months of every sale, listing or commission written by a flush.
+
+        Commissions invalidate the month of the date_of_sale of their sale.
+
+        param session: SQLAlchemy session
+        param flush_context: Flush context
+        return: None
+        """
+        dates = set()
+        listing_ids = set()
+        sale_ids = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Sale):
+                dates.update(attribute_values(obj, "date_of_sale"))
+            elif isinstance(obj, Commission):
+                # Reports put a commission in the month of its sale, not of its commission_date
+                sale_ids.update(attribute_values(obj, "sale_id"))
+            elif isinstance(obj, Listing) and obj not in session.new:
+                listing_ids.update(attribute_values(obj, "listing_id"))
+        listing_ids.discard(None)
+        sale_ids.discard(None)
+        if listing_ids:
+            dates.update(session.connection().execute(
+                select(Sale.date_of_sale).where(Sale.listing_id.in_(listing_ids)).distinct()
+            ).scalars())
+        if sale_ids:
+            dates.update(session.connection().execute(
+                select(Sale.date_of_sale).where(Sale.sale_id.in_(sale_ids)).distinct()
+            ).scalars())
+        for day in dates:
+            if day is not None:
+                self.invalidate(day.year, day.month)
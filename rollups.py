@@ -0,0 +1,271 @@
+import argparse
+import math
+from sqlalchemy import Integer, cast, event, func, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import sessionmaker
+
+from database import create_sqlite_engine
+from create import Base, Listing, Sale, Commission, AgentMonthlySales, OfficeMonthlySales
+
+# Maximum number of ids bound into one IN clause
+CHUNK_SIZE = 500
+
+ROLLUP_COLUMNS = ("sales_count", "price_sum", "days_on_market_sum", "days_on_market_count", "commission_sum", "commission_count")
+
+# Rollup values of a key without sales or commissions
+EMPTY_ROLLUP = (0, 0.0, 0, 0, 0.0, 0)
+
+def enable_rollups(target):
+    """
+    Maintain the monthly rollup tables on every flush and let the report queries read them.
+
+    Sales and commissions written through the ORM are applied in the same transaction by
+    session events. Rows written with bulk inserts must be passed to add_sales_to_rollups.
+
+    param target: Session or sessionmaker
+    return: None
+    """
+    info = target.kw.setdefault("info", {}) if isinstance(target, sessionmaker) else target.info
+    # The info flag rather than event.contains() guards against registering twice, since
+    # the event registry can match a new sessionmaker reusing the id() of a collected one
+    if not info.get("rollups"):
+        info["rollups"] = True
+        event.listen(target, "before_flush", _before_flush)
+        event.listen(target, "after_flush", _after_flush)
+
+def rollups_enabled(session):
+    """
+    Check whether a session maintains and reads the monthly rollup tables.
+
+    param session: SQLAlchemy session
+    return: True if rollups are enabled
+    """
+    return session.info.get("rollups", False)
+
+def add_sales_to_rollups(session, sale_ids):
+    """
+    Add bulk inserted sales and their commissions to the rollup tables.
+
+    param session: SQLAlchemy session
+    param sale_ids: Ids of the inserted sales
+    return: None
+    """
+    _update_rollups(session.connection(), set(sale_ids), set(), 1)
+
+def remove_sales_from_rollups(session, sale_ids):
+    """
+    Subtract sales and their commissions from the rollup tables before a bulk update.
+
+    param session: SQLAlchemy session
+    param sale_ids: Ids of the sales about to be updated
+    return: None
+    """
+    _update_rollups(session.connection(), set(sale_ids), set(), -1)
+
+def rebuild_rollups(session):
+    """
+    Recompute the rollup tables from the sales and commissions tables.
+
+    The tables are dropped and created again, so a database whose rollup tables predate
+    a new rollup column gets the current schema.
+
+    param session: SQLAlchemy session
+    return: None
+    """
+    connection = session.connection()
+    for model in (AgentMonthlySales, OfficeMonthlySales):
+        model.__table__.drop(connection, checkfirst=True)
+        model.__table__.create(connection)
+    for model, rows in _contributions(connection, None).items():
+        _upsert(connection, model, rows, 1)
+    session.commit()
+
+def verify_rollups(session):
+    """
+    Compare the rollup tables with the sales and commissions tables.
+
+    param session: SQLAlchemy session
+    return: List of (table, key, expected values, stored values) for every mismatch
+    """
+    mismatches = []
+    for model, expected in _contributions(session.connection(), None).items():
+        key_columns = list(model.__table__.primary_key.columns)
+        stored = {
+            tuple(row[:3]): tuple(row[3:])
+            for row in session.execute(select(*key_columns, *[getattr(model, column) for column in ROLLUP_COLUMNS]))
+        }
+        for key in set(expected) | set(stored):
+            expected_values = expected.get(key, EMPTY_ROLLUP)
+            stored_values = stored.get(key, EMPTY_ROLLUP)
+            if not all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6) for a, b in zip(expected_values, stored_values)):
+                mismatches.append((model.__tablename__, key, expected_values, stored_values))
+    return mismatches
+
+def _before_flush(session, flush_context, instances):
+    """
+    Subtract the rollup contribution of every sale the flush is about to change.
+
+    param session: SQLAlchemy session
+    param flush_context: Flush context
+    param instances: Unused
+    return: None
+    """
+    sale_ids = set()
+    listing_ids = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Sale):
+            sale_ids.add(obj.sale_id)
+        elif isinstance(obj, Commission):
+            sale_ids.update(attribute_values(obj, "sale_id"))
+        elif isinstance(obj, Listing):
+            listing_ids.add(obj.listing_id)
+    for obj in session.new:
+        if isinstance(obj, Commission):
+            sale_ids.update(attribute_values(obj, "sale_id"))
+    sale_ids.discard(None)
+    listing_ids.discard(None)
+    session.info["rollup_pending"] = (sale_ids, listing_ids)
+    if sale_ids or listing_ids:
+        _update_rollups(session.connection(), sale_ids, listing_ids, -1)
+
+def _after_flush(session, flush_context):
+    """
+    Add back the rollup contribution of every sale the flush changed or inserted.
+
+    param session: SQLAlchemy session
+    param flush_context: Flush context
+    return: None
+    """
+    sale_ids, listing_ids = session.info.pop("rollup_pending", (set(), set()))
+    for obj in session.new:
+        if isinstance(obj, Sale):
+            sale_ids.add(obj.sale_id)
+        elif isinstance(obj, Commission):
+            sale_ids.add(obj.sale_id)
+    for obj in session.dirty:
+        if isinstance(obj, Commission):
+            sale_ids.add(obj.sale_id)
+    sale_ids.discard(None)
+    if sale_ids or listing_ids:
+        _update_rollups(session.connection(), sale_ids, listing_ids, 1)
+
+def attribute_values(obj, key):
+    """
+    Get the current and previous values of an attribute, so a flush handler sees both the old and the new row.
+
+    param obj: ORM instance
+    param key: Attribute name
+    return: Set of values
+    """
+    history = inspect(obj).attrs[key].history
+    return set(history.added) | set(history.unchanged) | set(history.deleted)
+
+def _update_rollups(connection, sale_ids, listing_ids, sign):
+    """
+    Add or subtract the contribution of a set of sales to the rollup tables.
+
+    param connection: SQLAlchemy connection
+    param sale_ids: Ids of the sales
+    param listing_ids: Ids of listings whose sales are included as well
+    param sign: 1 to add, -1 to subtract
+    return: None
+    """
+    # Listings are resolved to their sales first, so a sale matched both ways is counted once
+    sale_ids = set(sale_ids)
+    listing_ids = list(listing_ids)
+    for start in range(0, len(listing_ids), CHUNK_SIZE):
+        sale_ids.update(connection.execute(select(Sale.sale_id).where(Sale.listing_id.in_(listing_ids[start:start + CHUNK_SIZE]))).scalars())
+    sale_ids = sorted(sale_ids)
+    for start in range(0, len(sale_ids), CHUNK_SIZE):
+        condition = Sale.sale_id.in_(sale_ids[start:start + CHUNK_SIZE])
+        for model, rows in _contributions(connection, condition).items():
+            _upsert(connection, model, rows, sign)
+
+def _contributions(connection, condition):
+    """
+    Aggregate the rollup values of the sales matching a condition.
+
+    param connection: SQLAlchemy connection
+    param condition: Filter on Sale, or None for every sale
+    return: Dictionary of {(year, month, id): (sales_count, price_sum, days_on_market_sum, days_on_market_count, commission_sum, commission_count)} by rollup model
+    """
+    year = cast(func.strftime("%Y", Sale.date_of_sale), Integer)
+    month = cast(func.strftime("%m", Sale.date_of_sale), Integer)
+    days = cast(func.julianday(Sale.date_of_sale) - func.julianday(Listing.date_of_listing), Integer)
+    keys = {AgentMonthlySales: (Sale.agent_id, Commission.agent_id), OfficeMonthlySales: (Listing.office_id, Listing.office_id)}
+    contributions = {}
+    for model, (sale_key, commission_key) in keys.items():
+        rows = {}
+        sales_query = (
+            select(year, month, sale_key, func.count(Sale.sale_id), func.sum(Sale.sale_price), func.sum(days), func.count(days))
+            .select_from(Sale)
+            .join(Listing, Listing.listing_id == Sale.listing_id, isouter=model is AgentMonthlySales)
+            .group_by(year, month, sale_key)
+        )
+        commissions_query = (
+            select(year, month, commission_key, func.sum(Commission.commission_amount), func.count(Commission.commission_id))
+            .select_from(Commission)
+            .join(Sale, Sale.sale_id == Commission.sale_id)
+            .join(Listing, Listing.listing_id == Sale.listing_id, isouter=model is AgentMonthlySales)
+            .group_by(year, month, commission_key)
+        )
+        if condition is not None:
+            sales_query = sales_query.where(condition)
+            commissions_query = commissions_query.where(condition)
+        for row_year, row_month, key, count, price_sum, days_sum, days_count in connection.execute(sales_query):
+            if row_year is not None and key is not None:
+                rows[(row_year, row_month, key)] = (count, price_sum or 0.0, days_sum or 0, days_count, 0.0, 0)
+        for row_year, row_month, key, commission_sum, commission_count in connection.execute(commissions_query):
+            if row_year is not None and key is not None:
+                sales_values = rows.get((row_year, row_month, key), EMPTY_ROLLUP)[:4]
+                rows[(row_year, row_month, key)] = (*sales_values, commission_sum or 0.0, commission_count)
+        contributions[model] = rows
+    return contributions
+
+def _upsert(connection, model, rows, sign):
+    """
+    Add signed rollup values to a rollup table, creating missing rows.
+
+    param connection: SQLAlchemy connection
+    param model: Rollup model
+    param rows: Dictionary of rollup values by (year, month, id)
+    param sign: 1 to add, -1 to subtract
+    return: None
+    """
+    if not rows:
+        return
+    key_columns = [column.name for column in model.__table__.primary_key.columns]
+    statement = insert(model)
+    statement = statement.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={column: getattr(model, column) + getattr(statement.excluded, column) for column in ROLLUP_COLUMNS},
+    )
+    connection.execute(statement, [
+        dict(zip(key_columns, key), **{column: sign * value for column, value in zip(ROLLUP_COLUMNS, values)})
+        for key, values in rows.items()
+    ])
+
+def main():
+    """
+    Rebuild or verify the rollup tables of the database.
+    """
+    parser = argparse.ArgumentParser(description="Maintain the monthly rollup tables.")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    args = parser.parse_args()
+
+    engine = create_sqlite_engine()
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    if args.command == "rebuild":
+        rebuild_rollups(session)
+        print("Rollups rebuilt")
+    else:
+        mismatches = verify_rollups(session)
+        for table, key, expected, stored in mismatches:
+            print(f"{table} {key}: expected {expected}, stored {stored}")
+        print(f"{len(mismatches)} mismatched rollup rows")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,49 @@
+import contextlib
+import csv
+import gzip
+import io
+import json
+import random
+import re
+import tempfile
 import unittest
-from sqlalchemy import create_engine
+from unittest import mock
+from sqlalchemy import create_engine, event, func, text
+from sqlalchemy import insert as insert_statement
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import sessionmaker
 from datetime import timedelta, date
-from create import Base, Office, EstateAgent, Listing, Sale, Commission, MonthlyCommission, AgentOffice, Seller, Buyer
-from queries import get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price, insert_monthly_commissions, print_monthly_commissions
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import aiosqlite
+    import greenlet
+except ImportError:
+    aiosqlite = None
+import asyncio
+from sqlalchemy.ext.asyncio import async_sessionmaker
+import async_queries
+from benchmark import compare, generate_dataset, open_dataset, plans, rolled_back_session
+import importer
+import export
+from export import export_query, export_sales, export_to_path
+from importer import CsvImporter, write_sample_feeds
+from instrumentation import QueryProfiler, normalize_statement
+from partitions import SalesPartitions, split_sales
+from database import create_async_sqlite_engine, create_engines
+from create import Base, Office, EstateAgent, Listing, Sale, Commission, MonthlyCommission, AgentOffice, Seller, Buyer, AgentMonthlySales, ImportCheckpoint
+from insert import COMMISSION_TIERS, ContactKeys, ContactRegistry, _generate_partition, _init_partition_worker, get_commission_rate, recompute_commissions, seed
+from insert import generate_agent_offices, generate_agents, generate_listings_and_sellers, generate_offices, generate_sales_and_commissions, iter_unsold_listings
+from rollups import enable_rollups, rebuild_rollups, verify_rollups
+from report_cache import ReportCache
+from analytics import SalesColumns, _month_index, export_snapshot, refresh_snapshot
+from queries import get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price, insert_monthly_commissions, print_monthly_commissions, store_monthly_commissions
+from queries import (
+    AgentRecord, MonthlyReport, iter_listings, search_listings, sold_between, sold_in_month, get_top_offices_by_month, get_top_agents_by_month, get_average_days_on_market_by_month,
+    get_average_selling_price_by_month, insert_monthly_commissions_range, migrate_monthly_commissions,
+)
 
 class TestMainFunctions(unittest.TestCase):
 
@@ -125,8 +165,8 @@ class TestMainFunctions(unittest.TestCase):
             MonthlyCommission(monthly_commission_id=2, agent_id=2, year=date(2023, 4, 17).year, month=date(2023, 4, 17).month, total_commission=5800),
             MonthlyCommission(monthly_commission_id=3, agent_id=3, year=date(2023, 4, 17).year, month=date(2023, 4, 17).month, total_commission=15600),
             MonthlyCommission(monthly_commission_id=4, agent_id=4, year=date(2023, 4, 17).year, month=date(2023, 4, 17).month, total_commission=0),
-            MonthlyCommission(monthly_commission_id=5, agent_id=1, year=date(2023, 4, 17).year, month=date(2023, 4, 17).month, total_commission=11700),
-            MonthlyCommission(monthly_commission_id=6, agent_id=2, year=date(2023, 4, 17).year, month=date(2023, 4, 17).month, total_commission=13600),
+            MonthlyCommission(monthly_commission_id=5, agent_id=1, year=date(2023, 4, 17).year, month=date(2023, 4, 17).month - 1, total_commission=11700),
+            MonthlyCommission(monthly_commission_id=6, agent_id=2, year=date(2023, 4, 17).year, month=date(2023, 4, 17).month - 1, total_commission=13600),
             MonthlyCommission(monthly_commission_id=7, agent_id=3, year=date(2023, 4, 17).year, month=date(2023, 4, 17).month - 1, total_commission=19500)
 
         ]
@@ -186,8 +226,995 @@ class TestMainFunctions(unittest.TestCase):
             (1, 23400.0), (2, 29100.0), (3, 52600.0)
         ]
         self.assertEqual(monthly_commissions, expected_output)
+        stored = self.session.query(MonthlyCommission.agent_id, MonthlyCommission.total_commission).filter(MonthlyCommission.year == 2023, MonthlyCommission.month == 4).order_by(MonthlyCommission.agent_id).all()
+        self.assertEqual(stored, expected_output + [(4, 0.0)])
+        self.assertEqual(insert_monthly_commissions(self.session, 2023, 4), expected_output)
+        self.assertEqual(self.session.query(MonthlyCommission).count(), 7)
 
+    def test_month_filters_use_date_index(self):
+        """
+        Test that every monthly report reads sales and commissions from the covering indexes only
+        """
+        range_scan = re.compile(r"SEARCH sales USING COVERING INDEX ix_sales_date_listing_agent_price \(date_of_sale>\? AND date_of_sale<\?\)")
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.startswith(("SELECT", "INSERT")) and "sales" in statement:
+                statements.append((statement, parameters))
+        event.listen(self.engine, "before_cursor_execute", record)
+        for report in (get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price, insert_monthly_commissions):
+            statements.clear()
+            report(self.session, 2023, 4)
+            self.assertTrue(statements, report.__name__)
+            for statement, parameters in statements:
+                with self.engine.connect() as connection:
+                    plan = [row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+                self.assertTrue(any(range_scan.match(step) for step in plan), (report.__name__, plan))
+                self.assertFalse(any(step.startswith("SCAN") for step in plan), (report.__name__, plan))
+                self.assertFalse(any(step.startswith("SEARCH commissions") and "COVERING" not in step for step in plan), (report.__name__, plan))
+        event.remove(self.engine, "before_cursor_execute", record)
+
+    def test_monthly_report(self):
+        """
+        Test that the single-pass monthly report matches the individual report queries
+        """
+        report = MonthlyReport(self.session, 2023, 4, chunk_size=3).run()
+        self.assertEqual(report.top_offices, [tuple(office) for office in get_top_offices(self.session, 2023, 4)])
+        self.assertEqual([(agent.agent_id, count) for agent, count in report.top_agents],
+                         [(agent.agent_id, count) for agent, count in get_top_agents(self.session, 2023, 4)])
+        self.assertEqual(report.average_days_on_market, get_average_days_on_market(self.session, 2023, 4))
+        self.assertEqual(report.average_selling_price, get_average_selling_price(self.session, 2023, 4))
+        self.assertEqual(report.monthly_commissions, insert_monthly_commissions(self.session, 2023, 4))
+        self.assertEqual(MonthlyReport(self.session, 2023, 5).run(), ([], [], None, None, []))
+
+    def test_monthly_report_skips_unknown_ids(self):
+        """
+        Test that the top sellers of the single-pass report skip agents and offices missing from their tables before the top 5 is cut, like the SQL reports
+        """
+        self.session.add(Listing(listing_id=11, seller_id=5, bedrooms=2, bathrooms=1, listing_price=100000, zip_code="ZipCode5",
+                                 date_of_listing=date(2023, 4, 1), agent_id=5, office_id=99, status="sold"))
+        for sale_id, agent_id in ((20, 99), (21, 99), (22, 99), (23, 5), (24, 6)):
+            self.session.add(Sale(sale_id=sale_id, listing_id=11, buyer_id=1, sale_price=100000, date_of_sale=date(2023, 4, 18), agent_id=agent_id))
+        self.session.commit()
+        report = MonthlyReport(self.session, 2023, 4).run()
+        top_agents = [(agent.agent_id, count) for agent, count in get_top_agents(self.session, 2023, 4)]
+        self.assertEqual(len(top_agents), 5)
+        self.assertEqual([(agent.agent_id, count) for agent, count in report.top_agents], top_agents)
+        top_offices = [tuple(office) for office in get_top_offices(self.session, 2023, 4)]
+        self.assertEqual(len(top_offices), 5)
+        self.assertEqual(report.top_offices, top_offices)
+
+    def test_report_ranges(self):
+        """
+        Test that the multi-month reports match the single-month reports for every month of the range
+        """
+        self.session.add(Sale(sale_id=17, listing_id=9, buyer_id=1, sale_price=100000, date_of_sale=date(2023, 5, 31), agent_id=4))
+        self.session.add(Commission(commission_id=10, agent_id=4, sale_id=17, commission_amount=10000, commission_date=date(2023, 5, 31)))
+        self.session.commit()
+        start, end = (2023, 3), (2023, 5)
+        top_offices = get_top_offices_by_month(self.session, start, end)
+        top_agents = get_top_agents_by_month(self.session, start, end)
+        days_on_market = get_average_days_on_market_by_month(self.session, start, end)
+        selling_prices = get_average_selling_price_by_month(self.session, start, end)
+        commissions = insert_monthly_commissions_range(self.session, start, end)
+        for year, month in ((2023, 4), (2023, 5)):
+            self.assertEqual([tuple(row[2:]) for row in top_offices if row[:2] == (year, month)],
+                             [tuple(row) for row in get_top_offices(self.session, year, month)])
+            self.assertEqual([(row[2].agent_id, row[3]) for row in top_agents if row[:2] == (year, month)],
+                             [(agent.agent_id, count) for agent, count in get_top_agents(self.session, year, month)])
+            self.assertIn((year, month, get_average_days_on_market(self.session, year, month)), days_on_market)
+            self.assertIn((year, month, get_average_selling_price(self.session, year, month)), selling_prices)
+            self.assertEqual([tuple(row[2:]) for row in commissions if row[:2] == (year, month)],
+                             insert_monthly_commissions(self.session, year, month))
+        self.assertEqual(len(days_on_market), 2)
+
+    def test_report_cache(self):
+        """
+        Test that cached reports are served from the cache until a flush touches their month
+        """
+        cache = ReportCache(maxsize=2)
+        cache.install(self.session)
+        cached_top_agents = cache.wrap(get_top_agents)
+        cached_selling_price = cache.wrap(get_average_selling_price)
+        top_agents = cached_top_agents(self.session, 2023, 4)
+        self.assertEqual([agent.agent_id for agent, _ in top_agents], [1, 2, 3, 4])
+        self.assertIsInstance(top_agents[0].agent, AgentRecord)
+        self.session.commit()
+        # Records hold no session state, so the cached result itself is served after a commit
+        self.assertIs(cached_top_agents(self.session, 2023, 4), top_agents)
+        self.assertEqual(top_agents[0].agent.first_name, "FirstName1")
+        self.assertEqual(cached_selling_price(self.session, 2023, 4), 565625.0)
+        self.assertEqual(cached_selling_price(self.session, 2023, 4), 565625.0)
+        self.assertEqual(cache.info(), (2, 2, 2, 2))
+
+        self.session.add(Sale(sale_id=17, listing_id=10, buyer_id=1, sale_price=1090000, date_of_sale=date(2023, 4, 20), agent_id=4))
+        self.session.commit()
+        self.assertEqual(cache.info().currsize, 0)
+        self.assertAlmostEqual(cached_selling_price(self.session, 2023, 4), 10140000 / 17)
+
+        cached_selling_price(self.session, 2023, 3)
+        cached_selling_price(self.session, 2023, 2)
+        self.assertEqual(cache.info().currsize, 2)
+        cached_selling_price(self.session, 2023, 4)
+        self.assertEqual(cache.info().misses, 6)
+
+        cached_commissions = cache.wrap(insert_monthly_commissions)
+        cached_commissions(self.session, 2023, 4)
+        self.session.add(Commission(commission_id=100, agent_id=4, sale_id=17, commission_amount=100, commission_date=date(2023, 5, 2)))
+        self.session.commit()
+        self.assertNotIn(4, [key[2] for key in cache._entries])
+
+    def test_print_monthly_commissions_statement_count(self):
+        """
+        Test that printing monthly commissions issues the same number of statements for 3 or 40 agents
+        """
+        # The first upsert of an engine checks the unique index once
+        insert_monthly_commissions(self.session, 2023, 4)
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(self.engine, "before_cursor_execute", record)
+        output = io.StringIO()
+        print_monthly_commissions(self.session, insert_monthly_commissions(self.session, 2023, 4), file=output)
+        few_agents = len(statements)
+        self.assertIn("FirstName3           LastName3            $52,600.00", output.getvalue())
+
+        for agent_id in range(7, 44):
+            self.session.add(EstateAgent(agent_id=agent_id, first_name=f"FirstName{agent_id}", last_name=f"LastName{agent_id}", email=f"email{agent_id}@example.com", phone=f"Phone{agent_id}"))
+            self.session.add(Commission(commission_id=agent_id + 100, agent_id=agent_id, sale_id=10, commission_amount=100, commission_date=date(2023, 4, 17)))
+        self.session.commit()
+        statements.clear()
+        output = io.StringIO()
+        monthly_commissions = insert_monthly_commissions(self.session, 2023, 4)
+        print_monthly_commissions(self.session, monthly_commissions, file=output)
+        event.remove(self.engine, "before_cursor_execute", record)
+        self.assertEqual(len(monthly_commissions), 40)
+        self.assertEqual(len(statements), few_agents)
+        self.assertIn("FirstName43", output.getvalue())
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_sales_columns(self):
+        """
+        Test that the columnar engine gives the same answers as the SQL reports
+        """
+        self.session.add(Sale(sale_id=17, listing_id=9, buyer_id=1, sale_price=100000, date_of_sale=date(2023, 5, 31), agent_id=4))
+        self.session.commit()
+        columns = SalesColumns.load(self.session, chunk_size=5)
+        self.assertEqual(len(columns), 17)
+        for year, month in ((2023, 4), (2023, 5), (2023, 6)):
+            self.assertEqual(columns.get_top_offices(year, month), [tuple(office) for office in get_top_offices(self.session, year, month)])
+            self.assertEqual(columns.get_top_agents(year, month), [(agent.agent_id, count) for agent, count in get_top_agents(self.session, year, month)])
+            self.assertEqual(columns.get_average_days_on_market(year, month), get_average_days_on_market(self.session, year, month))
+            self.assertEqual(columns.get_average_selling_price(year, month), get_average_selling_price(self.session, year, month))
+        self.assertEqual(columns.monthly_average_selling_price(), {(2023, 4): 565625.0, (2023, 5): 100000.0})
+        self.assertEqual(columns.monthly_average_days_on_market(), {(2023, 4): 16.0, (2023, 5): 60.0})
+
+        self.session.add(Sale(sale_id=18, listing_id=9, buyer_id=1, sale_price=100000, date_of_sale=date(2023, 5, 30), agent_id=99))
+        self.session.add(Sale(sale_id=19, listing_id=9, buyer_id=1, sale_price=100000, date_of_sale=date(2023, 5, 30), agent_id=99))
+        self.session.commit()
+        columns = SalesColumns.load(self.session)
+        self.assertEqual(columns.get_top_agents(2023, 5), [(agent.agent_id, count) for agent, count in get_top_agents(self.session, 2023, 5)])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_sales_columns_snapshot(self):
+        """
+        Test that a memory-mapped snapshot gives the same answers as the SQL reports after an incremental refresh
+        """
+        with tempfile.TemporaryDirectory() as path:
+            manifest = export_snapshot(self.session, path, chunk_size=5)
+            self.assertEqual(manifest["max_sale_id"], 16)
+            self.assertEqual(SalesColumns.from_snapshot(path).get_monthly_commissions(2023, 4), insert_monthly_commissions(self.session, 2023, 4))
+
+            self.session.add(Listing(listing_id=11, seller_id=5, bedrooms=3, bathrooms=2, listing_price=400000, zip_code="ZipCode5",
+                                     date_of_listing=date(2023, 4, 1), agent_id=4, office_id=6, status="Sold"))
+            self.session.add(Sale(sale_id=17, listing_id=11, buyer_id=1, sale_price=390000, date_of_sale=date(2023, 5, 31), agent_id=4))
+            self.session.add(Commission(commission_id=10, agent_id=4, sale_id=17, commission_amount=10000, commission_date=date(2023, 5, 31)))
+            self.session.add(Sale(sale_id=18, listing_id=11, buyer_id=2, sale_price=380000, date_of_sale=date(2023, 3, 2), agent_id=4))
+            self.session.commit()
+            with mock.patch("analytics._month_index", wraps=_month_index) as month_index:
+                manifest = refresh_snapshot(self.session, path, chunk_size=5)
+            self.assertEqual(manifest["max_sale_id"], 18)
+            self.assertEqual(manifest["rows"]["sale_id"], 18)
+            # Only the appended sales are sorted, and the merged index matches a full rebuild
+            self.assertEqual(len(month_index.call_args.args[0]), 2)
+            rebuilt = _month_index(numpy.fromfile(path + "/sale_day.bin", dtype="<i4"))
+            numpy.testing.assert_array_equal(numpy.fromfile(path + "/month_order.bin", dtype="<i8"), rebuilt[0])
+            numpy.testing.assert_array_equal(numpy.fromfile(path + "/sorted_month.bin", dtype="<i4"), rebuilt[1])
+
+            columns = SalesColumns.from_snapshot(path)
+            self.assertIsInstance(columns.sale_price, numpy.memmap)
+            for year, month in ((2023, 3), (2023, 4), (2023, 5)):
+                self.assertEqual(columns.get_top_offices(year, month), [tuple(office) for office in get_top_offices(self.session, year, month)])
+                self.assertEqual(columns.get_top_agents(year, month), [(agent.agent_id, count) for agent, count in get_top_agents(self.session, year, month)])
+                self.assertEqual(columns.get_average_days_on_market(year, month), get_average_days_on_market(self.session, year, month))
+                self.assertEqual(columns.get_average_selling_price(year, month), get_average_selling_price(self.session, year, month))
+            self.assertEqual(columns.get_monthly_commissions(2023, 5), [(4, 10000.0)])
+            del columns
+
+    def test_recompute_commissions(self):
+        """
+        Test that commissions are recomputed in bulk from a new rate table
+        """
+        self.assertEqual([get_commission_rate(price) for price in (99999, 100000, 500000, 2000000)], [0.1, 0.075, 0.05, 0.04])
+        self.assertEqual(recompute_commissions(self.session, tiers=((300000, 0.05), (None, 0.03)), batch_size=4), 9)
+        amounts = dict(self.session.query(Commission.sale_id, Commission.commission_amount))
+        self.assertEqual((amounts[1], amounts[3], amounts[9]), (9750, 11700, 29700))
+        self.assertEqual(insert_monthly_commissions(self.session, 2023, 4), [(1, 39150), (2, 49900), (3, 80100)])
+        recompute_commissions(self.session)
+        self.assertEqual(self.session.get(Commission, 1).commission_amount, 195000 * get_commission_rate(195000, COMMISSION_TIERS))
+
+    def test_search_listings(self):
+        """
+        Test that keyset pages cover every matching listing once, in price order, with an index range scan
+        """
+        listing_ids = []
+        page = search_listings(self.session, limit=4, status="sold")
+        while True:
+            listing_ids.extend(listing.listing_id for listing in page.listings)
+            if page.next_key is None:
+                break
+            page = search_listings(self.session, after=page.next_key, limit=4, status="sold")
+        self.assertEqual(listing_ids, list(range(1, 11)))
+        self.assertEqual([listing.listing_id for listing in iter_listings(self.session, chunk_size=3, status="sold")], listing_ids)
+        self.assertEqual([listing.listing_id for listing in search_listings(self.session, zip_code="ZipCode1").listings], [1, 7])
+        self.assertEqual([listing.listing_id for listing in iter_listings(self.session, min_bedrooms=5, max_price=800000, listed_to=date(2023, 4, 1))], [4, 5, 6, 7])
+        self.assertEqual(search_listings(self.session, min_price=2000000), ([], None))
+
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("SELECT"):
+                statements.append((statement, parameters))
+        event.listen(self.engine, "before_cursor_execute", record)
+        search_listings(self.session, after=(500000, 4), zip_code="ZipCode4")
+        event.remove(self.engine, "before_cursor_execute", record)
+        plan = " ".join(row[3] for row in self.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + statements[0][0], statements[0][1]))
+        self.assertRegex(plan, r"SEARCH listings USING INDEX ix_listings_zip_code_price \(zip_code=\? AND listing_price>\?\)")
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_results_are_records(self):
+        """
+        Test that reports and record searches return read-only records without adding anything to the identity map
+        """
+        self.session.expunge_all()
+        top_agents = get_top_agents(self.session, 2023, 4)
+        self.assertEqual(top_agents[0], (AgentRecord(1, "FirstName1", "LastName1", "email1@example.com", "Phone1"), top_agents[0].sales_count))
+        self.assertTrue(all(isinstance(agent, AgentRecord) for agent, _ in top_agents + MonthlyReport(self.session, 2023, 4).run().top_agents))
+        page = search_listings(self.session, limit=4, status="sold", records=True)
+        self.assertEqual([listing.listing_id for listing in page.listings], [1, 2, 3, 4])
+        self.assertEqual(page.next_key, (page.listings[-1].listing_price, 4))
+        self.assertEqual([listing.listing_id for listing in iter_listings(self.session, chunk_size=3, status="sold", records=True)], list(range(1, 11)))
+        self.assertEqual(len(self.session.identity_map), 0)
+        with self.assertRaises(AttributeError):
+            page.listings[0].status = "listed"
+
+    def test_contact_registry(self):
+        """
+        Test that the contact registry rejects emails and phones that already exist or were reserved
+        """
+        registry = ContactRegistry.load(self.session, Seller)
+        self.assertEqual(len(registry), 6)
+        self.assertFalse(registry.reserve("selleremail1@example.com", "NewPhone"))
+        self.assertFalse(registry.reserve("new@example.com", "SellerPhone2"))
+        self.assertTrue(registry.reserve("new@example.com", "NewPhone"))
+        self.assertFalse(registry.reserve("new@example.com", "OtherPhone"))
+
+    def test_contact_keys(self):
+        """
+        Test that contact keys stay found across merges of the pending keys into the sorted array, with and without numpy
+        """
+        for np in (numpy, None):
+            with mock.patch("insert.PENDING_KEYS", 4), mock.patch("insert.np", np):
+                keys = ContactKeys([2 ** 64 - 1, 7, 7, 3])
+                self.assertEqual(len(keys), 3)
+                for key in range(100, 110):
+                    keys.add(key)
+                    keys.add(key)
+                self.assertEqual(len(keys), 13)
+                self.assertLess(len(keys.pending), 4)
+                self.assertEqual(list(keys.keys), sorted(keys.keys))
+                self.assertTrue(all(key in keys for key in [3, 7, 2 ** 64 - 1, *range(100, 110)]))
+                self.assertFalse(any(key in keys for key in [0, 4, 99, 110, 2 ** 64 - 2]))
+
+
+
+class TestRollups(TestMainFunctions):
+    """
+    Run the report tests against the incrementally maintained rollup tables.
+    """
+
+    def setUp(self):
+        """
+        Set up the database with rollups enabled and create sample data.
+        """
+        self.engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(self.engine)
+        Session = sessionmaker(bind=self.engine)
+        enable_rollups(Session)
+        self.session = Session()
+        self.create_sample_data()
+
+    def test_month_filters_use_date_index(self):
+        """
+        Test that the read-only reports do not touch the sales table when rollups are enabled
+        """
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(self.engine, "before_cursor_execute", record)
+        for report in (get_top_offices, get_top_agents, get_average_days_on_market, get_average_selling_price, insert_monthly_commissions):
+            report(self.session, 2023, 4)
+        event.remove(self.engine, "before_cursor_execute", record)
+        self.assertFalse([statement for statement in statements if re.search(r"\b(sales|commissions)\b", statement)])
+
+    def test_rollups_follow_updates_and_deletes(self):
+        """
+        Test that changing and deleting sales and commissions keeps the rollups in sync
+        """
+        self.assertEqual(verify_rollups(self.session), [])
+        sale = self.session.get(Sale, 10)
+        sale.date_of_sale = date(2023, 5, 2)
+        self.session.delete(self.session.get(Commission, 9))
+        self.session.add(Commission(commission_id=10, agent_id=4, sale_id=10, commission_amount=1000, commission_date=date(2023, 5, 2)))
+        self.session.commit()
+        self.assertEqual(verify_rollups(self.session), [])
+        self.assertEqual(get_average_selling_price(self.session, 2023, 5), 1090000)
+        self.assertEqual(self.session.get(AgentMonthlySales, (2023, 5, 4)).commission_sum, 1000)
+        self.assertEqual(self.session.get(AgentMonthlySales, (2023, 4, 3)).commission_sum, 33100)
+
+    def test_rollups_skip_missing_listing_dates(self):
+        """
+        Test that sales of listings without a listing date are left out of the rollup average days on market, like SQL avg() does
+        """
+        listing_id = self.session.query(Sale.listing_id).filter(sold_in_month(2023, 4)).first()[0]
+        self.session.get(Listing, listing_id).date_of_listing = None
+        self.session.commit()
+        self.assertEqual(verify_rollups(self.session), [])
+        direct = sessionmaker(bind=self.engine)()
+        self.assertEqual(get_average_days_on_market(self.session, 2023, 4), get_average_days_on_market(direct, 2023, 4))
+        direct.close()
+
+    def test_rollups_follow_bulk_inserts(self):
+        """
+        Test that the batched insert path maintains the rollups and that a rebuild gives the same rows
+        """
+        seed(self.session, num_listings=100, batch_size=30)
+        self.assertEqual(verify_rollups(self.session), [])
+        before = sorted(tuple(row) for row in self.session.query(AgentMonthlySales.year, AgentMonthlySales.month, AgentMonthlySales.agent_id, AgentMonthlySales.sales_count))
+        rebuild_rollups(self.session)
+        after = sorted(tuple(row) for row in self.session.query(AgentMonthlySales.year, AgentMonthlySales.month, AgentMonthlySales.agent_id, AgentMonthlySales.sales_count))
+        self.assertEqual(before, after)
+
+    def test_rollups_follow_flushes_larger_than_a_chunk(self):
+        """
+        Test that a flush changing more sales and listings than fit in one IN clause counts every sale once
+        """
+        seed(self.session, num_listings=100, batch_size=30)
+        sales = self.session.query(Sale).all()
+        listings = self.session.query(Listing).all()
+        for sale in sales:
+            sale.sale_price += 1000
+        # Unsold listings shift the listing ids against the sale ids of the same chunk
+        for listing in listings:
+            listing.bathrooms += 1
+        with mock.patch("rollups.CHUNK_SIZE", 3):
+            self.session.commit()
+        self.assertGreater(len(sales), 10 * 3)
+        self.assertEqual(verify_rollups(self.session), [])
+
+    def test_recompute_commissions(self):
+        """
+        Test that recomputing commissions keeps the rollups in step
+        """
+        super().test_recompute_commissions()
+        self.assertEqual(verify_rollups(self.session), [])
+
+
+class TestBatchedInsert(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Set up an empty in-memory database.
+        """
+        self.engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(self.engine)
+        Session = sessionmaker(bind=self.engine)
+        self.session = Session()
+
+    def tearDown(self):
+        """
+        Close the session and dispose of the engine.
+        """
+        self.session.close()
+        self.engine.dispose()
+
+    def test_batched_seed(self):
+        """
+        Test that the batched generators write consistent sales, commissions and listing statuses
+        """
+        seed(self.session, num_listings=250, batched=True, batch_size=40)
+        sales = self.session.query(Sale).count()
+        self.assertGreater(self.session.query(Listing).count(), 0)
+        self.assertGreater(sales, 0)
+        self.assertEqual(self.session.query(Commission).count(), sales)
+        self.assertEqual(self.session.query(Listing).filter(Listing.status == "sold").count(), sales)
+        self.assertEqual(self.session.query(Sale).join(Listing, Listing.listing_id == Sale.listing_id).filter(Sale.agent_id == Listing.agent_id).count(), sales)
+
+    def test_per_row_seed_streams_listings(self):
+        """
+        Test that the per-row sales generator streams unsold listings in chunks and marks them sold in bulk
+        """
+        generate_offices(self.session, num_offices=3)
+        generate_agents(self.session, num_agents=3)
+        generate_listings_and_sellers(self.session, 25, agents=self.session.query(EstateAgent).all(), offices=self.session.query(Office).all())
+        self.session.query(Listing).filter(Listing.listing_id <= 5).update({"status": "sold"})
+        self.session.commit()
+        self.session.expunge_all()
+        self.assertEqual([len(chunk) for chunk in iter_unsold_listings(self.session, chunk_size=8)], [8, 8, 4])
+        generate_sales_and_commissions(self.session, chunk_size=8)
+        self.assertEqual(len(self.session.identity_map), 0)
+        sold = self.session.query(Listing).filter(Listing.status == "sold", Listing.listing_id > 5).count()
+        self.assertEqual(self.session.query(Sale).count(), sold)
+        self.assertEqual(self.session.query(Sale).filter(Sale.listing_id <= 5).count(), 0)
+
+    def test_per_row_seed_commits_whole_chunks(self):
+        """
+        Test that a failure in the per-row sales generator rolls back its chunk, leaving no sale on a listing still listed
+        """
+        generate_offices(self.session, num_offices=3)
+        generate_agents(self.session, num_agents=3)
+        generate_listings_and_sellers(self.session, 40, agents=self.session.query(EstateAgent).all(), offices=self.session.query(Office).all())
+        calls = []
+
+        def fail_on_tenth_sale(sale_price):
+            calls.append(1)
+            if len(calls) == 10:
+                raise RuntimeError("interrupted")
+            return get_commission_rate(sale_price)
+
+        with mock.patch("insert.get_commission_rate", fail_on_tenth_sale), mock.patch("random.random", return_value=0.0):
+            with self.assertRaises(RuntimeError):
+                generate_sales_and_commissions(self.session, self.session.query(Listing).order_by(Listing.listing_id).all(), chunk_size=8)
+        self.assertEqual(self.session.query(Sale).count(), 8)
+        self.assertEqual(self.session.query(Listing).filter(Listing.status == "sold").count(), 8)
+        self.assertEqual(self.session.query(Commission).count(), 8)
+
+    def test_agent_offices(self):
+        """
+        Test that the office and agent generators return their ids and that only unassigned agents get 1 to 3 offices
+        """
+        offices = generate_offices(self.session, num_offices=5, batch_size=2)
+        agents = generate_agents(self.session, num_agents=40, batch_size=15)
+        self.assertEqual(offices, [office_id for office_id, in self.session.query(Office.office_id).order_by(Office.office_id)])
+        self.assertEqual(agents, [agent_id for agent_id, in self.session.query(EstateAgent.agent_id).order_by(EstateAgent.agent_id)])
+        self.session.add(AgentOffice(agent_id=agents[0], office_id=offices[0]))
+        self.session.commit()
+        agent_offices = generate_agent_offices(self.session, agents, self.session.query(Office).all(), batch_size=10)
+        self.assertEqual(agent_offices, [row_id for row_id, in self.session.query(AgentOffice.agent_office_id).filter(AgentOffice.agent_office_id > 1).order_by(AgentOffice.agent_office_id)])
+        counts = dict(self.session.query(AgentOffice.agent_id, func.count(func.distinct(AgentOffice.office_id))).group_by(AgentOffice.agent_id).all())
+        self.assertEqual(set(counts), set(agents))
+        self.assertEqual(counts[agents[0]], 1)
+        self.assertTrue(all(1 <= count <= 3 for count in counts.values()))
+        self.assertEqual(self.session.query(AgentOffice).count(), sum(counts.values()))
+        self.assertEqual(generate_agent_offices(self.session, agents, offices), [])
+
+    def test_partitions_without_seed_differ(self):
+        """
+        Test that partitions generated without a seed by workers forked with the same random state get different data
+        """
+        self.addCleanup(_init_partition_worker, None)
+        _init_partition_worker({"agent_ids": [1], "office_ids": [1], "seller_id": 1, "listing_id": 1, "buyer_id": 1, "sale_id": 1, "commission_id": 1, "tag": "t", "seed": None})
+        prices = []
+        for index in range(2):
+            random.seed(0)
+            prices.append([listing["listing_price"] for listing in _generate_partition((index, index * 10, 10))[Listing]])
+        self.assertNotEqual(prices[0], prices[1])
+
+    def test_parallel_seed(self):
+        """
+        Test that the parallel generator writes every listing once with valid foreign keys
+        """
+        seed(self.session, num_listings=300, batch_size=70, workers=2)
+        sales = self.session.query(Sale).count()
+        self.assertEqual(self.session.query(Listing).count(), 300)
+        self.assertEqual(self.session.query(Seller).count(), 300)
+        self.assertEqual(self.session.query(Buyer).count(), sales)
+        self.assertEqual(self.session.query(Commission).count(), sales)
+        self.assertEqual(self.session.query(Listing).filter(Listing.status == "sold").count(), sales)
+        self.assertEqual(self.session.query(Listing).join(Office, Office.office_id == Listing.office_id).join(EstateAgent, EstateAgent.agent_id == Listing.agent_id).count(), 300)
+
+
+class TestDatabase(unittest.TestCase):
+
+    def test_create_engines(self):
+        """
+        Test that the tuned engines apply the PRAGMAs and that the read engine rejects writes
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            engines = create_engines("sqlite:///" + directory + "/test.db")
+            Base.metadata.create_all(engines.write)
+            with engines.write.connect() as connection:
+                self.assertEqual(connection.execute(text("PRAGMA journal_mode")).scalar(), "wal")
+                self.assertEqual(connection.execute(text("PRAGMA synchronous")).scalar(), 1)
+                self.assertEqual(connection.execute(text("PRAGMA temp_store")).scalar(), 2)
+            with engines.read.connect() as connection:
+                self.assertEqual(connection.execute(text("SELECT count(*) FROM sales")).scalar(), 0)
+                with self.assertRaises(OperationalError):
+                    connection.execute(text("DELETE FROM sales"))
+            self.assertEqual(engines.write.pool.size(), 1)
+            engines.write.dispose()
+            engines.read.dispose()
+
+    def test_migrate_monthly_commissions(self):
+        """
+        Test that a monthly_commission table without the unique index is deduplicated and indexed, so the monthly upsert works on it
+        """
+        engine = create_engine("sqlite:///:memory:")
+        with engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TABLE monthly_commission (monthly_commission_id INTEGER PRIMARY KEY, agent_id INTEGER, year INTEGER, month INTEGER, total_commission FLOAT)")
+            connection.exec_driver_sql("INSERT INTO monthly_commission (agent_id, year, month, total_commission) VALUES (1, 2023, 4, 10), (1, 2023, 4, 20), (2, 2023, 4, 30), (1, 2023, 3, 40)")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        self.assertEqual(migrate_monthly_commissions(session), 1)
+        self.assertEqual(session.query(MonthlyCommission.agent_id, MonthlyCommission.year, MonthlyCommission.month, MonthlyCommission.total_commission).order_by(MonthlyCommission.monthly_commission_id).all(),
+                         [(1, 2023, 4, 20.0), (2, 2023, 4, 30.0), (1, 2023, 3, 40.0)])
+        with self.assertRaises(IntegrityError):
+            session.execute(insert_statement(MonthlyCommission), {"agent_id": 2, "year": 2023, "month": 4, "total_commission": 0})
+        session.rollback()
+        self.assertEqual(insert_monthly_commissions(session, 2023, 4), [])
+        self.assertEqual(migrate_monthly_commissions(session), 0)
+        session.close()
+        engine.dispose()
+
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        self.assertEqual(migrate_monthly_commissions(session), 0)
+        indexes = session.connection().exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'uq_monthly_commission_agent_month'").all()
+        self.assertEqual(indexes, [])
+        session.close()
+        engine.dispose()
+
+    def test_upserts_migrate_monthly_commissions(self):
+        """
+        Test that every monthly commission upsert migrates a table created before the unique index on its first run
+        """
+        upserts = (
+            lambda session: store_monthly_commissions(session, 2023, 4, [(1, 50.0)]),
+            lambda session: insert_monthly_commissions_range(session, (2023, 1), (2023, 12)),
+        )
+        for upsert in upserts:
+            engine = create_engine("sqlite:///:memory:")
+            with engine.begin() as connection:
+                connection.exec_driver_sql("CREATE TABLE monthly_commission (monthly_commission_id INTEGER PRIMARY KEY, agent_id INTEGER, year INTEGER, month INTEGER, total_commission FLOAT)")
+                connection.exec_driver_sql("INSERT INTO monthly_commission (agent_id, year, month, total_commission) VALUES (1, 2023, 4, 10), (1, 2023, 4, 20)")
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            upsert(session)
+            self.assertEqual(session.query(MonthlyCommission).count(), 1)
+            self.assertEqual(migrate_monthly_commissions(session), 0)
+            session.close()
+            engine.dispose()
+
+
+@unittest.skipIf(aiosqlite is None, "aiosqlite or greenlet is not installed")
+class TestAsyncQueries(unittest.TestCase):
+
+    create_sample_data = TestMainFunctions.create_sample_data
+
+    def setUp(self):
+        """
+        Set up an on-disk database with the sample data, since every aiosqlite connection to :memory: is a new database.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = "sqlite:///" + self.directory.name + "/test.db"
+        self.engine = create_engine(self.url)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.create_sample_data()
+
+    def tearDown(self):
+        """
+        Close the session and remove the database.
+        """
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_monthly_dashboard(self):
+        """
+        Test that the async reports and dashboard give the same answers as the sync reports
+        """
+        async def run():
+            engine = create_async_sqlite_engine(self.url.replace("sqlite://", "sqlite+aiosqlite://"))
+            session_factory = async_sessionmaker(engine, expire_on_commit=False)
+            try:
+                dashboard = await async_queries.get_monthly_dashboard(2023, 4, session_factory)
+                async with session_factory() as session:
+                    commissions = await async_queries.insert_monthly_commissions(session, 2023, 4)
+                return dashboard, commissions
+            finally:
+                await engine.dispose()
+
+        dashboard, commissions = asyncio.run(run())
+        self.assertEqual([tuple(office) for office in dashboard.top_offices], [tuple(office) for office in get_top_offices(self.session, 2023, 4)])
+        self.assertEqual([(agent.agent_id, count) for agent, count in dashboard.top_agents], [(agent.agent_id, count) for agent, count in get_top_agents(self.session, 2023, 4)])
+        self.assertEqual(dashboard.average_days_on_market, get_average_days_on_market(self.session, 2023, 4))
+        self.assertEqual(dashboard.average_selling_price, 565625.0)
+        self.assertEqual(commissions, [(1, 23400.0), (2, 29100.0), (3, 52600.0)])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_generate_dataset(self):
+        """
+        Test that generated datasets are deterministic and consistent
+        """
+        rows = []
+        for _ in range(2):
+            engine = create_engine("sqlite:///:memory:")
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            sales = generate_dataset(session, 500, num_offices=10, num_agents=20, batch_size=120)
+            self.assertEqual(session.query(Listing).filter(Listing.status == "sold").count(), sales)
+            self.assertEqual(session.query(Commission).count(), sales)
+            self.assertEqual(session.query(Seller).count(), 500)
+            rows.append(session.query(Sale.sale_id, Sale.listing_id, Sale.sale_price, Sale.date_of_sale).order_by(Sale.sale_id).all())
+            session.close()
+            engine.dispose()
+        self.assertEqual(rows[0], rows[1])
+
+    def test_compare(self):
+        """
+        Test that only cases slower than the threshold are flagged
+        """
+        baseline = {"results": [{"name": "a", "size": 10, "seconds": 1.0}, {"name": "b", "size": 10, "seconds": 1.0}]}
+        current = {"results": [{"name": "a", "size": 10, "seconds": 1.5}, {"name": "b", "size": 10, "seconds": 1.1}, {"name": "c", "size": 10, "seconds": 9.0}]}
+        with io.StringIO() as output, contextlib.redirect_stdout(output):
+            self.assertEqual(compare(baseline, current, threshold=0.2), [("a", 10, 1.0, 1.5)])
+
+    def test_plans(self):
+        """
+        Test that the reports are timed and explained with the replaced indexes and then the covering ones
+        """
+        with tempfile.TemporaryDirectory() as directory, io.StringIO() as output, contextlib.redirect_stdout(output):
+            results = plans(300, directory, repeat=1)
+            engine = open_dataset(directory, 300)
+            with engine.connect() as connection:
+                indexes = {name for name, in connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            engine.dispose()
+        self.assertIn("ix_sales_date_of_sale", " ".join(results["get_average_selling_price"]["before"]["plans"][0]))
+        self.assertIn("COVERING INDEX ix_sales_date_listing_agent_price", " ".join(results["get_average_selling_price"]["after"]["plans"][0]))
+        self.assertTrue({"ix_sales_date_listing_agent_price", "ix_commissions_sale_agent_amount"} <= indexes)
+        self.assertFalse({"ix_sales_date_of_sale", "ix_commissions_sale_id"} & indexes)
+
+    def test_writer_cases_are_rolled_back(self):
+        """
+        Test that commits of a rolled back session are undone, so the writer cases leave the cached dataset untouched
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            engine = open_dataset(directory, 300)
+            with engine.connect() as connection:
+                amounts = connection.execute(func.sum(Commission.commission_amount).select()).scalar()
+            with rolled_back_session(engine) as (session, rollback):
+                for _ in range(2):
+                    self.assertTrue(insert_monthly_commissions(session, 2022, 6))
+                    self.assertGreater(recompute_commissions(session, tiers=((100000, 0.5), (None, 0.25))), 0)
+                    self.assertGreater(session.query(MonthlyCommission).count(), 0)
+                    rollback()
+                    self.assertEqual(session.query(MonthlyCommission).count(), 0)
+            with engine.connect() as connection:
+                self.assertEqual(connection.execute(func.count(MonthlyCommission.agent_id).select()).scalar(), 0)
+                self.assertEqual(connection.execute(func.sum(Commission.commission_amount).select()).scalar(), amounts)
+            engine.dispose()
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Set up an in-memory database with a profiler installed.
+        """
+        self.engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.profiler = QueryProfiler(threshold=None)
+        self.profiler.install(self.engine)
+
+    def tearDown(self):
+        """
+        Close the session and dispose of the engine.
+        """
+        self.session.close()
+        self.engine.dispose()
+
+    def test_statements_are_grouped(self):
+        """
+        Test that statements differing only in values are grouped with their calls, written rows and latency histogram
+        """
+        self.assertEqual(normalize_statement("SELECT a FROM t WHERE b IN (?, ?, ?) AND c = 'x''y' LIMIT 10"), "SELECT a FROM t WHERE b IN (?, ...) AND c = ? LIMIT ?")
+        for ids in ([1], [1, 2, 3]):
+            self.session.query(Listing).filter(Listing.listing_id.in_(ids)).all()
+        self.session.execute(insert_statement(Office), [{"office_id": i, "address": "a", "city": "c", "state": "s", "zip_code": "z"} for i in range(3)])
+        stats = {stats.statement.split(" ")[0]: stats for stats in self.profiler.summary()}
+        self.assertEqual(stats["SELECT"].calls, 2)
+        self.assertEqual(sum(stats["SELECT"].buckets), 2)
+        self.assertIsNone(stats["SELECT"].rows_written)
+        self.assertEqual(stats["INSERT"].rows_written, 3)
+        metrics = self.profiler.prometheus()
+        self.assertIn("# TYPE sql_statement_duration_seconds histogram", metrics)
+        self.assertRegex(metrics, r'sql_statement_duration_seconds_bucket\{statement="SELECT [^"]*IN \(\?, \.\.\.\)[^"]*",le="\+Inf"\} 2')
+        self.assertRegex(metrics, r'sql_statement_rows_written_total\{statement="INSERT INTO offices[^"]*"\} 3')
+        self.assertNotRegex(metrics, r'sql_statement_rows_written_total\{statement="SELECT')
+
+        self.profiler.uninstall(self.engine)
+        self.session.query(Listing).all()
+        self.assertEqual(sum(stats.calls for stats in self.profiler.summary()), 3)
+
+    def test_slow_statements_are_logged_with_plan(self):
+        """
+        Test that statements above the threshold are logged with their query plan
+        """
+        self.profiler.threshold = 0
+        with self.assertLogs("instrumentation", level="WARNING") as logs:
+            search_listings(self.session, zip_code="ZipCode1")
+        self.assertIn("SEARCH listings USING INDEX ix_listings_zip_code_price", logs.output[0])
+
+
+class TestPartitions(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Set up a generated dataset in a temporary database file and an empty partition directory.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine("sqlite:///" + self.directory.name + "/main.db")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        generate_dataset(self.session, 600, num_offices=10, num_agents=20)
+        self.partitions = SalesPartitions(self.engine, self.directory.name + "/partitions")
+
+    def tearDown(self):
+        """
+        Close the session, dispose of the engine and remove the files.
+        """
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_reports_are_routed_to_their_partition(self):
+        """
+        Test that the monthly reports give the same results on the partition of their month as on the single sales table
+        """
+        reports = (get_top_offices, get_average_days_on_market, get_average_selling_price, insert_monthly_commissions)
+        expected = [report(self.session, 2022, month) for month in (3, 6) for report in reports]
+        agents = [(agent.agent_id, count) for agent, count in get_top_agents(self.session, 2022, 6)]
+        sales = self.session.query(Sale).count()
+        self.assertEqual(split_sales(self.session, self.partitions, chunk_size=50), sales)
+        self.assertEqual(self.session.query(Sale).count() + self.session.query(Commission).count(), 0)
+        self.assertEqual([self.partitions.report(report, 2022, month) for month in (3, 6) for report in reports], expected)
+        self.assertEqual(self.partitions.report(lambda session, year, month: [(agent.agent_id, count) for agent, count in get_top_agents(session, year, month)], 2022, 6), agents)
+        with self.partitions.session(2022, 6) as session:
+            self.assertEqual(session.query(Sale).filter(~sold_in_month(2022, 6)).count(), 0)
+        self.assertEqual(self.partitions.report(get_top_offices, 2030, 1), [])
+        self.assertNotIn("2030_01", self.partitions.keys())
+
+    def test_interrupted_split_resumes(self):
+        """
+        Test that a split interrupted after writing a partition but before deleting from the main database resumes when run again
+        """
+        expected = [report(self.session, 2022, 6) for report in (get_top_offices, get_average_selling_price)]
+        sales = self.session.query(Sale).count()
+        with mock.patch("partitions.delete", side_effect=RuntimeError("interrupted")):
+            with self.assertRaises(RuntimeError):
+                split_sales(self.session, self.partitions, chunk_size=50)
+        self.session.rollback()
+        self.assertEqual(self.session.query(Sale).count(), sales)
+        self.assertEqual(split_sales(self.session, self.partitions, chunk_size=50), sales)
+        self.assertEqual(self.session.query(Sale).count(), 0)
+        self.assertEqual([self.partitions.report(report, 2022, 6) for report in (get_top_offices, get_average_selling_price)], expected)
+
+    def test_write_and_archive(self):
+        """
+        Test that new sales are routed by sale date with their commissions and that old partitions are archived
+        """
+        self.session.query(Commission).delete()
+        self.session.query(Sale).delete()
+        self.session.commit()
+        sales = [{"sale_id": i, "listing_id": i, "buyer_id": 1, "sale_price": 100000.0, "date_of_sale": day, "agent_id": 1}
+                 for i, day in enumerate((date(2021, 12, 31), date(2022, 1, 1), date(2022, 1, 15)), 1)]
+        commissions = [{"commission_id": i, "agent_id": 1, "sale_id": i, "commission_amount": 10000.0, "commission_date": date(2022, 2, 1)} for i in range(1, 4)]
+        self.assertEqual(self.partitions.write(sales, commissions), {"2021_12": 1, "2022_01": 2})
+        self.assertEqual(self.partitions.report(insert_monthly_commissions, 2022, 1), [(1, 20000.0)])
+        late = {"commission_id": 4, "agent_id": 1, "sale_id": 2, "commission_amount": 5000.0, "commission_date": date(2022, 3, 1)}
+        self.assertEqual(self.partitions.write([], [late]), {"2022_01": 0})
+        self.assertEqual(self.partitions.report(insert_monthly_commissions, 2022, 1), [(1, 25000.0)])
+        with self.assertRaises(ValueError):
+            self.partitions.write([], [dict(late, commission_id=5, sale_id=99)])
+        archive = self.directory.name + "/archive"
+        self.assertEqual(self.partitions.archive((2022, 1), archive), ["2021_12"])
+        self.assertEqual(self.partitions.keys(), ["2022_01"])
+        self.assertEqual(self.partitions.report(get_average_selling_price, 2021, 12), None)
+        self.assertEqual(SalesPartitions(self.engine, archive).report(get_average_selling_price, 2021, 12), 100000.0)
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Set up an empty temporary database file and a directory for the feeds.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine("sqlite:///" + self.directory.name + "/import.db")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        """
+        Close the session, dispose of the engine and remove the files.
+        """
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def write_feed(self, feed, lines):
+        """
+        Write a CSV feed file into the feed directory.
+        """
+        with open(f"{self.directory.name}/{feed}.csv", "w") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def test_import_feeds(self):
+        """
+        Test that the feeds are imported with their foreign keys resolved, duplicate contacts merged and invalid rows rejected
+        """
+        self.session.add(Seller(seller_id=1, name="Existing", email=" Existing@Example.com", phone="111"))
+        self.session.commit()
+        self.write_feed("offices", ["office_id,address,city,state,zip_code", "O1,1 Main St,Springfield,IL,62701"])
+        self.write_feed("agents", ["agent_id,first_name,last_name,email,phone,office_id", "A1,Ann,Lee,ann@example.com,222,O1", "A2,Bob,Ray,bob@example.com,333,O9"])
+        self.write_feed("sellers", ["seller_id,name,email,phone", "S1,Sam,Sam@Example.com ,444", "S2,Sam Again,sam@example.com,555", "S3,Old,existing@example.com,999"])
+        self.write_feed("listings", [
+            "listing_id,seller_id,bedrooms,bathrooms,listing_price,date_of_listing,agent_id,office_id",
+            "L1,S1,3,2,300000,2022-01-10,A1,O1", "L2,S2,2,1,200000,2022-01-11,A1,O1", "L3,S3,2,1,-5,2022-01-12,A1,O1",
+            "L4,S3,4,3,500000,2022-01-13,A1,O1", "L5,S4,1,1,100000,2022-01-14,A1,O1",
+        ])
+        self.write_feed("buyers", ["buyer_id,name,email,phone", "B1,Bea,bea@example.com,666"])
+        self.write_feed("sales", ["sale_id,listing_id,buyer_id,sale_price,date_of_sale,agent_id", "T1,L2,B1,210000,2022-03-01,A1", "T2,L3,B1,100000,2022-03-02,A1"])
+        rejects = io.StringIO()
+        reports = CsvImporter(self.session, chunk_size=2, rejects=rejects).run(self.directory.name)
+        self.assertEqual([(report.feed, report.rows, report.imported, report.duplicates, report.rejected) for report in reports], [
+            ("offices", 1, 1, 0, 0), ("agents", 2, 1, 0, 1), ("sellers", 3, 1, 2, 0),
+            ("listings", 5, 3, 0, 2), ("buyers", 1, 1, 0, 0), ("sales", 2, 1, 0, 1),
+        ])
+        self.assertEqual([row.split(",")[:3] for row in rejects.getvalue().splitlines()], [
+            ["agents", "3", "unknown office_id O9"], ["listings", "4", "negative listing_price -5"],
+            ["listings", "6", "unknown seller_id S4"], ["sales", "3", "unknown listing_id L3"],
+        ])
+        self.assertEqual(self.session.query(Seller.email).order_by(Seller.seller_id).all(), [(" Existing@Example.com",), ("sam@example.com",)])
+        listings = self.session.query(Listing.listing_price, Listing.seller_id, Listing.status).order_by(Listing.listing_id).all()
+        self.assertEqual(listings, [(300000.0, 2, "listed"), (200000.0, 2, "sold"), (500000.0, 1, "listed")])
+        self.assertEqual(self.session.query(AgentOffice).count(), 1)
+        commission = self.session.query(Commission).one()
+        self.assertEqual(commission.commission_amount, 210000 * get_commission_rate(210000))
+        self.assertEqual(CsvImporter(self.session).run(self.directory.name)[0].rows, 0)
+
+    def test_resume_after_failure(self):
+        """
+        Test that an import interrupted by a failed chunk resumes after its last committed chunk and ends like an uninterrupted one
+        """
+        write_sample_feeds(self.directory.name, 300)
+        write_batch = importer.write_batch
+        calls = []
+
+        def fail_on_tenth_chunk(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 10:
+                args[0].rollback()
+                raise OperationalError("INSERT", {}, Exception("disk I/O error"))
+            return write_batch(*args, **kwargs)
+
+        with mock.patch("importer.write_batch", fail_on_tenth_chunk):
+            with self.assertRaises(OperationalError):
+                CsvImporter(self.session, chunk_size=50).run(self.directory.name)
+        self.assertEqual(self.session.query(Seller).count(), 297)
+        self.assertEqual(self.session.query(Listing).count(), 50)
+        CsvImporter(self.session, chunk_size=50).run(self.directory.name)
+        self.assertEqual(self.session.query(func.sum(ImportCheckpoint.rows)).scalar(), sum(1 for feed in importer.FEEDS for _ in open(f"{self.directory.name}/{feed}.csv")) - len(importer.FEEDS))
+
+        expected_engine = create_engine("sqlite://")
+        Base.metadata.create_all(expected_engine)
+        expected = sessionmaker(bind=expected_engine)()
+        CsvImporter(expected, chunk_size=50).run(self.directory.name)
+        for model in (Office, EstateAgent, AgentOffice, Seller, Listing, Buyer, Sale, Commission):
+            columns = model.__table__.columns
+            self.assertEqual(self.session.query(*columns).order_by(*columns).all(), expected.query(*columns).order_by(*columns).all())
+        expected.close()
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Set up a generated dataset in a temporary database file.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine("sqlite:///" + self.directory.name + "/export.db")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        generate_dataset(self.session, 600, num_offices=10, num_agents=20)
+
+    def tearDown(self):
+        """
+        Close the session, dispose of the engine and remove the files.
+        """
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_export_csv(self):
+        """
+        Test that the CSV export holds every sale of the range once, in date order, with its listing, agent, office and commission
+        """
+        output = io.StringIO()
+        self.assertEqual(export_sales(self.session, output, start=(2022, 3), end=(2022, 5), chunk_size=7), self.session.query(Sale).filter(sold_between((2022, 3), (2022, 5))).count())
+        rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+        self.assertEqual(len({row["sale_id"] for row in rows}), len(rows))
+        self.assertEqual([row["date_of_sale"] for row in rows], sorted(row["date_of_sale"] for row in rows))
+        self.assertTrue("2022-03-01" <= rows[0]["date_of_sale"] and rows[-1]["date_of_sale"] < "2022-06-01")
+        sale = self.session.get(Sale, int(rows[0]["sale_id"]))
+        commission = self.session.query(Commission).filter_by(sale_id=sale.sale_id).one()
+        self.assertEqual((int(rows[0]["listing_id"]), int(rows[0]["agent_id"]), int(rows[0]["office_id"])), (sale.listing_id, sale.agent_id, self.session.get(Listing, sale.listing_id).office_id))
+        self.assertEqual(float(rows[0]["commission_amount"]), round(commission.commission_amount, 2))
+        output = io.StringIO()
+        self.assertEqual(export_sales(self.session, output, start=(2030, 1), end=(2030, 1)), 0)
+        self.assertEqual(output.getvalue().splitlines(), [",".join(rows[0])])
 
+    def test_export_gzip_ndjson(self):
+        """
+        Test that an export to a .ndjson.gz file is compressed NDJSON holding the same rows as the CSV export
+        """
+        path = self.directory.name + "/sales.ndjson.gz"
+        report = export_to_path(self.session, path, chunk_size=50)
+        self.assertEqual(report.rows, self.session.query(Sale).count())
+        with gzip.open(path, "rt") as file:
+            rows = [json.loads(line) for line in file]
+        output = io.StringIO()
+        export_sales(self.session, output)
+        self.assertEqual([{key: str(value) if value is not None else "" for key, value in row.items()} for row in rows], list(csv.DictReader(io.StringIO(output.getvalue()))))
+        with self.assertRaises(ValueError):
+            export_sales(self.session, io.StringIO(), format="xml")
+
+    def test_export_open_ranges(self):
+        """
+        Test that an export with only --from or only --to leaves the other side of the range open
+        """
+        cases = (("--from", "2022-06", (2022, 6), None, Sale.date_of_sale >= date(2022, 6, 1)), ("--to", "2022-05", None, (2022, 5), Sale.date_of_sale < date(2022, 6, 1)))
+        for option, month, start, end, condition in cases:
+            expected = self.session.query(Sale).filter(condition).count()
+            self.assertEqual(export_sales(self.session, io.StringIO(), start=start, end=end), expected)
+            path = f"{self.directory.name}/{option[2:]}.csv"
+            with mock.patch("sys.argv", ["export.py", path, option, month]), mock.patch("export.create_sqlite_engine", return_value=self.engine), \
+                    io.StringIO() as output, contextlib.redirect_stdout(output):
+                export.main()
+            with open(path) as file:
+                dates = [row["date_of_sale"] for row in csv.DictReader(file)]
+            self.assertEqual(len(dates), expected)
+            self.assertTrue(dates[0] >= "2022-06-01" if start else dates[-1] < "2022-06-01")
+
+    def test_export_keeps_sales_with_missing_rows(self):
+        """
+        Test that a sale whose listing has no office is still exported once, and that the export reads the date index without sorting
+        """
+        sale = self.session.query(Sale).order_by(Sale.sale_id).first()
+        self.session.get(Listing, sale.listing_id).office_id = None
+        self.session.commit()
+        output = io.StringIO()
+        self.assertEqual(export_sales(self.session, output), self.session.query(Sale).count())
+        rows = [row for row in csv.DictReader(io.StringIO(output.getvalue())) if int(row["sale_id"]) == sale.sale_id]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]["listing_id"], rows[0]["office_id"], rows[0]["office_city"]), (str(sale.listing_id), "", ""))
+        statement = export_query((2022, 3), (2022, 5)).compile(self.engine)
+        plan = " ".join(row[3] for row in self.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + str(statement), tuple(statement.params[key] for key in statement.positiontup)))
+        self.assertIn("sales USING INDEX ix_sales_date_listing_agent_price", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
 
 
 if __name__ == '__main__':